@@ -0,0 +1,633 @@
+import json
+import logging
+import os
+
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from string import ascii_lowercase, digits
+from time import perf_counter
+from typing import Iterable
+
+from citymap import MinimalMap, RoundCityMap, readSnapshot
+from cityimage import (
+    CityImage,
+    DarkCityImage,
+    ENCODING_FORMATS,
+    ImageEncoder,
+    MinimalisticCityImage,
+    encodedFilenames,
+    encodingOptions,
+)
+from geometry import Geometry
+from instrumentation import Instrumentation
+from osmcache import ImageCache
+
+# image classes providing the palette of each theme
+THEMES = {
+    "light": CityImage,
+    "dark": DarkCityImage,
+}
+MAP_TYPES = ["round", "minimal"]
+
+
+def slugify(city: str) -> str:
+    """Formats a city name to be used in filenames
+
+    Args:
+        city (str): City name
+
+    Returns:
+        str
+    """
+    return "".join(
+        [
+            c
+            for c in city.lower().replace(" ", "-")
+            if c in ascii_lowercase or c in digits or c == "-"
+        ]
+    )
+
+
+def loadJobs(path: str) -> list[dict]:
+    """Loads a job list from a JSON file.
+    The file contains a list of jobs, each one being either a city name or a dict with keys:
+
+    - city (str): City name
+    - radius (float, optional): Radius of the round map, in meters. Defaults to 3000.
+    - maps (list[str], optional): Maps to be rendered ("round", "minimal"). Defaults to both.
+    - themes (list[str], optional): Themes of the round map ("light", "dark"). Defaults to both.
+    - output (str, optional): Output folder. Defaults to "output".
+    - name (str, optional): Prefix of the output files. Defaults to the formatted city name.
+    - density (bool, optional): Draw the density of the minimal map features instead of
+      each point. Defaults to False.
+    - encoding (dict, optional): Format, compression and sizes of the images,
+      see cityimage.encodingOptions. Defaults to full RGB PNG.
+
+    Args:
+        path (str): Job file
+
+    Returns:
+        list[dict]: list of jobs, with all their keys
+    """
+    with open(path, "r") as f:
+        raw = json.load(f)
+
+    return [normalizeJob(j) for j in raw]
+
+
+def normalizeJob(job: dict | str) -> dict:
+    """Fills the missing keys of a job and validates it
+
+    Args:
+        job (dict | str): Job, or city name
+
+    Raises:
+        ValueError: the job contains an unknown map type, theme or encoding option
+
+    Returns:
+        dict
+    """
+    if isinstance(job, str):
+        job = {"city": job}
+
+    job = {
+        "radius": 3000,
+        "maps": list(MAP_TYPES),
+        "themes": list(THEMES),
+        "output": "output",
+        "name": slugify(job["city"]),
+        "density": False,
+        **job,
+    }
+    job["encoding"] = encodingOptions(job.get("encoding"))
+
+    if unknown := set(job["maps"]) - set(MAP_TYPES):
+        raise ValueError(f"Unknown map types {sorted(unknown)} in job {job['city']}")
+    if unknown := set(job["themes"]) - set(THEMES):
+        raise ValueError(f"Unknown themes {sorted(unknown)} in job {job['city']}")
+
+    return job
+
+
+def expectedOutputs(job: dict, empty: Iterable[str] = ()) -> dict[str, dict[str, str]]:
+    """Returns the files produced by a job
+
+    Args:
+        job (dict)
+        empty (Iterable[str], optional): Files of the minimal map features found without
+            elements, which are never produced. Defaults to ().
+
+    Returns:
+        dict[str, dict[str, str]]: for each map type, filename of each theme (round map)
+            or feature (minimal map)
+    """
+    prefix = os.path.join(job["output"], job["name"])
+    extension = ENCODING_FORMATS[job["encoding"]["format"]]
+    outputs = {}
+
+    if "round" in job["maps"]:
+        outputs["round"] = {
+            theme: f"{prefix}-minimal{extension}"
+            if theme == "light"
+            else f"{prefix}-minimal-{theme}{extension}"
+            for theme in job["themes"]
+        }
+
+    if "minimal" in job["maps"]:
+        empty = set(empty)
+        outputs["minimal"] = {
+            name: filename
+            for name in MinimalMap(job["city"]).feature_definitions
+            if (filename := f"{prefix}-{name.replace(' ', '-')}{extension}") not in empty
+        }
+
+    return outputs
+
+
+def snapshotPath(
+    job: dict, map_type: str, snapshot_dir: str | None, key: str = ""
+) -> str | None:
+    """Returns the snapshot file of a map of a job
+
+    Args:
+        job (dict)
+        map_type (str): "round" or "minimal"
+        snapshot_dir (str | None): Snapshot folder
+        key (str, optional): Snapshot key of the map (see CityMap.snapshotKey), so that
+            maps queried with different parameters get different files. Defaults to "".
+
+    Returns:
+        str | None: None if snapshots are not used
+    """
+    if not snapshot_dir:
+        return None
+
+    suffix = f"round-{job['radius']}" if map_type == "round" else map_type
+    if key:
+        suffix = f"{suffix}-{key[:16]}"
+    return os.path.join(snapshot_dir, f"{job['name']}-{suffix}.snapshot")
+
+
+def snapshotData(map_type: str, snapshot: str) -> dict:
+    """Opens a snapshot, returning its geometry in the same form of fetchJob.
+    Coordinates are memory mapped, so processes opening the same snapshot share them.
+
+    Args:
+        map_type (str): "round" or "minimal"
+        snapshot (str): Snapshot file
+
+    Returns:
+        dict
+    """
+    header, geometry = readSnapshot(snapshot)
+
+    if map_type == "minimal":
+        return {
+            f["name"]: (geometry[f["name"]], f["color"])
+            for f in header["features"]
+            if "node" in f["topology"]
+        }
+
+    return geometry
+
+
+def fetchJob(
+    job: dict, profile_dir: str | None = None, snapshot_dir: str | None = None
+) -> tuple[dict[str, dict | str], dict[str, dict]]:
+    """Loads the maps of a job. Runs on the I/O workers.
+    With a snapshot folder, each map is saved as a snapshot and its path is returned instead
+    of its geometry, so that render processes map it instead of unpickling it.
+    Maps with a valid snapshot (same query parameters, not expired) are not loaded again.
+
+    Args:
+        job (dict)
+        profile_dir (str | None, optional): Folder of the cProfile stats. Defaults to None.
+        snapshot_dir (str | None, optional): Folder of the map snapshots. Defaults to None.
+
+    Returns:
+        tuple[dict[str, dict | str], dict[str, dict]]: geometry (or snapshot path) and
+            instrumentation report of each map type
+    """
+    data = {}
+    reports = {}
+
+    for map_type in job["maps"]:
+        instrumentation = Instrumentation(f"{job['name']}-{map_type}", profile_dir)
+        if map_type == "round":
+            m = RoundCityMap(job["city"], job["radius"], instrumentation=instrumentation)
+        else:
+            m = MinimalMap(job["city"], instrumentation=instrumentation)
+
+        snapshot = snapshotPath(job, map_type, snapshot_dir, m.snapshotKey())
+        if snapshot and m.isSnapshotValid(snapshot):
+            data[map_type] = snapshot
+            continue
+
+        m.loadCity()
+        m.loadFeatures()
+        reports[map_type] = instrumentation.report()
+
+        if snapshot:
+            m.saveSnapshot(snapshot)
+            data[map_type] = snapshot
+        elif map_type == "round":
+            data["round"] = {
+                f: getattr(m, f) for f in ["trees", "water", "parks", "buildings"]
+            }
+        else:
+            data["minimal"] = {
+                tag: (coords, m.getColor(tag))
+                for tag, coords in m.circular_features.items()
+            }
+
+    return data, reports
+
+
+def renderMap(
+    map_type: str,
+    city: str,
+    data: dict | str,
+    outputs: dict[str, str],
+    name: str = "",
+    profile_dir: str | None = None,
+    layer_cache: str | None = None,
+    density: bool = False,
+    encoding: dict | None = None,
+) -> tuple[list[str], dict]:
+    """Renders a map and saves its images. Runs on the render processes.
+    Images are first written to temporary files, so that a crash never leaves
+    partial outputs behind. The images of the map are encoded concurrently,
+    on a couple of threads.
+
+    Args:
+        map_type (str): "round" or "minimal"
+        city (str): City name
+        data (dict | str): Geometry of the map (or its snapshot), as returned by fetchJob
+        outputs (dict[str, str]): Filename of each theme (round map) or feature (minimal map)
+        name (str, optional): Name of the job, used in the report. Defaults to "".
+        profile_dir (str | None, optional): Folder of the cProfile stats. Defaults to None.
+        layer_cache (str | None, optional): Folder of the rasterized layers of the round map,
+            see CityImage. Defaults to None (no cache).
+        density (bool, optional): Draw the density of the minimal map features instead of
+            each point. Defaults to False.
+        encoding (dict | None, optional): Encoding options of the images,
+            see cityimage.encodingOptions. Defaults to None (full RGB PNG).
+
+    Returns:
+        tuple[list[str], dict]: saved files (downscaled copies included),
+            instrumentation report
+    """
+    if isinstance(data, str):
+        data = snapshotData(map_type, data)
+
+    tmp = {k: "{}.tmp{}".format(*os.path.splitext(v)) for k, v in outputs.items()}
+    instrumentation = Instrumentation(f"{name}-{map_type}-image", profile_dir)
+    # the encoder waits for all the images when the block ends
+    with ImageEncoder(workers=2) as encoder:
+        if map_type == "round":
+            cache = ImageCache(layer_cache) if layer_cache else None
+            image = CityImage(
+                layer_cache=cache,
+                encoding=encoding,
+                encoder=encoder,
+                instrumentation=instrumentation,
+            )
+            image.drawTrees(data["trees"])
+            image.drawWater(data["water"])
+            image.drawParks(data["parks"])
+            image.drawBuildings(data["buildings"])
+            image.drawTitle(city)
+            image.saveThemes({tmp[t]: THEMES[t]().palette for t in outputs})
+
+        elif map_type == "minimal":
+            image = MinimalisticCityImage(
+                encoding=encoding, encoder=encoder, instrumentation=instrumentation
+            )
+            city_name = city.split(",")[0]
+            # features without elements get no image
+            data = {tag: v for tag, v in data.items() if tag in outputs and len(v[0])}
+            for tag, (coords, fill) in data.items():
+
+                if density:
+                    image.drawDensity(coords, fill=fill, layer=tag)
+                else:
+                    image.drawPoints(coords, fill, layer=tag)
+                image.drawTitle(f"{city_name} and its {len(coords)} {tag}", layer=tag)
+
+            tmp = {k: v for k, v in tmp.items() if k in data}
+            image.saveLayers(tmp)
+
+    saved = []
+    for key, filename in tmp.items():
+        for src, dst in zip(
+            encodedFilenames(filename, encoding),
+            encodedFilenames(outputs[key], encoding),
+        ):
+            os.replace(src, dst)
+            saved.append(dst)
+
+    return saved, instrumentation.report()
+
+
+def estimateRenderMemory(data: dict | str, outputs: dict[str, str]) -> int:
+    """Estimates the peak memory of a render process, in bytes
+
+    Args:
+        data (dict | str): Geometry of the map, or its snapshot
+        outputs (dict[str, str]): Output files
+
+    Returns:
+        int
+    """
+    if isinstance(data, str):
+        data = readSnapshot(data)[1]
+
+    image = CityImage()
+    real_size = tuple(int(image._sizes[x] / image._supersample) for x in range(2))
+    tile = image._tile_size * image._supersample + 2 * image._margin()
+
+    geometry = [g if isinstance(g, Geometry) else g[0] for g in data.values()]
+    # recorded operations hold int32 coordinates and bounding boxes
+    operations = sum(g.nbytes + len(g) * 16 for g in geometry)
+    # every output image is kept until the end, along with a few tile buffers
+    images = len(outputs) * real_size[0] * real_size[1] * 3 + 3 * tile * tile * 3
+    interpreter = 150 * 1024**2
+
+    return operations * 2 + images + interpreter
+
+
+def availableMemory() -> int:
+    """Returns the memory available on the machine, in bytes
+
+    Returns:
+        int
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        jobs: list[dict],
+        status_path: str | None = None,
+        fetch_workers: int = 4,
+        render_workers: int | None = None,
+        memory_limit: int | None = None,
+        profile_dir: str | None = None,
+        layer_cache: str | None = None,
+        snapshot_dir: str | None = None,
+    ) -> None:
+        """Create a batch runner.
+        Maps are fetched on a pool of I/O threads, while images are rendered on a pool
+        of processes. Renders are started only when their estimated memory fits in the limit.
+
+        Args:
+            jobs (list[dict]): Jobs, as returned by loadJobs
+            status_path (str | None, optional): JSON file where the status of each job is saved.
+                Defaults to None.
+            fetch_workers (int, optional): Number of maps fetched concurrently. Defaults to 4.
+            render_workers (int | None, optional): Number of render processes.
+                Defaults to the number of CPUs.
+            memory_limit (int | None, optional): Memory available to concurrent renders, in bytes.
+                Defaults to 75% of the available memory.
+            profile_dir (str | None, optional): Folder where cProfile stats of each stage are saved.
+                Defaults to None (no profiling).
+            layer_cache (str | None, optional): Folder where the rasterized layers of round maps
+                are cached, so that only the changed layers are rasterized again.
+                Defaults to None (no cache).
+            snapshot_dir (str | None, optional): Folder where the normalized maps are saved as
+                snapshots, shared with the render processes and reused by later runs.
+                Defaults to None (maps are sent to the render processes).
+
+        Raises:
+            ValueError: two jobs write to the same files (same output folder and name)
+        """
+        self._jobs = {}
+        for job in jobs:
+            job_id = f"{job['output']}/{job['name']}"
+            if job_id in self._jobs:
+                raise ValueError(
+                    f"Jobs {self._jobs[job_id]['city']} and {job['city']} "
+                    f"have the same output files {job_id}, set a different name"
+                )
+            self._jobs[job_id] = job
+        self._status_path = status_path
+        self._fetch_workers = fetch_workers
+        self._render_workers = render_workers or os.cpu_count() or 1
+        self._memory_limit = memory_limit or int(availableMemory() * 0.75)
+        self._profile_dir = profile_dir
+        self._layer_cache = layer_cache
+        self._snapshot_dir = snapshot_dir
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+        self._status = self._loadStatus()
+
+    def _loadStatus(self) -> dict[str, dict]:
+        """Loads the status of a previous run, if any
+
+        Returns:
+            dict[str, dict]
+        """
+        if self._status_path and os.path.exists(self._status_path):
+            with open(self._status_path, "r") as f:
+                return json.load(f)
+
+        return {}
+
+    def _setStatus(self, job_id: str, status: str, **kwargs) -> None:
+        """Updates the status of a job and saves it to file
+
+        Args:
+            job_id (str)
+            status (str): fetching, rendering, done or failed
+            **kwargs: other fields to be saved (error, timings...)
+        """
+        self._status.setdefault(job_id, {}).update({"status": status, **kwargs})
+        logging.info(f"Job {job_id}: {status}")
+
+        if not self._status_path:
+            return
+
+        tmp = f"{self._status_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._status, f, indent=2)
+        os.replace(tmp, self._status_path)
+
+    def _saveReport(self, job_id: str, reports: dict[str, dict]) -> None:
+        """Saves the instrumentation reports of a job in {output}/{name}-report.json
+
+        Args:
+            job_id (str)
+            reports (dict[str, dict]): Report of each stage
+        """
+        job = self._jobs[job_id]
+        filename = os.path.join(job["output"], f"{job['name']}-report.json")
+        with open(filename, "w") as f:
+            json.dump({"city": job["city"], **reports}, f, indent=2)
+
+    def _missingOutputs(self, job_id: str) -> dict[str, dict[str, str]]:
+        """Returns the outputs of a job that have not been produced yet.
+        Outputs of features found empty by a previous run are not expected.
+
+        Args:
+            job_id (str)
+
+        Returns:
+            dict[str, dict[str, str]]
+        """
+        empty = self._status.get(job_id, {}).get("empty", [])
+        missing = {}
+        for map_type, outputs in expectedOutputs(self._jobs[job_id], empty).items():
+            outputs = {k: v for k, v in outputs.items() if not os.path.exists(v)}
+            if outputs:
+                missing[map_type] = outputs
+
+        return missing
+
+    def run(self) -> dict[str, dict]:
+        """Runs all the jobs. Jobs whose outputs are already there are skipped.
+
+        Returns:
+            dict[str, dict]: status of each job
+        """
+        fetches = {}
+        renders = {}
+        queue = deque()
+        # renders still to be completed by each job, and their time
+        remaining = {}
+        render_time = {}
+        reports = {}
+        reserved = 0
+
+        with ThreadPoolExecutor(self._fetch_workers) as fetch_pool, ProcessPoolExecutor(
+            self._render_workers
+        ) as render_pool:
+            for job_id, job in self._jobs.items():
+                # jobs whose outputs are all there are skipped, whatever their status:
+                # deleted outputs, and outputs added to the job, are produced again
+                missing = self._missingOutputs(job_id)
+                if not missing:
+                    if self._status.get(job_id, {}).get("status") == "done":
+                        logging.info(f"Job {job_id}: already done")
+                    else:
+                        self._setStatus(job_id, "done")
+                    continue
+
+                os.makedirs(job["output"], exist_ok=True)
+                self._setStatus(job_id, "fetching")
+                future = fetch_pool.submit(
+                    fetchJob,
+                    {**job, "maps": list(missing)},
+                    self._profile_dir,
+                    self._snapshot_dir,
+                )
+                fetches[future] = (job_id, missing, perf_counter())
+
+            while fetches or queue or renders:
+                # start the renders that fit in memory, at least one at a time
+                while queue and len(renders) < self._render_workers:
+                    job_id, map_type, data, outputs, memory = queue[0]
+                    if renders and reserved + memory > self._memory_limit:
+                        break
+
+                    queue.popleft()
+                    reserved += memory
+                    job = self._jobs[job_id]
+                    future = render_pool.submit(
+                        renderMap,
+                        map_type,
+                        job["city"],
+                        data,
+                        outputs,
+                        job["name"],
+                        self._profile_dir,
+                        self._layer_cache,
+                        job["density"],
+                        job["encoding"],
+                    )
+                    renders[future] = (job_id, map_type, outputs, memory, perf_counter())
+
+                done, _ = wait(
+                    list(fetches) + list(renders), return_when=FIRST_COMPLETED
+                )
+
+                for future in done:
+                    if future in fetches:
+                        job_id, missing, started = fetches.pop(future)
+                        try:
+                            data, fetch_reports = future.result()
+                        except Exception as e:
+                            logging.exception(f"Job {job_id} failed while fetching")
+                            self._setStatus(job_id, "failed", error=repr(e))
+                            continue
+
+                        self._setStatus(
+                            job_id, "rendering", fetch_time=perf_counter() - started
+                        )
+                        remaining[job_id] = len(missing)
+                        render_time[job_id] = 0
+                        reports[job_id] = {
+                            f"fetch-{k}": v for k, v in fetch_reports.items()
+                        }
+                        for map_type, outputs in missing.items():
+                            memory = estimateRenderMemory(data[map_type], outputs)
+                            queue.append(
+                                (job_id, map_type, data[map_type], outputs, memory)
+                            )
+
+                    else:
+                        job_id, map_type, outputs, memory, started = renders.pop(future)
+                        reserved -= memory
+                        render_time[job_id] += perf_counter() - started
+                        if self._status[job_id]["status"] == "failed":
+                            continue
+
+                        try:
+                            saved, render_report = future.result()
+                        except Exception as e:
+                            logging.exception(f"Job {job_id} failed while rendering")
+                            self._setStatus(job_id, "failed", error=repr(e))
+                            continue
+
+                        # outputs not saved belong to features without elements,
+                        # which are not expected by the next runs
+                        empty = set(self._status[job_id].get("empty", [])) - set(saved)
+                        empty.update(f for f in outputs.values() if f not in saved)
+                        self._status[job_id]["empty"] = sorted(empty)
+
+                        reports[job_id][f"render-{map_type}"] = render_report
+                        remaining[job_id] -= 1
+                        if remaining[job_id] == 0:
+                            self._saveReport(job_id, reports.pop(job_id))
+                            self._setStatus(
+                                job_id, "done", render_time=render_time[job_id]
+                            )
+
+        return self._status
+
+
+def runJobs(jobs: list[dict], **kwargs) -> dict[str, dict]:
+    """Runs a list of jobs, see BatchRunner
+
+    Args:
+        jobs (list[dict]): Jobs, as returned by loadJobs
+        **kwargs: BatchRunner options
+
+    Returns:
+        dict[str, dict]: status of each job
+    """
+    return BatchRunner([normalizeJob(j) for j in jobs], **kwargs).run()
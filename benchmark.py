@@ -0,0 +1,550 @@
+"""
+Benchmarks of the rendering pipeline. No network access is needed.
+
+Usage:
+
+- python benchmark.py circles [--points N] [--radius R]
+- python benchmark.py pipeline [--nodes N] [--ways N] [--vertices N] [--json]
+- python benchmark.py antialias [--supersample N ...] [--downsample S ...] [--width N]
+- python benchmark.py preview [--width N] [--scale S ...] [--final]
+"""
+
+import argparse
+import json
+import logging
+import re
+import resource
+import tempfile
+
+from math import cos, pi, radians
+from time import perf_counter
+
+import numpy as np
+
+from OSMPythonTools.nominatim import NominatimResults
+from OSMPythonTools.overpass import OverpassResult
+from PIL import Image
+
+from citymap import RoundCityMap, parseSelector
+from cityimage import CityImage
+from osmcache import OSMCache
+
+# tags of the synthetic elements, with their frequency
+SYNTHETIC_NODE_TAGS = [("natural", "tree")]
+SYNTHETIC_WAY_TAGS = [
+    (("building", "yes"), 0.8),
+    (("leisure", "park"), 0.1),
+    (("natural", "water"), 0.1),
+]
+
+
+def timeIt(function, repeat: int = 3) -> float:
+    """Returns the best time out of multiple runs of a function
+
+    Args:
+        function (callable): Function to be timed
+        repeat (int, optional): Number of runs. Defaults to 3.
+
+    Returns:
+        float: best time, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = perf_counter()
+        function()
+        best = min(best, perf_counter() - started)
+
+    return best
+
+
+def benchmarkCircles(points: int, radius: float, repeat: int = 3) -> dict:
+    """Compares the point renderers of CityImage. Only the rasterization is timed.
+
+    Args:
+        points (int): Number of circles
+        radius (float): Circles radius, in supersampled pixels
+        repeat (int, optional): Number of runs. Defaults to 3.
+
+    Returns:
+        dict: time of each renderer and whether they produce the same image
+    """
+    rng = np.random.default_rng(0)
+    coords = rng.random((points, 2))
+
+    results = {}
+    images = {}
+    for renderer in ["ellipse", "sprite", "auto"]:
+        image = CityImage(point_renderer=renderer)
+        image.drawMultipleCircles(coords, radius, (16, 16, 16))
+
+        margin = image._margin()
+        indexes = [image._tileIndex(o["bbox"], margin) for o in image._operations]
+        fills = [o["fill"] for o in image._operations]
+        tiles = image._tiles(margin)
+
+        def rasterize():
+            for tile, (_, render_box) in enumerate(tiles):
+                size = (render_box[2] - render_box[0], render_box[3] - render_box[1])
+                tile_img = Image.new("RGB", size)
+                image._drawTile(tile_img, render_box, tile, indexes, fills)
+
+        results[renderer] = timeIt(rasterize, repeat)
+        images[renderer] = np.asarray(image.render())
+
+    results["identical"] = all(
+        (images["ellipse"] == images[r]).all() for r in ["sprite", "auto"]
+    )
+    return results
+
+
+def syntheticCity(
+    nodes: int,
+    ways: int,
+    vertices: int,
+    center: tuple[float, float] = (45.4642, 9.19),
+    radius: float = 3500,
+    seed: int = 0,
+) -> dict:
+    """Generates a synthetic Overpass response, scattered in a circle around a center.
+    Ways are closed rings shaped like jagged polygons.
+
+    Args:
+        nodes (int): Number of nodes (trees)
+        ways (int): Number of ways (buildings, parks and water)
+        vertices (int): Number of vertices of each way
+        center (tuple[float, float], optional): Center (lat, lon). Defaults to Milan.
+        radius (float, optional): Radius of the circle, in meters. Defaults to 3500.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Overpass JSON response
+    """
+    rng = np.random.default_rng(seed)
+    km_lat, km_lon = 110.574235, 110.572833 * cos(radians(center[0]))
+    d_lat, d_lon = radius / 1000 / km_lat, radius / 1000 / km_lon
+
+    def scatter(count: int) -> tuple[np.ndarray, np.ndarray]:
+        r = np.sqrt(rng.random(count))
+        theta = rng.random(count) * 2 * pi
+        return (
+            center[0] + r * np.sin(theta) * d_lat,
+            center[1] + r * np.cos(theta) * d_lon,
+        )
+
+    elements = []
+    lat, lon = scatter(nodes)
+    for i, (node_lat, node_lon) in enumerate(zip(lat.tolist(), lon.tolist())):
+        key, value = SYNTHETIC_NODE_TAGS[i % len(SYNTHETIC_NODE_TAGS)]
+        elements.append(
+            {
+                "type": "node",
+                "id": i,
+                "lat": node_lat,
+                "lon": node_lon,
+                "tags": {key: value},
+            }
+        )
+
+    tags, weights = zip(*SYNTHETIC_WAY_TAGS)
+    way_tags = rng.choice(len(tags), size=ways, p=weights)
+    lat, lon = scatter(ways)
+    # rings of about 15 meters, with jagged vertices
+    theta = np.linspace(0, 2 * pi, vertices, endpoint=False)
+    for i in range(ways):
+        size = 15 / 1000 * (0.5 + rng.random(vertices))
+        ring_lat = lat[i] + size / km_lat * np.sin(theta)
+        ring_lon = lon[i] + size / km_lon * np.cos(theta)
+        geometry = [
+            {"lat": a, "lon": b} for a, b in zip(ring_lat.tolist(), ring_lon.tolist())
+        ]
+        geometry.append(dict(geometry[0]))
+
+        key, value = tags[way_tags[i]]
+        elements.append(
+            {
+                "type": "way",
+                "id": nodes + i,
+                "nodes": list(range(vertices + 1)),
+                "geometry": geometry,
+                "tags": {key: value},
+            }
+        )
+
+    return {"version": 0.6, "elements": elements}
+
+
+class FakeNominatim:
+    def __init__(self, center: tuple[float, float] = (45.4642, 9.19)) -> None:
+        """Offline Nominatim backend, always returning the same city
+
+        Args:
+            center (tuple[float, float], optional): City center. Defaults to Milan.
+        """
+        self._center = center
+
+    def query(self, city: str, **_) -> NominatimResults:
+        lat, lon = self._center
+        json = [
+            {
+                "osm_type": "relation",
+                "osm_id": 1,
+                "lat": str(lat),
+                "lon": str(lon),
+                "boundingbox": [str(lat - 0.1), str(lat + 0.1), str(lon - 0.1), str(lon + 0.1)],
+            }
+        ]
+        return NominatimResults(json, "search", {"q": city})
+
+
+class FakeOverpass:
+    # Overpass element types returned by each statement of a union query
+    _statement_types = {"node": "node", "way": "way", "area": "way"}
+
+    def __init__(self, response: dict, limit: int | None = None) -> None:
+        """Offline Overpass backend, answering union queries with the elements of a
+        response matched by any of their statements: element type, tag selector and
+        bounding box. Ways are inside a bounding box if any of their vertices is.
+
+        Args:
+            response (dict): Overpass JSON response, e.g. from syntheticCity
+            limit (int | None, optional): Downloads of more elements time out, answered
+                with no elements and a remark like the real server. Counts always succeed.
+                Defaults to None (no limit).
+        """
+        self._response = response
+        self._limit = limit
+
+    def query(self, query: str, **_) -> OverpassResult:
+        statements = []
+        for topology, selector, bbox in re.findall(
+            r"(node|way|area)\[([^\]]+)\]\(([^()]+)\);", query
+        ):
+            key, value = parseSelector(selector)
+            south, west, north, east = (float(x) for x in bbox.split(","))
+            statements.append(
+                (self._statement_types[topology], key, value, south, west, north, east)
+            )
+
+        def matches(e: dict, statement: tuple) -> bool:
+            element_type, key, value, south, west, north, east = statement
+            tags = e.get("tags", {})
+            if e["type"] != element_type or key not in tags:
+                return False
+            if value is not None and tags[key] != value:
+                return False
+
+            points = e["geometry"] if e["type"] == "way" else [e]
+            return any(
+                south <= p["lat"] <= north and west <= p["lon"] <= east for p in points
+            )
+
+        elements = [
+            e
+            for e in self._response["elements"]
+            if any(matches(e, s) for s in statements)
+        ]
+
+        if "out count;" in query:
+            count = {"type": "count", "id": 0, "tags": {"total": str(len(elements))}}
+            return OverpassResult({"elements": [count]}, query, {})
+
+        if self._limit is not None and len(elements) > self._limit:
+            remark = 'runtime error: Query timed out in "query" at line 1 after 25 seconds.'
+            return OverpassResult({**self._response, "elements": [], "remark": remark}, query, {})
+
+        return OverpassResult({**self._response, "elements": elements}, query, {})
+
+
+def peakMemory() -> float:
+    """Returns the peak resident memory of the process, in MB
+
+    Returns:
+        float
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmarkPipeline(
+    nodes: int, ways: int, vertices: int, width: int = 2000, supersample: int = 8
+) -> dict:
+    """Runs a synthetic city through the whole pipeline, timing each stage
+
+    Args:
+        nodes (int): Number of nodes
+        ways (int): Number of ways
+        vertices (int): Number of vertices of each way
+        width (int, optional): Image size. Defaults to 2000.
+        supersample (int, optional): Image supersampling. Defaults to 8.
+
+    Returns:
+        dict: time, throughput and memory of each stage
+    """
+    report = {"nodes": nodes, "ways": ways, "vertices": nodes + ways * (vertices + 1)}
+    stages = {}
+
+    started = perf_counter()
+    response = syntheticCity(nodes, ways, vertices)
+    stages["generate"] = {"time": perf_counter() - started}
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        r = RoundCityMap(
+            "Synthetic city",
+            cache=OSMCache(cache_path),
+            nominatim=FakeNominatim(),
+            overpass=FakeOverpass(response),
+        )
+
+        started = perf_counter()
+        r.loadCity()
+        for features in r._planQueries():
+            r._queryOSM(features)
+        stages["fetch"] = {"time": perf_counter() - started}
+
+    # position filter on all the vertices at once
+    points = [
+        p
+        for e in response["elements"]
+        for p in (e["geometry"] if e["type"] == "way" else [e])
+    ]
+    lat = np.array([p["lat"] for p in points])
+    lon = np.array([p["lon"] for p in points])
+    started = perf_counter()
+    r._isPositionValid(lat, lon)
+    elapsed = perf_counter() - started
+    stages["filter"] = {"time": elapsed, "vertices/s": len(lat) / elapsed}
+
+    started = perf_counter()
+    for feature in r._features_list:
+        r._normalizeElements(**feature)
+    elapsed = perf_counter() - started
+    stages["normalize"] = {"time": elapsed, "vertices/s": report["vertices"] / elapsed}
+
+    image = CityImage(width=width, height=width, supersample=supersample)
+    started = perf_counter()
+    image.drawTrees(r.trees)
+    image.drawWater(r.water)
+    image.drawParks(r.parks)
+    image.drawBuildings(r.buildings)
+    image.drawTitle("Synthetic city")
+    stages["draw"] = {"time": perf_counter() - started}
+
+    started = perf_counter()
+    out_img = image.render()
+    elapsed = perf_counter() - started
+    stages["render"] = {"time": elapsed, "pixels/s": width * width / elapsed}
+
+    with tempfile.TemporaryDirectory() as output_path:
+        started = perf_counter()
+        out_img.save(f"{output_path}/synthetic.png", "PNG")
+        stages["save"] = {"time": perf_counter() - started}
+
+    report["stages"] = stages
+    report["peak_memory_mb"] = peakMemory()
+    return report
+
+
+def syntheticMap(nodes: int, ways: int, vertices: int) -> RoundCityMap:
+    """Loads a synthetic city into a round map, without network access
+
+    Args:
+        nodes (int): Number of nodes
+        ways (int): Number of ways
+        vertices (int): Number of vertices of each way
+
+    Returns:
+        RoundCityMap
+    """
+    with tempfile.TemporaryDirectory() as cache_path:
+        r = RoundCityMap(
+            "Synthetic city",
+            cache=OSMCache(cache_path),
+            nominatim=FakeNominatim(),
+            overpass=FakeOverpass(syntheticCity(nodes, ways, vertices)),
+        )
+        r.loadCity()
+        r.loadFeatures()
+
+    return r
+
+
+def benchmarkAntialias(
+    supersamples: list[int],
+    strategies: list[str],
+    width: int = 2000,
+    nodes: int = 50_000,
+    ways: int = 50_000,
+) -> list[dict]:
+    """Compares supersampling factors and downsampling strategies of CityImage.
+    Quality is measured against the default rendering (8x, Lanczos).
+
+    Args:
+        supersamples (list[int]): Supersampling factors
+        strategies (list[str]): Downsampling strategies
+        width (int, optional): Image size. Defaults to 2000.
+        nodes (int, optional): Number of nodes of the synthetic city. Defaults to 50_000.
+        ways (int, optional): Number of ways of the synthetic city. Defaults to 50_000.
+
+    Returns:
+        list[dict]: render time, mean absolute error and PSNR of each combination
+    """
+    r = syntheticMap(nodes, ways, 8)
+
+    def render(supersample: int, downsample: str) -> tuple[np.ndarray, float]:
+        image = CityImage(
+            width=width, height=width, supersample=supersample, downsample=downsample
+        )
+        image.drawTrees(r.trees)
+        image.drawWater(r.water)
+        image.drawParks(r.parks)
+        image.drawBuildings(r.buildings)
+        image.drawTitle("Synthetic city")
+
+        started = perf_counter()
+        out_img = image.render()
+        return np.asarray(out_img, dtype=float), perf_counter() - started
+
+    reference, _ = render(8, "lanczos")
+    results = []
+    for supersample in supersamples:
+        for downsample in strategies:
+            out_img, elapsed = render(supersample, downsample)
+            mse = ((out_img - reference) ** 2).mean()
+            results.append(
+                {
+                    "supersample": supersample,
+                    "downsample": downsample,
+                    "time": elapsed,
+                    "mae": np.abs(out_img - reference).mean(),
+                    "psnr": 10 * np.log10(255**2 / mse) if mse else float("inf"),
+                }
+            )
+
+    return results
+
+
+def benchmarkPreview(
+    width: int, scales: list[float], final: bool = False, nodes: int = 100_000, ways: int = 50_000
+) -> list[dict]:
+    """Measures the time of each step of a progressive rendering
+
+    Args:
+        width (int): Size of the final image
+        scales (list[float]): Scale of each draft
+        final (bool, optional): Also render the final image. Defaults to False.
+        nodes (int, optional): Number of nodes of the synthetic city. Defaults to 100_000.
+        ways (int, optional): Number of ways of the synthetic city. Defaults to 50_000.
+
+    Returns:
+        list[dict]: scale, size, draw time and render time of each step
+    """
+    r = syntheticMap(nodes, ways, 8)
+    timings = []
+
+    def draw(image: CityImage) -> None:
+        started = perf_counter()
+        image.drawTrees(r.trees)
+        image.drawWater(r.water)
+        image.drawParks(r.parks)
+        image.drawBuildings(r.buildings)
+        image.drawTitle("Synthetic city")
+        timings.append(perf_counter() - started)
+
+    results = []
+    steps = CityImage.progressive(draw, scales=scales, width=width, height=width)
+    for scale in scales + [None] * final:
+        started = perf_counter()
+        out_img = next(steps)
+        elapsed = perf_counter() - started
+        results.append(
+            {
+                "scale": scale or 1,
+                "size": out_img.size[0],
+                "draw": timings[-1],
+                "render": elapsed - timings[-1],
+            }
+        )
+
+    return results
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s: %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(description="Rendering benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    circles = subparsers.add_parser("circles", help="point renderers")
+    circles.add_argument("--points", type=int, default=100_000)
+    circles.add_argument("--radius", type=float, default=2)
+    circles.add_argument("--repeat", type=int, default=3)
+
+    pipeline = subparsers.add_parser("pipeline", help="synthetic city")
+    pipeline.add_argument("--nodes", type=int, default=100_000)
+    pipeline.add_argument("--ways", type=int, default=50_000)
+    pipeline.add_argument("--vertices", type=int, default=8)
+    pipeline.add_argument("--width", type=int, default=2000)
+    pipeline.add_argument("--supersample", type=int, default=8)
+    pipeline.add_argument("--json", action="store_true", help="print a JSON report")
+
+    antialias = subparsers.add_parser("antialias", help="supersampling and downsampling")
+    antialias.add_argument("--supersample", type=int, nargs="+", default=[8, 4, 2, 1])
+    antialias.add_argument(
+        "--downsample", nargs="+", default=["lanczos", "staged", "box", "reduce"]
+    )
+    antialias.add_argument("--width", type=int, default=2000)
+
+    preview = subparsers.add_parser("preview", help="progressive rendering")
+    preview.add_argument("--width", type=int, default=16000)
+    preview.add_argument("--scale", type=float, nargs="+", default=[0.125, 0.5])
+    preview.add_argument("--final", action="store_true", help="also render the final image")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "circles":
+        results = benchmarkCircles(args.points, args.radius, args.repeat)
+        logging.info(
+            f"{args.points} circles of radius {args.radius}: "
+            f"ellipse {results['ellipse']:.3f}s, sprite {results['sprite']:.3f}s, "
+            f"auto {results['auto']:.3f}s, "
+            f"identical output: {results['identical']}"
+        )
+
+    elif args.benchmark == "pipeline":
+        report = benchmarkPipeline(
+            args.nodes, args.ways, args.vertices, args.width, args.supersample
+        )
+        if args.json:
+            print(json.dumps(report, indent=2))
+            return
+
+        for stage, stats in report["stages"].items():
+            throughput = ", ".join(
+                f"{v:.0f} {k}" for k, v in stats.items() if k != "time"
+            )
+            logging.info(
+                f"{stage}: {stats['time']:.3f}s" + (f" ({throughput})" if throughput else "")
+            )
+        logging.info(f"peak memory: {report['peak_memory_mb']:.0f} MB")
+
+    elif args.benchmark == "antialias":
+        results = benchmarkAntialias(args.supersample, args.downsample, args.width)
+        for r in results:
+            logging.info(
+                f"{r['supersample']}x {r['downsample']}: {r['time']:.3f}s, "
+                f"mean error {r['mae']:.2f}, PSNR {r['psnr']:.1f} dB"
+            )
+
+    elif args.benchmark == "preview":
+        results = benchmarkPreview(args.width, args.scale, args.final)
+        for r in results:
+            logging.info(
+                f"scale {r['scale']} ({r['size']}px): draw {r['draw']:.3f}s, "
+                f"render {r['render']:.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,313 @@
+import hashlib
+import os
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from re import L
-from PIL import Image, ImageDraw, ImageFont
+from time import perf_counter
+from typing import Callable, Iterator
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+import numpy as np
+
+from geometry import Geometry
+from instrumentation import Instrumentation
+from osmcache import ImageCache
+
+# pixels covered by each circle sprite, shared by all the images
+_sprites = {}
+
+# bundled fonts, found next to this file whatever the working directory
+FONTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+FONT_VARIANTS = [
+    "Light",
+    "LightItalic",
+    "Regular",
+    "Italic",
+    "Bold",
+    "BoldItalic",
+    "Black",
+    "BlackItalic",
+]
+
+# scale of each draft rendered before the final image
+DRAFT_SCALES = [0.125, 0.5]
+
+# coverage masks are stored as 16 bit images, keeping the negative lobes of the
+# resampling filter: coverage c in [0, 255] is stored as c * scale + zero
+_MASK_SCALE = 64
+_MASK_ZERO = 16384
+
+# extension of each output format
+ENCODING_FORMATS = {"png": ".png", "webp": ".webp"}
+
+
+@lru_cache(maxsize=None)
+def loadFont(variant: str = "Light", size: int = 10) -> ImageFont.FreeTypeFont:
+    """Loads a bundled Chivo font. Each variant and size is loaded once per process.
+
+    Args:
+        variant (str, optional): One of FONT_VARIANTS. Defaults to "Light".
+        size (int, optional): Font size, in pixels. Defaults to 10.
+
+    Raises:
+        ValueError: unknown variant
+
+    Returns:
+        ImageFont.FreeTypeFont
+    """
+    if variant not in FONT_VARIANTS:
+        raise ValueError(f"Unknown font variant {variant}")
+
+    return ImageFont.truetype(os.path.join(FONTS_PATH, f"Chivo-{variant}.ttf"), size)
+
+
+def encodingOptions(encoding: dict | None = None) -> dict:
+    """Fills the missing encoding options and validates them. Options are:
+
+    - format (str, optional): "png" or "webp". Defaults to "png".
+    - compress_level (int, optional): PNG compression level, from 0 (fastest)
+      to 9 (smallest). Defaults to 6.
+    - colors (int | None, optional): Quantize the image to a palette of this many colors,
+      which shrinks images made of a few flat colors. Defaults to None (full RGB).
+    - lossless (bool, optional): Lossless WebP. Defaults to False.
+    - quality (int, optional): WebP quality, or compression effort if lossless.
+      Defaults to 90.
+    - sizes (list[int], optional): Widths of downscaled copies saved next to the image,
+      as {name}-{width}.{extension}. Defaults to none.
+
+    Args:
+        encoding (dict | None, optional): Encoding options. Defaults to None.
+
+    Raises:
+        ValueError: unknown option or format, invalid number of colors
+
+    Returns:
+        dict
+    """
+    options = {
+        "format": "png",
+        "compress_level": 6,
+        "colors": None,
+        "lossless": False,
+        "quality": 90,
+        "sizes": [],
+        **(encoding or {}),
+    }
+
+    if unknown := set(options) - {
+        "format",
+        "compress_level",
+        "colors",
+        "lossless",
+        "quality",
+        "sizes",
+    }:
+        raise ValueError(f"Unknown encoding options {sorted(unknown)}")
+    if options["format"] not in ENCODING_FORMATS:
+        raise ValueError(f"Unknown encoding format {options['format']}")
+    if options["colors"] is not None and not 2 <= options["colors"] <= 256:
+        raise ValueError(f"Palettes have from 2 to 256 colors, not {options['colors']}")
+
+    return options
+
+
+def encodedFilenames(filename: str, encoding: dict | None = None) -> list[str]:
+    """Returns the files written when encoding an image: the image itself,
+    then its downscaled copies
+
+    Args:
+        filename (str): Filename. Extension gets automatically added.
+        encoding (dict | None, optional): Encoding options, see encodingOptions.
+            Defaults to None.
+
+    Returns:
+        list[str]
+    """
+    options = encodingOptions(encoding)
+    extension = ENCODING_FORMATS[options["format"]]
+    if filename.endswith(extension):
+        filename = filename[: -len(extension)]
+
+    return [f"{filename}{extension}"] + [
+        f"{filename}-{width}{extension}" for width in options["sizes"]
+    ]
+
+
+def encodeImage(
+    out_img: Image.Image, filename: str, encoding: dict | None = None
+) -> list[str]:
+    """Encodes an image, and its downscaled copies
+
+    Args:
+        out_img (Image.Image): Output image
+        filename (str): Filename. Extension gets automatically added.
+        encoding (dict | None, optional): Encoding options, see encodingOptions.
+            Defaults to None.
+
+    Returns:
+        list[str]: Written files
+    """
+    options = encodingOptions(encoding)
+    filenames = encodedFilenames(filename, options)
+
+    for filename, width in zip(filenames, [None, *options["sizes"]]):
+        img = out_img
+        if width is not None:
+            height = max(1, round(out_img.height * width / out_img.width))
+            img = out_img.resize(
+                (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+            )
+
+        if options["colors"]:
+            # no dithering: the noise would cost more than the palette saves
+            img = img.quantize(
+                options["colors"],
+                method=Image.Quantize.FASTOCTREE,
+                dither=Image.Dither.NONE,
+            )
+
+        if options["format"] == "png":
+            img.save(filename, "PNG", compress_level=options["compress_level"])
+        else:
+            if img.mode == "P":
+                img = img.convert("RGB")
+            img.save(
+                filename,
+                "WEBP",
+                lossless=options["lossless"],
+                quality=options["quality"],
+            )
+
+    return filenames
+
+
+class ImageEncoder:
+    def __init__(self, workers: int = 1) -> None:
+        """Create a background encoder. Images are compressed and written by a pool of
+        threads (the codecs release the GIL), so that the next image can be rendered
+        in the meantime.
+
+        Args:
+            workers (int, optional): Number of images encoded concurrently. Defaults to 1.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = []
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Schedules an encoding task
+
+        Args:
+            function (Callable): Task
+            *args: Task arguments
+
+        Returns:
+            Future
+        """
+        future = self._executor.submit(function, *args)
+        self._pending.append(future)
+        return future
+
+    def wait(self) -> list:
+        """Waits for all the scheduled tasks
+
+        Raises:
+            Exception: the first error raised by a task
+
+        Returns:
+            list: Result of each task, in order
+        """
+        pending, self._pending = self._pending, []
+        return [f.result() for f in pending]
+
+    def close(self) -> None:
+        """Waits for all the scheduled tasks, then stops the workers"""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self) -> "ImageEncoder":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
 
 class CityImage:
+    # fill color of each layer
+    _layer_colors = {
+        "trees": (16, 16, 16),
+        "water": (24, 24, 24),
+        "parks": (200, 200, 200),
+        "buildings": (16, 16, 16),
+    }
+
     def __init__(
         self,
         width: int = 2000,
         height: int = 2000,
         background_color: tuple[float, float, float] | str = (240, 240, 240),
         scl: float = 0.8,
-        supersample: float = 8,
+        supersample: int = 8,
+        tile_size: int | None = 256,
+        point_renderer: str = "auto",
+        downsample: str = "lanczos",
+        simplify: float | None = None,
+        draft: float | None = None,
+        layer_cache: ImageCache | None = None,
+        encoding: dict | None = None,
+        encoder: ImageEncoder | None = None,
+        instrumentation: Instrumentation | None = None,
     ):
+        """Create a city image.
+        Drawing calls are recorded and rasterized only when the image is rendered,
+        one supersampled tile at a time.
+
+        Args:
+            width (int, optional): Output width. Defaults to 2000.
+            height (int, optional): Output height. Defaults to 2000.
+            background_color (tuple[float, float, float] | str, optional): Background color.
+                Defaults to (240, 240, 240).
+            scl (float, optional): Scale of the map relative to the image. Defaults to 0.8.
+            supersample (int, optional): Supersampling factor. Defaults to 8.
+            tile_size (int | None, optional): Size of the rendered tiles, in output pixels.
+                None renders the whole supersampled canvas at once. Defaults to 256.
+            point_renderer (str, optional): How circles are rasterized: "sprite" stamps a
+                precomputed disc on all the centers at once, "ellipse" draws them one by one,
+                "auto" picks the fastest one for each tile. Defaults to "auto".
+            downsample (str, optional): How the supersampled canvas is reduced to the output size:
+                "lanczos" gives the sharpest result, "staged" averages the canvas down to twice
+                the output size before applying Lanczos, "box" averages the pixels with a box
+                filter and "reduce" averages whole blocks of pixels, which is the fastest.
+                Defaults to "lanczos".
+            simplify (float | None, optional): Tolerance of the polygon simplification,
+                in output pixels. Polygons smaller than the tolerance are skipped, the others
+                are simplified with Douglas-Peucker. Circles closer than the tolerance are
+                drawn only once. A quarter of a pixel is not noticeable.
+                Defaults to None (no simplification).
+            draft (float | None, optional): Renders a quick draft, scaled by this factor:
+                no supersampling, block downsampling and geometry simplified to one output
+                pixel. Defaults to None (full quality).
+            layer_cache (ImageCache | None, optional): Cache of the rasterized layers. If provided,
+                each layer is rasterized on its own into a coverage mask, and images are composed
+                by painting the masks with the layer colors: only the layers whose geometry
+                changed get rasterized again. Edges shared by two layers are blended slightly
+                differently than in a full rendering. Defaults to None (no cache).
+            encoding (dict | None, optional): Format, compression and sizes of the saved
+                images, see encodingOptions. Defaults to None (full RGB PNG).
+            encoder (ImageEncoder | None, optional): Encodes the saved images in the
+                background: save methods return as soon as the image is rendered, wait on
+                the encoder before using the files. Defaults to None (images are encoded
+                before save methods return).
+            instrumentation (Instrumentation | None, optional): Collects draw, resize and encode
+                timers. Defaults to a new instance.
+        """
+        if draft:
+            width, height = max(1, int(width * draft)), max(1, int(height * draft))
+            supersample = 1
+            downsample = "reduce"
+            simplify = max(simplify or 0, 1)
 
         self._supersample = supersample
         self._sizes = (width * self._supersample, height * self._supersample)
@@ -23,8 +320,34 @@ class CityImage:
             self._sizes[x] * (1 - self._scl) * self._border_rations[x] for x in range(2)
         )
 
-        self._image = Image.new("RGB", self._sizes, background_color)
-        self._draw = ImageDraw.Draw(self._image)
+        self._background_color = background_color
+        self._tile_size = tile_size
+        if downsample not in ["lanczos", "staged", "box", "reduce"]:
+            raise ValueError(f"Unknown downsample strategy {downsample}")
+
+        self._downsample = downsample
+        self._resample = (
+            Image.Resampling.BOX if downsample == "box" else Image.Resampling.LANCZOS
+        )
+        self._point_renderer = point_renderer
+        self._simplify = simplify
+        self._layer_cache = layer_cache
+        self._encoding = encodingOptions(encoding)
+        self._encoder = encoder
+        # recorded drawing operations, in order
+        self._operations = []
+        self._instrumentation = (
+            instrumentation if instrumentation is not None else Instrumentation()
+        )
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        """Returns the instrumentation of the image
+
+        Returns:
+            Instrumentation
+        """
+        return self._instrumentation
 
     def drawCircle(
         self,
@@ -32,84 +355,329 @@ class CityImage:
         radius: float = 1,
         fill: tuple[int, int, int] | str = "black",
     ) -> None:
-        """Draws a circle according to its relative position (in range [0-1] for both x and y)
+        """Draws a circle according to its absolute position
 
         Args:
             coords (tuple[int, int]): circle center coordinates
             radius (float, optional): Circle radius. Defaults to 1.
             fill (tuple[int, int,  int] | str, optional): Fill color. Defaults to "black".
         """
-        # arc bounding box
-        xy = (
-            coords[0] - radius,
-            coords[1] - radius,
-            coords[0] + radius,
-            coords[1] + radius,
-        )
-
-        self._draw.ellipse(xy, fill=fill)
+        self._addCircles(np.array([coords], dtype=float), radius, fill)
 
     def drawMultipleCircles(
         self,
-        coords: list[tuple[int, int]],
+        coords: Geometry | list[tuple[float, float]],
         radius: float = 1,
         fill: tuple[int, int, int] | str = "black",
+        layer: str | None = None,
     ) -> None:
         """Draws multiple circles from a list of relative positions (in range [0-1] for both x and y)
 
         Args:
-            coords (tuple[int, int]): circle center coordinates
+            coords (Geometry | list[tuple[float, float]]): circle center coordinates
             radius (float, optional): Circle radius. Defaults to 1.
             fill (tuple[int, int,  int] | str, optional): Fill color. Defaults to "black".
+            layer (str | None, optional): Layer name, used to pick the color from a theme palette.
+                Defaults to None.
+        """
+        if isinstance(coords, Geometry):
+            coords = coords.coords
+
+        abs_coords = self._relativeToAbsolute(np.asarray(coords, dtype=float))
+
+        if self._simplify and len(abs_coords):
+            # only the first circle of each cell of the tolerance grid is kept
+            tolerance = self._simplify * self._supersample
+            cells = np.floor(abs_coords / tolerance).astype(np.int64)
+            cells -= cells.min(axis=0)
+            keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+            _, first = np.unique(keys, return_index=True)
+            self._instrumentation.count("simplify.points", len(abs_coords))
+            abs_coords = abs_coords[np.sort(first)]
+            self._instrumentation.count("simplify.kept_points", len(abs_coords))
+
+        self._addCircles(abs_coords, radius, fill, layer)
+
+    def drawDensity(
+        self,
+        coords: Geometry | list[tuple[float, float]],
+        fill: tuple[int, int, int] | str = "black",
+        ramp: list[tuple[int, int, int] | str] | None = None,
+        cell_size: float = 10,
+        shape: str = "hex",
+        levels: int = 8,
+        layer: str | None = None,
+    ) -> None:
+        """Draws the density of a set of points, from a list of relative positions
+        (in range [0-1] for both x and y). Points are binned in a lattice of cells at once,
+        then each non empty cell is drawn with the color of the ramp matching its count,
+        on a logarithmic scale. The cost depends on the number of cells, not of points.
+
+        Args:
+            coords (Geometry | list[tuple[float, float]]): points coordinates
+            fill (tuple[int, int, int] | str, optional): Color of the densest cells, used if no
+                ramp is provided. Defaults to "black".
+            ramp (list[tuple[int, int, int] | str] | None, optional): Colors from the sparsest
+                to the densest cells. Defaults to the fill, faded into the background.
+            cell_size (float, optional): Distance between the centers of adjacent cells,
+                in output pixels. Defaults to 10.
+            shape (str, optional): "hex" for a lattice of hexagons, "grid" for a square grid.
+                Defaults to "hex".
+            levels (int, optional): Number of colors taken from the ramp. Defaults to 8.
+            layer (str | None, optional): Layer name. Defaults to None.
+
+        Raises:
+            ValueError: unknown shape
+        """
+        if shape not in ["hex", "grid"]:
+            raise ValueError(f"Unknown cell shape {shape}")
+
+        if isinstance(coords, Geometry):
+            coords = coords.coords
+
+        abs_coords = self._relativeToAbsolute(
+            np.asarray(coords, dtype=float).reshape(-1, 2)
+        )
+        if not len(abs_coords):
+            return
+
+        size = cell_size * self._supersample
+        if shape == "hex":
+            cells = self._hexCells(abs_coords, size)
+            radius = size / np.sqrt(3)
+            centers = np.column_stack(
+                (
+                    size * (cells[:, 0] + cells[:, 1] / 2),
+                    radius * 1.5 * cells[:, 1],
+                )
+            )
+            # pointy topped hexagons
+            angles = np.radians(np.arange(6) * 60 - 30)
+            corners = radius * np.column_stack((np.cos(angles), np.sin(angles)))
+        else:
+            cells = np.floor(abs_coords / size).astype(np.int64)
+            centers = (cells + 0.5) * size
+            corners = size * np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+
+        # cells are counted through a linear index
+        origin = cells.min(axis=0)
+        span = cells.max(axis=0) - origin + 1
+        index = (cells[:, 0] - origin[0]) * span[1] + cells[:, 1] - origin[1]
+        index, first, counts = np.unique(index, return_index=True, return_counts=True)
+        centers = centers[first]
+        self._instrumentation.count("density.points", len(abs_coords))
+        self._instrumentation.count("density.cells", len(counts))
+
+        if ramp is None:
+            ramp = [self._blend(self._background_color, fill, 0.2), fill]
+
+        colors = np.array(
+            [ImageColor.getrgb(c)[:3] if isinstance(c, str) else c[:3] for c in ramp],
+            dtype=float,
+        )
+        positions = np.linspace(0, 1, len(colors))
+        level = np.log1p(counts) / np.log1p(counts.max()) * (levels - 1)
+        level = np.rint(level).astype(int)
+
+        for value in range(levels):
+            selected = centers[level == value]
+            if not len(selected):
+                continue
+
+            t = value / max(levels - 1, 1)
+            color = tuple(
+                int(round(np.interp(t, positions, colors[:, c]))) for c in range(3)
+            )
+            polygons = (selected[:, None, :] + corners[None, :, :]).reshape(-1, 2)
+            offsets = np.arange(0, len(polygons) + 1, len(corners))
+            self._addPolygons(polygons, offsets, color, layer)
+
+    def _hexCells(self, abs_coords: np.ndarray, size: float) -> np.ndarray:
+        """Returns the hexagon containing each point, in axial coordinates
+
+        Args:
+            abs_coords (np.ndarray): Nx2 array of absolute coordinates
+            size (float): Distance between the centers of adjacent hexagons
+
+        Returns:
+            np.ndarray: Nx2 array of (q, r) coordinates
         """
+        radius = size / np.sqrt(3)
+        x, y = abs_coords[:, 0], abs_coords[:, 1]
+        q = (np.sqrt(3) / 3 * x - y / 3) / radius
+        r = 2 / 3 * y / radius
+        s = -q - r
+
+        # the rounded cube coordinates must add up to zero:
+        # the one with the largest rounding error is fixed
+        rq, rr, rs = np.rint(q), np.rint(r), np.rint(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq[fix_q] = -rr[fix_q] - rs[fix_q]
+        rr[fix_r] = -rq[fix_r] - rs[fix_r]
 
-        for c in coords:
-            abs_coords = self._relativeToAbsolute(c)
-            self.drawCircle(abs_coords, radius, fill)
+        return np.column_stack((rq, rr)).astype(np.int64)
+
+    def _blend(
+        self,
+        color: tuple[int, int, int] | str,
+        other: tuple[int, int, int] | str,
+        amount: float,
+    ) -> tuple[int, int, int]:
+        """Blends two colors
+
+        Args:
+            color (tuple[int, int, int] | str)
+            other (tuple[int, int, int] | str)
+            amount (float): Amount of the second color, in range [0, 1]
+
+        Returns:
+            tuple[int, int, int]
+        """
+        a, b = (ImageColor.getrgb(c) if isinstance(c, str) else c for c in (color, other))
+        return tuple(int(round(a[x] + (b[x] - a[x]) * amount)) for x in range(3))
 
     def drawPoly(
         self,
-        coords: list[tuple[int, int]],
+        coords: list[tuple[int, int]] | list[float],
         fill: tuple[int, int, int] | str = "black",
     ) -> None:
-        """Draws a polygon according to its relative position (in range [0-1] for both x and y)
+        """Draws a polygon according to its absolute position
 
         Args:
-            coords (list[tuple[int, int]]): list of relative coordinates
+            coords (list[tuple[int, int]] | list[float]): list of coordinates, as pairs or flattened
             fill (tuple[int, int,  int] | str, optional): Fill color. Defaults to "black".
         """
-        self._draw.polygon(coords, width=0, fill=fill)
+        abs_coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self._addPolygons(abs_coords, np.array([0, len(abs_coords)]), fill)
 
     def drawMultiplePoly(
         self,
-        coords: list[tuple[int, int]],
+        coords: Geometry | list[list[tuple[float, float]]],
         fill: tuple[int, int, int] | str = "black",
+        layer: str | None = None,
     ) -> None:
         """Draws multiple polygon from list of relative positions (in range [0-1] for both x and y)
 
         Args:
-            coords (list[tuple[int, int]]): list of relative coordinates
+            coords (Geometry | list[list[tuple[float, float]]]): rings of relative coordinates
             fill (tuple[int, int,  int] | str, optional): Fill color. Defaults to "black".
+            layer (str | None, optional): Layer name, used to pick the color from a theme palette.
+                Defaults to None.
         """
-        for c in coords:
-            abs_coords = self._relativeToAbsolute(c)
+        if not isinstance(coords, Geometry):
+            rings = [np.asarray(c, dtype=float).reshape(-1, 2) for c in coords]
+            offsets = np.cumsum([0] + [len(r) for r in rings])
+            coords = Geometry(
+                np.concatenate(rings) if rings else np.empty((0, 2)), offsets
+            )
 
-            if len(abs_coords) < 3:
-                continue
+        # all the vertices are converted at once, then each ring is a slice
+        abs_coords = self._relativeToAbsolute(coords.coords.astype(float))
+        geometry = Geometry(abs_coords, coords.offsets)
+
+        if self._simplify:
+            # the tolerance is in supersampled pixels, just like the coordinates
+            tolerance = self._simplify * self._supersample
+            self._instrumentation.count("simplify.vertices", len(geometry.coords))
+            geometry = geometry.cull(tolerance).simplify(tolerance)
+            self._instrumentation.count("simplify.kept_vertices", len(geometry.coords))
+
+        self._addPolygons(geometry.coords, geometry.offsets, fill, layer)
+
+    def _addCircles(
+        self,
+        abs_coords: np.ndarray,
+        radius: float,
+        fill: tuple[int, int, int] | str,
+        layer: str | None = None,
+    ) -> None:
+        """Records a set of circles
+
+        Args:
+            abs_coords (np.ndarray): Nx2 array of absolute centers
+            radius (float): Circles radius
+            fill (tuple[int, int, int] | str): Fill color
+            layer (str | None, optional): Layer name. Defaults to None.
+        """
+        if not len(abs_coords):
+            return
+
+        # the circles bounding boxes are truncated just like PIL does,
+        # so that translating them by whole tiles doesn't change the result
+        boxes = np.trunc(
+            np.hstack((abs_coords - radius, abs_coords + radius))
+        ).astype(np.int32)
+
+        self._operations.append(
+            {
+                "type": "circles",
+                "boxes": boxes,
+                "bbox": boxes,
+                "fill": fill,
+                "layer": layer,
+            }
+        )
+
+    def _addPolygons(
+        self,
+        abs_coords: np.ndarray,
+        offsets: np.ndarray,
+        fill: tuple[int, int, int] | str,
+        layer: str | None = None,
+    ) -> None:
+        """Records a set of polygons. Rings with less than 3 vertices are skipped.
+
+        Args:
+            abs_coords (np.ndarray): Nx2 array of absolute coordinates
+            offsets (np.ndarray): Ring offsets
+            fill (tuple[int, int, int] | str): Fill color
+            layer (str | None, optional): Layer name. Defaults to None.
+        """
+        offsets = np.asarray(offsets)
+        keep = np.diff(offsets) >= 3
+        if not keep.any():
+            return
 
-            self.drawPoly(abs_coords, fill)
+        starts, ends = offsets[:-1][keep], offsets[1:][keep]
+        # coordinates are truncated just like PIL does
+        coords = np.trunc(abs_coords).astype(np.int32)
+
+        bbox = np.hstack(
+            (
+                np.minimum.reduceat(coords, starts, axis=0),
+                np.maximum.reduceat(coords, starts, axis=0),
+            )
+        )
+
+        self._operations.append(
+            {
+                "type": "polygons",
+                "coords": coords,
+                "starts": starts,
+                "ends": ends,
+                "bbox": bbox,
+                "fill": fill,
+                "layer": layer,
+            }
+        )
 
     def _relativeToAbsolute(
-        self, rel: tuple[float, float] | list[tuple[float, float]]
-    ) -> list[tuple[float, float]]:
+        self, rel: tuple[float, float] | list[tuple[float, float]] | np.ndarray
+    ) -> list[tuple[float, float]] | np.ndarray:
         """Converts relative coordinates to absolute coordinates
 
         Args:
-            rel (tuple[float, float] | list[tuple[float, float]]): list of relative coordinates
+            rel (tuple[float, float] | list[tuple[float, float]] | np.ndarray): list of relative
+                coordinates, or Nx2 array
 
         Returns:
-            list[tuple[float, float]]: List of absolute coordinates
+            list[tuple[float, float]] | np.ndarray: List (or Nx2 array) of absolute coordinates
         """
+        if isinstance(rel, np.ndarray):
+            return np.asarray(self._border) + rel * np.asarray(self._sizes) * self._scl
+
         if isinstance(rel, tuple):
             return tuple(
                 self._border[x] + rel[x] * self._sizes[x] * self._scl for x in range(2)
@@ -120,72 +688,833 @@ class CityImage:
             for r in rel
         )
 
-    def drawTitle(self, title: str) -> None:
-        """Draws a title on the image
+    def drawTitle(self, title: str, layer: str = "title", font: str = "Light") -> None:
+        """Draws a title on the image.
+        The text is rasterized once, then pasted on each tile it covers.
 
         Args:
             text (str): Title text
+            layer (str, optional): Layer name. Defaults to "title".
+            font (str, optional): Chivo variant, one of FONT_VARIANTS. Defaults to "Light".
         """
         dy = int((1 - self._scl) * self._sizes[1] * 0.25)
         dx = self._sizes[0] // 2
 
-        font = ImageFont.truetype("src/Chivo-Light.ttf", self._title_size)
+        title_font = loadFont(font, self._title_size)
 
-        self._draw.text(
-            (dx, dy),
+        # the text bounding box is needed to know which tiles it covers
+        bbox = ImageDraw.Draw(Image.new("1", (1, 1))).textbbox(
+            (dx, dy), title, font=title_font, align="center", anchor="mt"
+        )
+        mask = Image.new("L", (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+        ImageDraw.Draw(mask).text(
+            (dx - bbox[0], dy - bbox[1]),
             title,
-            fill=self._title_color,
-            font=font,
+            fill=255,
+            font=title_font,
             align="center",
             anchor="mt",
         )
 
+        self._operations.append(
+            {
+                "type": "text",
+                "xy": (dx, dy),
+                "text": title,
+                "font": title_font,
+                "mask": mask,
+                "bbox": np.array([bbox], dtype=np.int32),
+                "fill": self._title_color,
+                "layer": layer,
+            }
+        )
+
+    def _tiles(self, margin: int) -> list[tuple[tuple[int, ...], tuple[int, ...]]]:
+        """Splits the output image in tiles
+
+        Args:
+            margin (int): Margin around each tile, in supersampled pixels
+
+        Returns:
+            list[tuple[tuple[int, ...], tuple[int, ...]]]: list of (output box, rendered box),
+                row by row. The rendered box is in supersampled pixels and includes the margin.
+        """
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        tile_size = self._tile_size or max(real_size)
+
+        tiles = []
+        for y in range(0, real_size[1], tile_size):
+            for x in range(0, real_size[0], tile_size):
+                out_box = (
+                    x,
+                    y,
+                    min(x + tile_size, real_size[0]),
+                    min(y + tile_size, real_size[1]),
+                )
+                render_box = (
+                    max(out_box[0] * self._supersample - margin, 0),
+                    max(out_box[1] * self._supersample - margin, 0),
+                    min(out_box[2] * self._supersample + margin, self._sizes[0]),
+                    min(out_box[3] * self._supersample + margin, self._sizes[1]),
+                )
+                tiles.append((out_box, render_box))
+
+        return tiles
+
+    def _tileIndex(
+        self, bbox: np.ndarray, margin: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Builds a grid index of the primitives touching each tile
+
+        Args:
+            bbox (np.ndarray): Px4 array of primitive bounding boxes
+            margin (int): Margin around each tile, in supersampled pixels
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: primitive ids sorted by tile (and by drawing order
+                inside each tile), offsets of each tile in the sorted ids
+        """
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        tile_size = (self._tile_size or max(real_size)) * self._supersample
+        grid = tuple(-(-real_size[x] // (tile_size // self._supersample)) for x in range(2))
+
+        # range of tiles covered by each primitive, including their margins
+        first = [
+            np.clip((bbox[:, x] - margin) // tile_size, 0, grid[x] - 1) for x in range(2)
+        ]
+        last = [
+            np.clip((bbox[:, x + 2] + margin) // tile_size, 0, grid[x] - 1)
+            for x in range(2)
+        ]
+        nx = last[0] - first[0] + 1
+        count = nx * (last[1] - first[1] + 1)
+
+        # expand each primitive into one entry per covered tile
+        primitive = np.repeat(np.arange(len(bbox)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        nx = np.repeat(nx, count)
+        tx = np.repeat(first[0], count) + local % nx
+        ty = np.repeat(first[1], count) + local // nx
+        tile = ty * grid[0] + tx
+
+        order = np.argsort(tile, kind="stable")
+        starts = np.searchsorted(tile[order], np.arange(grid[0] * grid[1] + 1))
+        return primitive[order], starts
+
+    def _drawTile(
+        self,
+        image: Image.Image,
+        box: tuple[int, int, int, int],
+        tile: int,
+        indexes: list[tuple[np.ndarray, np.ndarray]],
+        fills: list[tuple[int, int, int] | str | int],
+        selected: list[bool] | None = None,
+    ) -> None:
+        """Draws the primitives touching a tile of the supersampled canvas
+
+        Args:
+            image (Image.Image): Tile image
+            box (tuple[int, int, int, int]): Rendered box, in supersampled pixels
+            tile (int): Tile number
+            indexes (list[tuple[np.ndarray, np.ndarray]]): Tile index of each operation
+            fills (list[tuple[int, int, int] | str | int]): Fill of each operation
+            selected (list[bool] | None, optional): Whether each operation has to be drawn.
+                Defaults to None (all of them).
+        """
+        draw = ImageDraw.Draw(image)
+        origin = np.array(box[:2], dtype=np.int32)
+
+        if selected is None:
+            selected = [True] * len(self._operations)
+
+        for operation, (ids, starts), fill, draw_operation in zip(
+            self._operations, indexes, fills, selected
+        ):
+            if not draw_operation:
+                continue
+
+            ids = ids[starts[tile] : starts[tile + 1]]
+            if not len(ids):
+                continue
+
+            started = perf_counter()
+            if operation["type"] == "circles":
+                boxes = operation["boxes"][ids] - np.tile(origin, 2)
+                self._drawCircles(image, draw, boxes, fill)
+
+            elif operation["type"] == "polygons":
+                coords = operation["coords"]
+                for start, end in zip(
+                    operation["starts"][ids].tolist(), operation["ends"][ids].tolist()
+                ):
+                    ring = coords[start:end] - origin
+                    draw.polygon(ring.ravel().tolist(), width=0, fill=fill)
+
+            elif operation["type"] == "text":
+                bbox = operation["bbox"][0]
+                image.paste(fill, (bbox[0] - box[0], bbox[1] - box[1]), operation["mask"])
+
+            layer = operation["layer"] or operation["type"]
+            self._instrumentation.addTime(f"draw.{layer}", perf_counter() - started)
+
+    def _drawCircles(
+        self,
+        image: Image.Image,
+        draw: ImageDraw.ImageDraw,
+        boxes: np.ndarray,
+        fill: tuple[int, int, int] | str | int,
+    ) -> None:
+        """Draws circles with the selected point renderer
+
+        Args:
+            image (Image.Image): Tile image
+            draw (ImageDraw.ImageDraw): Tile drawing context
+            boxes (np.ndarray): Px4 array of circles bounding boxes, relative to the tile
+            fill (tuple[int, int, int] | str | int): Fill color
+        """
+        if self._point_renderer == "auto":
+            # stamping costs about 3ns for each pixel of the covered region
+            # and 25ns for each stamped pixel, while each ellipse costs about
+            # 2.3us plus 6.5ns for each of its pixels
+            size = (boxes[0, 2:] - boxes[0, :2] + 1).prod()
+            region = (boxes[:, 2:].max(axis=0) - boxes[:, :2].min(axis=0) + 1).prod()
+            sprite = 3 * region + 25 * size * len(boxes)
+            ellipse = (2300 + 6.5 * size) * len(boxes)
+            use_sprite = sprite < ellipse
+        else:
+            use_sprite = self._point_renderer == "sprite"
+
+        if use_sprite:
+            self._stampCircles(image, boxes, fill)
+        else:
+            for b in boxes.tolist():
+                draw.ellipse(b, fill=fill)
+
+    def _stampCircles(
+        self,
+        image: Image.Image,
+        boxes: np.ndarray,
+        fill: tuple[int, int, int] | str | int,
+    ) -> None:
+        """Draws circles by stamping a precomputed disc sprite on their positions.
+        All the stamps are computed at once and the image is filled through a single mask,
+        giving the same pixels as drawing each ellipse.
+
+        Args:
+            image (Image.Image): Tile image
+            boxes (np.ndarray): Px4 array of circles bounding boxes, relative to the tile
+            fill (tuple[int, int, int] | str | int): Fill color
+        """
+        # only the region covered by the circles gets a mask
+        left, top = np.maximum(boxes[:, :2].min(axis=0), 0).tolist()
+        right = min(int(boxes[:, 2].max()) + 1, image.width)
+        bottom = min(int(boxes[:, 3].max()) + 1, image.height)
+        if right <= left or bottom <= top:
+            return
+
+        width, height = right - left, bottom - top
+        mask = np.zeros((height, width), dtype=bool)
+        boxes = boxes - np.array([left, top, left, top], dtype=boxes.dtype)
+        sizes = boxes[:, 2:] - boxes[:, :2]
+
+        # boxes of the same circles can differ by a pixel after truncation
+        for size in np.unique(sizes, axis=0):
+            dx, dy = self._circleSprite(*size.tolist())
+            if not len(dx):
+                # circles smaller than a pixel might not cover any
+                continue
+
+            same = boxes[(sizes == size).all(axis=1)]
+
+            # limit the memory used by the stamps
+            chunk = max(1, 2**22 // len(dx))
+            for c in range(0, len(same), chunk):
+                x = (same[c : c + chunk, 0, None] + dx).ravel()
+                y = (same[c : c + chunk, 1, None] + dy).ravel()
+                inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+                mask[y[inside], x[inside]] = True
+
+        # a bilevel mask is much faster to paste through than a grayscale one
+        image.paste(fill, (left, top, right, bottom), Image.fromarray(mask))
+
+    def _circleSprite(self, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the pixels covered by an ellipse drawn in a box of the given size
+
+        Args:
+            width (int)
+            height (int)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: x and y offsets of each covered pixel
+        """
+        key = (width, height)
+        if key not in _sprites:
+            sprite = Image.new("L", (width + 1, height + 1), 0)
+            ImageDraw.Draw(sprite).ellipse((0, 0, width, height), fill=255)
+            dy, dx = np.nonzero(np.asarray(sprite))
+            _sprites[key] = (dx.astype(np.int32), dy.astype(np.int32))
+
+        return _sprites[key]
+
+    def _renderTile(
+        self,
+        box: tuple[int, int, int, int],
+        tile: int,
+        indexes: list[tuple[np.ndarray, np.ndarray]],
+    ) -> Image.Image:
+        """Rasterizes the primitives touching a tile of the supersampled canvas
+
+        Args:
+            box (tuple[int, int, int, int]): Rendered box, in supersampled pixels
+            tile (int): Tile number
+            indexes (list[tuple[np.ndarray, np.ndarray]]): Tile index of each operation
+
+        Returns:
+            Image.Image
+        """
+        size = (box[2] - box[0], box[3] - box[1])
+        image = Image.new("RGB", size, self._background_color)
+        fills = [o["fill"] for o in self._operations]
+        self._drawTile(image, box, tile, indexes, fills)
+        return image
+
+    def _downsampleTile(
+        self,
+        image: Image.Image,
+        out_box: tuple[int, int, int, int],
+        render_box: tuple[int, int, int, int],
+    ) -> Image.Image:
+        """Downsamples a rendered tile to its output size
+
+        Args:
+            image (Image.Image): Rendered tile
+            out_box (tuple[int, int, int, int]): Output box, in output pixels
+            render_box (tuple[int, int, int, int]): Rendered box, in supersampled pixels
+
+        Returns:
+            Image.Image
+        """
+        # region of the tile that gets downsampled, relative to the rendered box
+        source_box = tuple(
+            out_box[x] * self._supersample - render_box[x % 2] for x in range(4)
+        )
+        size = (out_box[2] - out_box[0], out_box[3] - out_box[1])
+
+        with self._instrumentation.timer("resize"):
+            if self._downsample == "reduce":
+                return image.reduce(self._supersample, box=source_box)
+
+            factor = self._reduceFactor()
+            if factor > 1:
+                # tiles start on multiples of the factor, so blocks match the whole canvas
+                image = image.reduce(factor)
+                source_box = tuple(x / factor for x in source_box)
+
+            return image.resize(size, resample=self._resample, box=source_box)
+
+    def _reduceFactor(self) -> int:
+        """Returns the factor of the block reduction applied before resampling
+
+        Returns:
+            int: 1 if no reduction is applied
+        """
+        if self._downsample != "staged":
+            return 1
+
+        # the largest one leaving at least twice the output size
+        factors = [
+            f for f in range(2, self._supersample // 2 + 1) if self._supersample % f == 0
+        ]
+        return max(factors, default=1)
+
+    def _margin(self) -> int:
+        """Returns the margin needed around each tile by the resampling filter
+
+        Returns:
+            int: margin, in supersampled pixels
+        """
+        # polygons are filled slightly differently on the image borders
+        if self._downsample == "reduce":
+            return 1
+
+        support = {
+            Image.Resampling.NEAREST: 0,
+            Image.Resampling.BOX: 0.5,
+            Image.Resampling.BILINEAR: 1,
+            Image.Resampling.HAMMING: 1,
+            Image.Resampling.BICUBIC: 2,
+            Image.Resampling.LANCZOS: 3,
+        }[self._resample]
+        margin = int(np.ceil(support * self._supersample)) + 1
+
+        # blocks of the staged reduction must be aligned to the canvas
+        factor = self._reduceFactor()
+        return -(-margin // factor) * factor
+
+    @property
+    def palette(self) -> dict[str, tuple[int, int, int] | str]:
+        """Returns the colors of the image: background, title and each layer
+
+        Returns:
+            dict[str, tuple[int, int, int] | str]
+        """
+        return {
+            "background": self._background_color,
+            "title": self._title_color,
+            **self._layer_colors,
+        }
+
+    def _layerRuns(self) -> list[tuple[str | None, tuple[int, int, int] | str, list[int]]]:
+        """Groups the consecutive operations sharing the same layer and fill.
+        Runs are composed in order, so that layers are stacked as they were drawn.
+
+        Returns:
+            list[tuple[str | None, tuple[int, int, int] | str, list[int]]]: layer, fill and
+                operations of each run
+        """
+        runs = []
+        for i, o in enumerate(self._operations):
+            if runs and runs[-1][:2] == (o["layer"], o["fill"]):
+                runs[-1][2].append(i)
+            else:
+                runs.append((o["layer"], o["fill"], [i]))
+
+        return runs
+
+    def _layerKey(self, operations: list[int]) -> str:
+        """Returns the cache key of the coverage mask of a set of operations.
+        Colors are not part of the key, since masks are painted when composing the image.
+
+        Args:
+            operations (list[int]): Operation ids
+
+        Returns:
+            str
+        """
+        digest = hashlib.sha256()
+        for i in operations:
+            o = self._operations[i]
+            digest.update(o["type"].encode("utf-8"))
+            if o["type"] == "circles":
+                digest.update(o["boxes"].tobytes())
+            elif o["type"] == "polygons":
+                for array in (o["coords"], o["starts"], o["ends"]):
+                    digest.update(np.ascontiguousarray(array).tobytes())
+            else:
+                font = (o["font"].path, o["font"].size)
+                digest.update(repr((o["xy"], o["text"], font)).encode("utf-8"))
+
+        return self._layer_cache.key(
+            digest.hexdigest(), self._sizes, self._supersample, self._downsample
+        )
+
+    def _layerMasks(
+        self, runs: list[tuple[str | None, tuple[int, int, int] | str, list[int]]]
+    ) -> list[Image.Image]:
+        """Returns the coverage mask of each run, at the output size.
+        Masks missing from the layer cache are rasterized tile by tile, then cached.
+
+        Args:
+            runs (list[tuple[str | None, tuple[int, int, int] | str, list[int]]]): Operation runs
+
+        Returns:
+            list[Image.Image]: One 16 bit image per run
+        """
+        keys = [self._layerKey(operations) for _, _, operations in runs]
+        masks = [self._layer_cache.get(key) for key in keys]
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        self._instrumentation.count("layers.cached", len(runs) - len(missing))
+        self._instrumentation.count("layers.rendered", len(missing))
+
+        if not missing:
+            return masks
+
+        selections = {}
+        for i in missing:
+            selections[i] = [False] * len(self._operations)
+            for operation in runs[i][2]:
+                selections[i][operation] = True
+
+        # only the operations of the missing runs need to be indexed
+        margin = self._margin()
+        indexes = [
+            self._tileIndex(o["bbox"], margin)
+            if any(s[i] for s in selections.values())
+            else (None, None)
+            for i, o in enumerate(self._operations)
+        ]
+        fills = [255] * len(self._operations)
+
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        coverages = {i: Image.new("F", real_size, 0) for i in missing}
+
+        tiles = self._tiles(margin)
+        with self._instrumentation.profile("render-masks"):
+            for tile, (out_box, render_box) in enumerate(tiles):
+                size = (render_box[2] - render_box[0], render_box[3] - render_box[1])
+                for i in missing:
+                    # empty tiles stay empty
+                    if all(
+                        indexes[o][1][tile] == indexes[o][1][tile + 1] for o in runs[i][2]
+                    ):
+                        continue
+
+                    tile_img = Image.new("L", size, 0)
+                    self._drawTile(tile_img, render_box, tile, indexes, fills, selections[i])
+                    # downsampled as floats, so that the filter lobes aren't clipped
+                    out_tile = self._downsampleTile(tile_img.convert("F"), out_box, render_box)
+                    coverages[i].paste(out_tile, out_box[:2])
+
+        self._instrumentation.count("tiles", len(tiles))
+        for i in missing:
+            encoded = np.rint(np.asarray(coverages[i]) * _MASK_SCALE) + _MASK_ZERO
+            masks[i] = Image.fromarray(np.clip(encoded, 0, 65535).astype(np.uint16))
+            self._layer_cache.set(keys[i], masks[i])
+
+        return masks
+
+    def _composeLayers(
+        self, palettes: list[dict[str, tuple[int, int, int] | str]]
+    ) -> list[Image.Image]:
+        """Composes one image per theme by painting the (cached) coverage mask of each layer
+
+        Args:
+            palettes (list[dict[str, tuple[int, int, int] | str]]): Colors of each theme,
+                in the same form of the palette property. Missing layers keep their color.
+
+        Returns:
+            list[Image.Image]: One output image per theme
+        """
+        runs = self._layerRuns()
+        masks = self._layerMasks(runs)
+
+        masks = [np.asarray(mask) for mask in masks]
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        band = self._tile_size or real_size[1]
+
+        out_imgs = []
+        with self._instrumentation.timer("compose"):
+            for palette in palettes:
+                colors = [
+                    palette.get(layer, fill) if layer else fill for layer, fill, _ in runs
+                ]
+                background = palette.get("background", self._background_color)
+                colors = [
+                    np.array(
+                        ImageColor.getrgb(c)[:3] if isinstance(c, str) else c[:3],
+                        dtype=np.float32,
+                    )
+                    for c in [background, *colors]
+                ]
+
+                # layers are blended over each other, one band of rows at a time
+                out = np.empty((real_size[1], real_size[0], 3), dtype=np.uint8)
+                for y in range(0, real_size[1], band):
+                    rows = min(band, real_size[1] - y)
+                    block = np.empty((rows, real_size[0], 3), dtype=np.float32)
+                    block[:] = colors[0]
+                    for mask, color in zip(masks, colors[1:]):
+                        coverage = mask[y : y + rows].astype(np.float32) - _MASK_ZERO
+                        coverage /= _MASK_SCALE * 255
+                        block += (color - block) * coverage[..., None]
+
+                    out[y : y + rows] = np.clip(np.rint(block), 0, 255)
+
+                out_imgs.append(Image.fromarray(out, "RGB"))
+
+        return out_imgs
+
+    def render(self) -> Image.Image:
+        """Rasterizes the image tile by tile, downsampling each tile.
+        Tiles overlap by the support of the resampling filter, so the result is the
+        same as rasterizing and downsampling the whole supersampled canvas.
+        With a layer cache, the image is composed from the coverage mask of each layer.
+
+        Returns:
+            Image.Image: Output image
+        """
+        if self._layer_cache is not None:
+            return self._composeLayers([{}])[0]
+
+        margin = self._margin()
+        indexes = [self._tileIndex(o["bbox"], margin) for o in self._operations]
+
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        out_img = Image.new("RGB", real_size)
+
+        tiles = self._tiles(margin)
+        with self._instrumentation.profile("render"):
+            for tile, (out_box, render_box) in enumerate(tiles):
+                tile_img = self._renderTile(render_box, tile, indexes)
+                out_tile = self._downsampleTile(tile_img, out_box, render_box)
+                out_img.paste(out_tile, out_box[:2])
+
+        self._instrumentation.count("tiles", len(tiles))
+        return out_img
+
+    def renderThemes(
+        self, palettes: list[dict[str, tuple[int, int, int] | str]]
+    ) -> list[Image.Image]:
+        """Renders the image once for each theme.
+        Each tile is rasterized a single time into a mask of layer labels,
+        then every theme is obtained by a palette lookup on the mask.
+        Text is always drawn on top of the other layers.
+        With a layer cache, each theme is composed from the coverage mask of each layer.
+
+        Args:
+            palettes (list[dict[str, tuple[int, int, int] | str]]): Colors of each theme,
+                in the same form of the palette property. Missing layers keep their color.
+
+        Returns:
+            list[Image.Image]: One output image per theme
+        """
+        if self._layer_cache is not None:
+            return self._composeLayers(palettes)
+
+        # each layer (or each color, for unnamed layers) gets a label in the mask
+        labels = {}
+        for o in self._operations:
+            key = o["layer"] or ("fill", o["fill"])
+            if o["type"] != "text" and key not in labels:
+                labels[key] = (len(labels) + 1, o["fill"])
+
+        if len(labels) > 255:
+            raise ValueError("Too many layers to be rendered as themes.")
+
+        masks = [
+            labels.get(o["layer"] or ("fill", o["fill"]), (0,))[0]
+            for o in self._operations
+        ]
+
+        luts = []
+        text_fills = []
+        for palette in palettes:
+            colors = [palette.get("background", self._background_color)] + [
+                palette.get(k, fill) if isinstance(k, str) else fill
+                for k, (_, fill) in labels.items()
+            ]
+            lut = [
+                c
+                for color in colors
+                for c in (
+                    ImageColor.getrgb(color) if isinstance(color, str) else color
+                )[:3]
+            ]
+            luts.append(lut)
+            text_fills.append(
+                [palette.get(o["layer"], o["fill"]) for o in self._operations]
+            )
+
+        is_text = [o["type"] == "text" for o in self._operations]
+        is_shape = [not t for t in is_text]
+
+        margin = self._margin()
+        indexes = [self._tileIndex(o["bbox"], margin) for o in self._operations]
+
+        real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
+        out_imgs = [Image.new("RGB", real_size) for _ in palettes]
+
+        tiles = self._tiles(margin)
+        with self._instrumentation.profile("render-themes"):
+            for tile, (out_box, render_box) in enumerate(tiles):
+                size = (render_box[2] - render_box[0], render_box[3] - render_box[1])
+                mask = Image.new("P", size, 0)
+                self._drawTile(mask, render_box, tile, indexes, masks, is_shape)
+
+                for out_img, lut, fills in zip(out_imgs, luts, text_fills):
+                    mask.putpalette(lut)
+                    tile_img = mask.convert("RGB")
+                    self._drawTile(tile_img, render_box, tile, indexes, fills, is_text)
+                    out_tile = self._downsampleTile(tile_img, out_box, render_box)
+                    out_img.paste(out_tile, out_box[:2])
+
+        self._instrumentation.count("tiles", len(tiles))
+        return out_imgs
+
+    def saveThemes(self, outputs: dict[str, dict]) -> None:
+        """Saves the image in multiple themes, rasterizing it only once
+
+        Args:
+            outputs (dict[str, dict]): Palette of each file. Extension gets automatically added.
+        """
+        images = self.renderThemes(list(outputs.values()))
+
+        for filename, out_img in zip(outputs, images):
+            self._encode(out_img, filename)
+
     def save(self, filename: str) -> None:
-        """Saves image as a png file
+        """Saves the image, see encodingOptions
 
         Args:
             filename (str): Filename. Extension gets automatically added.
         """
-        if filename[-4:] != ".png":
-            filename += ".png"
+        out_img = self.render()
+        self._encode(out_img, filename)
+
+    def _encode(self, out_img: Image.Image, filename: str) -> None:
+        """Encodes an output image with the encoding options of the image,
+        in the background if the image has an encoder
+
+        Args:
+            out_img (Image.Image): Output image
+            filename (str): Filename. Extension gets automatically added.
+        """
+        if self._encoder is not None:
+            self._encoder.submit(self._encodeImage, out_img, filename)
+        else:
+            self._encodeImage(out_img, filename)
+
+    def _encodeImage(self, out_img: Image.Image, filename: str) -> list[str]:
+        """Encodes an output image, timing it
+
+        Args:
+            out_img (Image.Image): Output image
+            filename (str): Filename. Extension gets automatically added.
+
+        Returns:
+            list[str]: Written files
+        """
+        with self._instrumentation.timer("encode"):
+            return encodeImage(out_img, filename, self._encoding)
+
+    def renderLayers(
+        self, layers: list[str], composite: bool = False
+    ) -> dict[str | None, Image.Image]:
+        """Renders one image for each layer, on top of a shared base.
+        The base is made of every operation not belonging to the selected layers:
+        each of its tiles is rasterized once, then copied into a reused buffer
+        before drawing the operations of each layer.
+
+        Args:
+            layers (list[str]): Layers to be rendered
+            composite (bool, optional): Also render all the layers together, without
+                their text. Defaults to False.
+
+        Returns:
+            dict[str | None, Image.Image]: Output image of each layer. The composite image,
+                if requested, is keyed by None.
+        """
+        fills = [o["fill"] for o in self._operations]
+        in_base = [o["layer"] not in layers for o in self._operations]
+        selections = {
+            layer: [o["layer"] == layer for o in self._operations] for layer in layers
+        }
+        if composite:
+            selections[None] = [
+                o["layer"] in layers and o["type"] != "text" for o in self._operations
+            ]
+
+        margin = self._margin()
+        indexes = [self._tileIndex(o["bbox"], margin) for o in self._operations]
 
         real_size = tuple(int(self._sizes[x] / self._supersample) for x in range(2))
-        out_img = self._image.resize(real_size, resample=Image.ANTIALIAS)
-        out_img.save(filename, "PNG")
+        out_imgs = {layer: Image.new("RGB", real_size) for layer in selections}
+        # tile buffers, by size
+        buffers = {}
 
-    def drawTrees(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultipleCircles(pos, 2, (16, 16, 16))
+        tiles = self._tiles(margin)
+        with self._instrumentation.profile("render-layers"):
+            for tile, (out_box, render_box) in enumerate(tiles):
+                size = (render_box[2] - render_box[0], render_box[3] - render_box[1])
+                base = Image.new("RGB", size, self._background_color)
+                self._drawTile(base, render_box, tile, indexes, fills, in_base)
 
-    def drawWater(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (24, 24, 24))
+                if size not in buffers:
+                    buffers[size] = Image.new("RGB", size)
+                tile_img = buffers[size]
 
-    def drawParks(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (200, 200, 200))
+                for layer, selected in selections.items():
+                    tile_img.paste(base)
+                    self._drawTile(tile_img, render_box, tile, indexes, fills, selected)
+                    out_tile = self._downsampleTile(tile_img, out_box, render_box)
+                    out_imgs[layer].paste(out_tile, out_box[:2])
 
-    def drawBuildings(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (16, 16, 16))
+        self._instrumentation.count("tiles", len(tiles))
+        return out_imgs
 
+    def saveLayers(self, outputs: dict[str, str], composite: str | None = None) -> None:
+        """Saves one image for each layer, on top of a shared base
 
-class DarkCityImage(CityImage):
-    def __init__(self):
-        super().__init__(background_color=(15, 15, 15))
-        self._title_color = (200, 200, 200)
+        Args:
+            outputs (dict[str, str]): Filename of each layer. Extension gets automatically added.
+            composite (str | None, optional): Filename of the image containing all the layers.
+                Defaults to None (not saved).
+        """
+        images = self.renderLayers(list(outputs), composite is not None)
+        filenames = {**outputs, None: composite}
+
+        for layer, out_img in images.items():
+            self._encode(out_img, filenames[layer])
 
-    def drawTrees(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultipleCircles(pos, 2, (240, 240, 240))
+    @classmethod
+    def progressive(
+        cls,
+        draw: Callable[["CityImage"], None],
+        palettes: list[dict[str, tuple[int, int, int] | str]] | None = None,
+        scales: list[float] | None = None,
+        **kwargs,
+    ) -> Iterator[Image.Image | list[Image.Image]]:
+        """Renders an image progressively: quick drafts first, then the final image.
+        The drawing calls are repeated for each image, so that the geometry gets
+        simplified at the resolution of each draft.
 
-    def drawWater(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (232, 232, 232))
+        Args:
+            draw (Callable[[CityImage], None]): Draws the map on an image
+            palettes (list[dict[str, tuple[int, int, int] | str]] | None, optional):
+                Render these themes instead of the image colors. Defaults to None.
+            scales (list[float] | None, optional): Scale of each draft.
+                Defaults to DRAFT_SCALES.
+            **kwargs: Arguments of the image, used as they are for the final one
+
+        Yields:
+            Image.Image | list[Image.Image]: Each draft, then the final image.
+                A list of images (one per theme) if palettes are provided.
+        """
+        if scales is None:
+            scales = DRAFT_SCALES
 
-    def drawParks(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (55, 55, 55))
+        for scale in [*scales, None]:
+            image = cls(**{**kwargs, "draft": scale})
+            draw(image)
+            yield image.renderThemes(palettes) if palettes else image.render()
 
-    def drawBuildings(self, pos: list[tuple[float, float]]) -> None:
-        self.drawMultiplePoly(pos, (240, 240, 240))
+    def drawTrees(self, pos: Geometry) -> None:
+        # a quarter of an output pixel, whatever the supersampling
+        radius = 0.25 * self._supersample
+        self.drawMultipleCircles(pos, radius, self._layer_colors["trees"], layer="trees")
+
+    def drawWater(self, pos: Geometry) -> None:
+        self.drawMultiplePoly(pos, self._layer_colors["water"], layer="water")
+
+    def drawParks(self, pos: Geometry) -> None:
+        self.drawMultiplePoly(pos, self._layer_colors["parks"], layer="parks")
+
+    def drawBuildings(self, pos: Geometry) -> None:
+        self.drawMultiplePoly(pos, self._layer_colors["buildings"], layer="buildings")
+
+
+class DarkCityImage(CityImage):
+    _layer_colors = {
+        "trees": (240, 240, 240),
+        "water": (232, 232, 232),
+        "parks": (55, 55, 55),
+        "buildings": (240, 240, 240),
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(background_color=(15, 15, 15), **kwargs)
+        self._title_color = (200, 200, 200)
 
 
 class MinimalisticCityImage(CityImage):
-    def __init__(self):
-        super().__init__(background_color=(15, 15, 15))
+    def __init__(self, **kwargs):
+        super().__init__(background_color=(15, 15, 15), **kwargs)
         self._title_color = (200, 200, 200)
         self._title_size = int((1 - self._scl) * self._sizes[0] * 0.2)
+
+    def drawPoints(
+        self, pos: Geometry, fill: tuple[int, int, int] | str, layer: str | None = None
+    ) -> None:
+        # a pixel and a quarter of output, whatever the supersampling
+        radius = 1.25 * self._supersample
+        self.drawMultipleCircles(pos, radius, fill, layer=layer)
@@ -1,42 +1,243 @@
+import json
 import logging
+import mmap
+import os
+import re
+import struct
+
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from threading import BoundedSemaphore
+from time import perf_counter, sleep, time
+from types import MappingProxyType
+from typing import Callable, Iterator, Mapping, NotRequired, TypedDict
+from urllib.error import HTTPError, URLError
+from math import cos, sin, radians
+from OSMPythonTools.nominatim import Nominatim, NominatimResults
+from OSMPythonTools.cachingStrategy import CachingStrategy
+from OSMPythonTools.overpass import Overpass, OverpassResult
+
+import numpy as np
+
+from geometry import Geometry
+from instrumentation import Instrumentation
+from osmcache import NoCaching, OSMCache
+
+
+class FeatureDefinition(TypedDict):
+    # feature name, also used as attribute of the map
+    name: str
+    # tag selectors, either "key" or "key=value". Keys and values can be quoted
+    tag: list[str]
+    # "node", "way" or "area"
+    topology: list[str]
+    # fill color, used by the minimal map
+    color: NotRequired[str]
+
+
+TOPOLOGIES = {"node", "way", "area"}
+
+# tag selectors: "key" or "key=value", each part either quoted or a plain token.
+# Negations, inequalities and regular expressions are not supported
+_SELECTOR = re.compile(
+    r'^(?:"(?P<quoted_key>[^"]+)"|(?P<key>[^\s"=!~\[\]()]+))'
+    r'(?:=(?:"(?P<quoted_value>[^"]*)"|(?P<value>[^\s"=!~\[\]()]+)))?$'
+)
+
+# responses are only cached by OSMCache
+CachingStrategy.use(NoCaching)
+
+# remarks of the Overpass queries exceeding the time or memory limits of the server
+OVERPASS_TIMEOUT_REMARK = re.compile(
+    r"runtime error: query (timed out|run out of memory|ran out of memory)", re.IGNORECASE
+)
+
+# binary snapshots start with magic, version and header size, followed by a JSON header.
+# arrays come next, each one aligned so that it can be mapped without copies
+SNAPSHOT_MAGIC = b"CITYSNAP"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_PREAMBLE = struct.Struct("<8sIQ")
+_SNAPSHOT_ALIGNMENT = 64
+
+
+class OverpassTimeout(Exception):
+    """The Overpass server gave up on a query, exceeding its time or memory limits"""
+
+
+class RemarkOverpass(Overpass):
+    """Overpass backend returning the results with an error remark instead of raising
+    a generic exception, so that their remark can be read (see CityMap._fetchOverpass)
+    """
+
+    def _isValid(self, result: OverpassResult) -> bool:
+        return True
+
+
+def parseSelector(selector: str) -> tuple[str, str | None]:
+    """Splits a tag selector into its key and (optional) value
+
+    Args:
+        selector (str): Tag selector, either "key" or "key=value".
+            Keys and values can be quoted, e.g. '"name"="Parco Sempione"'.
+
+    Raises:
+        ValueError: the selector is malformed, or uses negations (!key, key!=value)
+            or regular expressions (key~value), which are not supported
 
-from time import sleep
-from math import cos, sin, asin, radians, sqrt
-from OSMPythonTools.nominatim import Nominatim
-from OSMPythonTools.overpass import overpassQueryBuilder, Overpass
+    Returns:
+        tuple[str, str | None]: key, value
+    """
+    match = _SELECTOR.match(selector)
+    if match is None:
+        raise ValueError(f"Unsupported tag selector {selector}")
+
+    key = match["quoted_key"] or match["key"]
+    if match["quoted_value"] is not None:
+        return key, match["quoted_value"]
+
+    return key, match["value"]
 
 
 class CityMap:
-    def __init__(self, city: str) -> None:
+    # requests in flight towards each service, shared by all the maps.
+    # the public Overpass instance grants 2 slots per IP,
+    # Nominatim asks for no more than 1 request at a time
+    _overpass_slots = BoundedSemaphore(2)
+    _nominatim_slots = BoundedSemaphore(1)
+
+    def __init__(
+        self,
+        city: str,
+        cache: OSMCache | None = None,
+        nominatim: Nominatim | None = None,
+        overpass: Overpass | None = None,
+        max_workers: int = 2,
+        dtype: type = np.float64,
+        instrumentation: Instrumentation | None = None,
+    ) -> None:
         """Create city map
 
         Args:
             city (str): City name
-            radius (float, optional): City radius, in meters. Defaults to 3000.
+            cache (OSMCache, optional): Cache for OSM responses. Defaults to a cache in the current folder.
+            nominatim (Nominatim, optional): Nominatim backend. Defaults to the public instance.
+            overpass (Overpass, optional): Overpass backend. Defaults to the public instance,
+                through RemarkOverpass.
+            max_workers (int, optional): Number of queries fetched concurrently. Defaults to 2.
+            dtype (type, optional): Type of normalized coordinates (np.float32 halves memory).
+                Defaults to np.float64.
+            instrumentation (Instrumentation, optional): Collects timers and counters of each stage.
+                Defaults to a new instance.
         """
         self._city = city
 
         self._elements_dict = {}
         self._normalized_dict = {}
-        self._features_list = []
+        self._features_list: list[FeatureDefinition] = []
+        self._dtype = dtype
 
         # request timing
         self._timeout = 300
-        self._try_again = 30
+        self._max_workers = max_workers
+        # retries, with exponential backoff
+        self._max_attempts = 6
+        self._backoff_base = 5
+        self._backoff_cap = 120
+        # maximum number of statements in a single union query
+        self._max_union_size = 64
+        # maximum number of elements fetched by a single query: larger areas are split
+        # in a quadtree of tiles, at most self._max_depth levels deep
+        self._max_elements = 200_000
+        self._max_depth = 5
+        # tiles submitted before the previous ones are consumed
+        self._max_tiles_in_flight = 2 * max_workers
         # initialize instances
-        self._nominatim = Nominatim()
-        self._overpass = Overpass()
+        self._cache = cache if cache is not None else OSMCache()
+        self._nominatim = nominatim if nominatim is not None else Nominatim()
+        self._overpass = overpass if overpass is not None else RemarkOverpass()
+        self._instrumentation = (
+            instrumentation if instrumentation is not None else Instrumentation(city)
+        )
 
-    def __getattr__(self, feature: str) -> list[tuple[float, float]]:
-        """Returns a list of features. Too check the available features, try using the features attribute
+    def __getattr__(self, feature: str) -> Geometry:
+        """Returns a feature. Too check the available features, try using the features attribute
+
+        Raises:
+            AttributeError: the feature is not defined
 
         Returns:
-            list[tuple[float, float]]: list of relative positions
+            Geometry: relative positions, empty if no element was found
         """
+        # private attributes are never features, and might be missing while unpickling
+        if feature.startswith("_"):
+            raise AttributeError(feature)
+
         if feature in self._normalized_dict:
             return self._normalized_dict[feature]
 
-        return []
+        definition = self._features.get(feature)
+        if definition is None:
+            raise AttributeError(
+                f"{type(self).__name__} has no feature {feature!r}. "
+                f"Available features: {', '.join(self._features)}"
+            )
+
+        return Geometry.empty(
+            "node" not in definition["topology"],
+            self._dtype,
+            {"name": feature, "topology": definition["topology"]},
+        )
+
+    @property
+    def _features_list(self) -> list[FeatureDefinition]:
+        """Returns the feature definitions, in drawing order
+
+        Returns:
+            list[FeatureDefinition]
+        """
+        return list(self._features.values())
+
+    @_features_list.setter
+    def _features_list(self, definitions: list[FeatureDefinition]) -> None:
+        """Validates the feature definitions and indexes them by name
+
+        Args:
+            definitions (list[FeatureDefinition])
+
+        Raises:
+            ValueError: a definition is incomplete, duplicated, has an unknown topology
+                or an unsupported tag selector
+        """
+        features = {}
+        for definition in definitions:
+            if missing := {"name", "tag", "topology"} - set(definition):
+                raise ValueError(f"Feature definition {definition} misses {sorted(missing)}")
+            if definition["name"] in features:
+                raise ValueError(f"Duplicated feature {definition['name']}")
+            if unknown := set(definition["topology"]) - TOPOLOGIES:
+                raise ValueError(
+                    f"Unknown topology {sorted(unknown)} in feature {definition['name']}"
+                )
+            for selector in definition["tag"]:
+                try:
+                    self._selectorFilter(selector)
+                except ValueError as e:
+                    raise ValueError(f"{e} in feature {definition['name']}") from None
+
+            features[definition["name"]] = definition
+
+        self._features = features
+
+    @property
+    def feature_definitions(self) -> Mapping[str, FeatureDefinition]:
+        """Returns the (read only) definition of each feature, by name
+
+        Returns:
+            Mapping[str, FeatureDefinition]
+        """
+        return MappingProxyType(self._features)
 
     @property
     def features(self) -> list[str]:
@@ -48,42 +249,280 @@ class CityMap:
         return [f for f in self._normalized_dict]
 
     @property
-    def circular_features(self) -> dict[list[tuple[float, float]]]:
+    def circular_features(self) -> dict[str, Geometry]:
         """Returns all features that can must drawn as circles
 
         Returns:
-            dict[list[tuple[float, float]]]
+            dict[str, Geometry]
         """
         return {
             k: v
             for k, v in self._normalized_dict.items()
-            if any(
-                "node" in x["topology"] and x["name"] == k for x in self._features_list
-            )
+            if "node" in self._features[k]["topology"]
         }
 
     @property
-    def polygonal_features(self) -> dict[list[tuple[float, float]]]:
+    def polygonal_features(self) -> dict[str, Geometry]:
         """Returns all features that can must drawn as polygons
 
         Returns:
-            dict[list[tuple[float, float]]]
+            dict[str, Geometry]
         """
         return {
             k: v
             for k, v in self._normalized_dict.items()
-            if any(
-                any(y in x["topology"] for y in {"way", "area"}) and x["name"] == k
-                for x in self._features_list
-            )
+            if any(t in self._features[k]["topology"] for t in ["way", "area"])
         }
 
-    def loadCity(self) -> None:
-        """Loads city area id and bounding box (both in xy and coordinates forms)"""
-        city_query = self._nominatim.query(
+    @property
+    def query_stats(self) -> list[dict]:
+        """Returns timing stats for each request made to Nominatim and Overpass
+
+        Returns:
+            list[dict]: list of {service, cached, attempts, elapsed, bytes}
+        """
+        return [
+            {k: v for k, v in e.items() if k != "kind"}
+            for e in self._instrumentation.events("request")
+        ]
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        """Returns the instrumentation of the map
+
+        Returns:
+            Instrumentation
+        """
+        return self._instrumentation
+
+    def _retry(
+        self,
+        service: str,
+        slots: BoundedSemaphore,
+        request,
+        *args,
+        fatal: Callable[[Exception], bool] | None = None,
+        **kwargs,
+    ):
+        """Performs a request, trying again with exponential backoff and jitter if it fails.
+        Gives up after self._max_attempts attempts.
+
+        Args:
+            service (str): Name of the service, used in stats and logs
+            slots (BoundedSemaphore): Concurrency limit of the service
+            request (callable): Function performing the request
+            *args, **kwargs: Arguments passed to the request
+            fatal (Callable[[Exception], bool] | None, optional): Tells the errors that would
+                happen again, which are raised without trying again. Defaults to None.
+
+        Raises:
+            RuntimeError: the request failed too many times
+
+        Returns:
+            tuple[Any, int]: result of the request, number of attempts
+        """
+        for attempt in range(self._max_attempts):
+            try:
+                with slots:
+                    result = request(*args, **kwargs)
+                break
+            except Exception as e:
+                # OFC they couldn't raise proper exceptions.
+                # this exceptions is a "generic" exception.
+                if fatal is not None and fatal(e):
+                    raise
+
+                if attempt == self._max_attempts - 1:
+                    raise RuntimeError(
+                        f"{service} request failed after {self._max_attempts} attempts"
+                    ) from e
+
+                delay = min(self._backoff_cap, self._backoff_base * 2**attempt)
+                delay = uniform(delay / 2, delay)
+                logging.error(f"Trying again in {delay:.1f} seconds...")
+                sleep(delay)
+
+        self._instrumentation.count(f"{service}.retries", attempt)
+        return result, attempt + 1
+
+    def _logStats(
+        self,
+        service: str,
+        cached: bool,
+        attempts: int,
+        elapsed: float,
+        size: int = 0,
+    ) -> None:
+        """Records the stats of a request
+
+        Args:
+            service (str): Name of the service
+            cached (bool): Was the response loaded from the cache?
+            attempts (int): Number of attempts
+            elapsed (float): Time spent, in seconds
+            size (int, optional): Size of the response, in bytes. Defaults to 0.
+        """
+        self._instrumentation.record(
+            "request",
+            service=service,
+            cached=cached,
+            attempts=attempts,
+            elapsed=elapsed,
+            bytes=size,
+        )
+        self._instrumentation.count(f"{service}.requests")
+        self._instrumentation.count(f"{service}.bytes", size)
+        self._instrumentation.addTime(f"{service}.latency", elapsed)
+
+    def _queryNominatim(self) -> NominatimResults:
+        """Query Nominatim for the city, using the cache if possible
+
+        Returns:
+            NominatimResults
+        """
+        key = self._cache.key("nominatim", self._city)
+        data = self._cache.get(key)
+
+        if data is not None:
+            self._logStats("nominatim", True, 0, 0, self._cachedSize(key))
+            return NominatimResults(data, "search", {"q": self._city})
+
+        started = perf_counter()
+        city_query, attempts = self._retry(
+            "nominatim",
+            self._nominatim_slots,
+            self._nominatim.query,
             self._city,
             timeout=self._timeout,
         )
+        elapsed = perf_counter() - started
+
+        self._cache.set(key, city_query.toJSON())
+        self._logStats("nominatim", False, attempts, elapsed, self._cachedSize(key))
+        return city_query
+
+    def _queryOverpass(self, query: str, topology: list[str]) -> Iterator[dict]:
+        """Query Overpass, using the cache if possible.
+        Failed requests are tried again with exponential backoff.
+        Responses are always read back from the cache, parsed incrementally
+        one element at a time, so that fresh ones aren't kept in memory.
+
+        Args:
+            query (str): Overpass query
+            topology (list[str]): Element topology
+
+        Returns:
+            Iterator[dict]: raw JSON elements
+        """
+        key = self._overpassKey(query, topology)
+        elements = self._cache.iterate(key, "elements")
+
+        if elements is not None:
+            self._logStats("overpass", True, 0, 0, self._cachedSize(key))
+            return elements
+
+        started = perf_counter()
+        results, attempts = self._retry(
+            "overpass", self._overpass_slots, self._fetchOverpass, query, fatal=self._isTimeout
+        )
+        elapsed = perf_counter() - started
+
+        data = results.toJSON()
+        del results
+        self._cache.set(key, data)
+        self._logStats("overpass", False, attempts, elapsed, self._cachedSize(key))
+
+        elements = self._cache.iterate(key, "elements")
+        if elements is None:
+            # evicted right away, by a cache smaller than the response
+            return iter(data.get("elements") or [])
+
+        return elements
+
+    def _fetchOverpass(self, query: str) -> OverpassResult:
+        """Performs an Overpass query, checking the remark of the response.
+        The server answers the queries exceeding its limits with a successful
+        response, whose remark tells what went wrong.
+
+        Args:
+            query (str): Overpass query
+
+        Raises:
+            OverpassTimeout: the query exceeded the time or memory limits of the server
+            RuntimeError: the server reported any other error
+
+        Returns:
+            OverpassResult
+        """
+        results = self._overpass.query(query, timeout=self._timeout)
+
+        remark = results.remark()
+        if remark and OVERPASS_TIMEOUT_REMARK.search(remark):
+            raise OverpassTimeout(remark)
+        if remark and "error" in remark:
+            raise RuntimeError(f"Overpass error: {remark}")
+
+        return results
+
+    def _overpassKey(self, query: str, topology: list[str]) -> str:
+        """Returns the cache key of an Overpass query
+
+        Args:
+            query (str): Overpass query
+            topology (list[str]): Element topology
+
+        Returns:
+            str
+        """
+        return self._cache.key("overpass", query, self._bbox, topology)
+
+    def _isTimeout(self, error: Exception) -> bool:
+        """Tells if a request failed because the query was too heavy for the server,
+        in which case trying it again is pointless.
+        Only the error types and the HTTP status are looked at: error messages
+        contain the query itself, whose settings mention the timeout.
+
+        Args:
+            error (Exception)
+
+        Returns:
+            bool
+        """
+        # OSMPythonTools wraps the original error in the arguments of a generic one
+        pending, errors = [error], []
+        while pending:
+            e = pending.pop()
+            if isinstance(e, BaseException) and e not in errors:
+                errors.append(e)
+                pending.extend((e.__cause__, e.__context__, *e.args))
+
+        for e in errors:
+            if isinstance(e, (OverpassTimeout, TimeoutError)):
+                return True
+            if isinstance(e, HTTPError) and e.code == 504:
+                return True
+            if isinstance(e, URLError) and isinstance(e.reason, TimeoutError):
+                return True
+
+        return False
+
+    def _cachedSize(self, key: str) -> int:
+        """Returns the size of a cached response, used as the size of the response itself
+
+        Args:
+            key (str)
+
+        Returns:
+            int: size in bytes, 0 if the entry is missing
+        """
+        try:
+            return os.path.getsize(self._cache.path(key))
+        except OSError:
+            return 0
+
+    def loadCity(self) -> None:
+        """Loads city area id and bounding box (both in xy and coordinates forms)"""
+        city_query = self._queryNominatim()
         # city area id
         self._area_id = city_query.areaId()
         # bounding box
@@ -95,151 +534,728 @@ class CityMap:
             float(raw_bbox[3]),
         )
 
-    def _coordsToXY(self, lat: float, lon: float) -> tuple[float, float]:
-        """Calculates points x and y coordinates according to its latitude and longitude
+    def _coordsToXY(
+        self, lat: float | np.ndarray, lon: float | np.ndarray
+    ) -> tuple[float, float] | tuple[np.ndarray, np.ndarray]:
+        """Calculates points x and y coordinates according to its latitude and longitude.
+        Works both on single points and on arrays of points.
 
         Args:
-            lat (float)
-            lon (float)
+            lat (float | np.ndarray)
+            lon (float | np.ndarray)
 
         Returns:
-            tuple[float, float]: x, y coordinates
+            tuple[float, float] | tuple[np.ndarray, np.ndarray]: x, y coordinates
         """
         x = (lat - self._bbox[0]) / (self._bbox[2] - self._bbox[0])
         y = (lon - self._bbox[1]) / (self._bbox[3] - self._bbox[1])
 
         return x, y
 
-    def _isPositionValid(self, *_) -> bool:
+    def _isPositionValid(
+        self, lat: float | np.ndarray, lon: float | np.ndarray
+    ) -> bool | np.ndarray:
         """Is the provided position valid?
         Let's just say that the position is valid. The actual check is delegated to the subclasses.
 
+        Args:
+            lat (float | np.ndarray)
+            lon (float | np.ndarray)
+
         Returns:
-            bool:
+            bool | np.ndarray: one value for each point
         """
-        return True
+        return np.ones(np.shape(lat), dtype=bool)
 
-    def _queryOSM(self, **kwargs) -> None:
-        """Query OSM and load data into self._elements_dict
+    def _selectorFilter(self, selector: str) -> tuple[str, str | None]:
+        """Splits a tag selector into its key and (optional) value, see parseSelector
 
-        Keyword args:
-            name (str): Element type.
-            tag (str): Element tag.
-            topology (str): Element topology.
+        Args:
+            selector (str): Tag selector
+
+        Raises:
+            ValueError: unsupported selector
+
+        Returns:
+            tuple[str, str | None]: key, value
+        """
+        return parseSelector(selector)
+
+    def _elementTypes(self, topology: list[str]) -> set[str]:
+        """Returns the type of the elements returned by Overpass for a given topology
+
+        Args:
+            topology (list[str]): Element topology.
+
+        Returns:
+            set[str]
+        """
+        if "node" in topology:
+            return {"node"}
+        elif any(t in ["way", "area"] for t in topology):
+            return {"way"}
+
+        return set()
+
+    def _planQueries(self) -> list[list[dict]]:
+        """Merges the tags of all the features into as few union queries as possible.
+        Each query contains at most self._max_union_size statements.
+
+        Returns:
+            list[list[dict]]: features of each query
+        """
+        plan = []
+        size = 0
+        features = []
+
+        for feature in self._features_list:
+            feature_size = len(feature["tag"]) * len(feature["topology"])
+
+            if features and size + feature_size > self._max_union_size:
+                plan.append(features)
+                size, features = 0, []
+
+            size += feature_size
+            features.append(feature)
+
+        if features:
+            plan.append(features)
+
+        return plan
+
+    def _unionQuery(
+        self, features: list[dict], bbox: tuple[float, ...], out: str = "body geom"
+    ) -> str:
+        """Returns the union query of the tags of a set of features, inside a bounding box
+
+        Args:
+            features (list[dict]): Features in the query
+            bbox (tuple[float, ...]): Bounding box (south, west, north, east)
+            out (str, optional): Output mode, "count" to only count the elements.
+                Defaults to "body geom".
+
+        Returns:
+            str
+        """
+        bbox = ",".join(str(b) for b in bbox)
+        statements = [
+            f"{topology}[{t}]({bbox});"
+            for feature in features
+            for t in feature["tag"]
+            for topology in feature["topology"]
+        ]
+        return f"({''.join(statements)}); out {out};"
+
+    def _splitBBox(self, bbox: tuple[float, ...]) -> list[tuple[float, ...]]:
+        """Splits a bounding box in four quadrants
+
+        Args:
+            bbox (tuple[float, ...]): Bounding box (south, west, north, east)
+
+        Returns:
+            list[tuple[float, ...]]: south west, south east, north west and north east quadrants
+        """
+        south, west, north, east = bbox
+        lat, lon = (south + north) / 2, (west + east) / 2
+        return [
+            (south, west, lat, lon),
+            (south, lon, lat, east),
+            (lat, west, north, lon),
+            (lat, lon, north, east),
+        ]
+
+    def _countElements(
+        self, features: list[dict], bbox: tuple[float, ...], topology: list[str]
+    ) -> int:
+        """Counts the elements of a union query, without downloading them.
+        Counting a large area can time out as well: a timed out count is reported
+        as over budget, so that the tile gets split.
+
+        Args:
+            features (list[dict]): Features in the query
+            bbox (tuple[float, ...]): Bounding box
+            topology (list[str]): Element topology
+
+        Raises:
+            Exception: the count failed for any other reason than a timeout
+
+        Returns:
+            int
+        """
+        query = self._unionQuery(features, bbox, "count")
+        try:
+            counts = [
+                e for e in self._queryOverpass(query, topology) if e["type"] == "count"
+            ]
+        except Exception as e:
+            if not self._isTimeout(e):
+                raise
+
+            logging.warning(f"Count of tile {bbox} timed out, splitting it")
+            self._instrumentation.count("overpass.count_timeouts")
+            return self._max_elements + 1
+
+        return sum(int(c["tags"]["total"]) for c in counts)
+
+    def _planTiles(
+        self, features: list[dict], topology: list[str]
+    ) -> list[tuple[tuple[float, ...], int]]:
+        """Splits the bounding box in a quadtree of tiles, so that each one contains
+        at most self._max_elements elements. Tiles of each level are counted concurrently.
+
+        Args:
+            features (list[dict]): Features in the query
+            topology (list[str]): Element topology
+
+        Returns:
+            list[tuple[tuple[float, ...], int]]: bounding box and depth of each tile,
+                in quadtree order
+        """
+        root = tuple(self._bbox)
+
+        # responses cached as a whole don't need to be counted
+        key = self._overpassKey(self._unionQuery(features, root), topology)
+        if os.path.exists(self._cache.path(key)):
+            return [(root, 0)]
+
+        # neither do the ones already split, including the tiles split after a timeout
+        plan = self._cache.get(self._tilesKey(features, topology))
+        if plan is not None:
+            return [(tuple(bbox), depth) for bbox, depth in plan]
+
+        tiles = []
+        # bounding box, depth and path in the quadtree of each tile to be counted
+        level = [(root, 0, "")]
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while level:
+                counts = executor.map(
+                    lambda tile: self._countElements(features, tile[0], topology), level
+                )
+                children = []
+                for (bbox, depth, path), count in zip(level, counts):
+                    if count > self._max_elements and depth < self._max_depth:
+                        children.extend(
+                            (quadrant, depth + 1, path + str(i))
+                            for i, quadrant in enumerate(self._splitBBox(bbox))
+                        )
+                    else:
+                        tiles.append((path, bbox, depth))
+
+                level = children
+
+        return [(bbox, depth) for _, bbox, depth in sorted(tiles)]
+
+    def _tilesKey(self, features: list[dict], topology: list[str]) -> str:
+        """Returns the cache key of the tiles a union query was split in
+
+        Args:
+            features (list[dict]): Features in the query
+            topology (list[str]): Element topology
+
+        Returns:
+            str
+        """
+        query = self._unionQuery(features, self._bbox)
+        return self._cache.key("overpass-tiles", query, self._bbox, topology)
+
+    def _queryOSM(self, features: list[dict]) -> None:
+        """Query OSM and load data into self._elements_dict.
+        The bounding box is split in tiles (see self._planTiles) fetched concurrently,
+        at most self._max_tiles_in_flight at a time,
+        and tiles whose query times out are split again.
+        Elements are consumed in tile order, skipping the ones already returned by another tile,
+        and assigned to every feature whose tags they match.
+        Their coordinates are appended to flat buffers as soon as they are parsed,
+        so that no element is kept in memory.
+
+        Args:
+            features (list[dict]): Features contained in the query, as planned by self._planQueries
+
+        Raises:
+            ValueError: the bounding box is not loaded
         """
 
         if not self._bbox:
             raise ValueError("Bounding Box not loaded.")
 
-        self._elements_dict[kwargs["name"]] = []
-
-        for t in kwargs["tag"]:
-            query = overpassQueryBuilder(
-                bbox=self._bbox,
-                selector=t,
-                elementType=kwargs["topology"],
-                includeGeometry=True,
+        for feature in features:
+            self._elements_dict[feature["name"]] = {
+                "count": 0,
+                "lat": array("d"),
+                "lon": array("d"),
+                # number of vertices of each ring, None for nodes
+                "sizes": None if "node" in feature["topology"] else array("q"),
+            }
+
+        topology = sorted({t for f in features for t in f["topology"]})
+
+        # features interested in each tag key: those accepting any value,
+        # and those accepting each specific value (including the former ones)
+        matchers = {}
+        for feature in features:
+            target = (
+                self._elements_dict[feature["name"]],
+                self._elementTypes(feature["topology"]),
             )
-
-            while True:
+            for selector in feature["tag"]:
+                key, value = self._selectorFilter(selector)
+                any_value, by_value = matchers.setdefault(key, ([], {}))
+                if value is None:
+                    any_value.append(target)
+                else:
+                    by_value.setdefault(value, []).append(target)
+
+        for any_value, by_value in matchers.values():
+            for targets in by_value.values():
+                targets.extend(any_value)
+
+        tiles = self._planTiles(features, topology)
+        # elements crossing the border of a tile are returned by both tiles
+        seen = set() if len(tiles) > 1 else None
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+
+            def fetch(bbox: tuple[float, ...], depth: int) -> tuple:
+                query = self._unionQuery(features, bbox)
+                future = executor.submit(self._queryOverpass, query, topology)
+                return bbox, depth, future
+
+            # tiles are submitted a few at a time, so that the ones fetched
+            # but not consumed yet don't pile up
+            queued = deque(tiles)
+            pending = deque()
+            self._instrumentation.count("overpass.tiles", len(tiles))
+            fetched = []
+
+            while queued or pending:
+                while queued and len(pending) < self._max_tiles_in_flight:
+                    pending.append(fetch(*queued.popleft()))
+
+                bbox, depth, future = pending.popleft()
                 try:
-                    results = self._overpass.query(
-                        query,
-                        timeout=self._timeout,
+                    elements = future.result()
+                except Exception as e:
+                    if not self._isTimeout(e) or depth >= self._max_depth:
+                        raise
+
+                    logging.warning(f"Query of tile {bbox} timed out, splitting it")
+                    pending.extendleft(
+                        reversed([fetch(q, depth + 1) for q in self._splitBBox(bbox)])
                     )
-                    break
-                except Exception as _:
-                    # OFC they couldn't raise proper exceptions.
-                    # this exceptions is a "generic" exception.
-                    logging.error(f"Trying again in {self._try_again} seconds...")
-                    sleep(self._try_again)
-
-            if not results.elements():
+                    seen = set() if seen is None else seen
+                    self._instrumentation.count("overpass.tiles", 3)
+                    continue
+
+                fetched.append((bbox, depth))
+
+                for element in elements:
+                    if seen is not None:
+                        element_id = (element["type"], element["id"])
+                        if element_id in seen:
+                            self._instrumentation.count("overpass.duplicates")
+                            continue
+                        seen.add(element_id)
+
+                    self._matchElement(element, matchers)
+
+        if len(fetched) > 1:
+            self._cache.set(self._tilesKey(features, topology), fetched)
+
+    def _matchElement(self, element: dict, matchers: dict) -> None:
+        """Appends an element to the buffers of all the features whose tags it matches
+
+        Args:
+            element (dict): Raw JSON element
+            matchers (dict): Features interested in each tag key, as built by self._queryOSM
+        """
+        tags = element.get("tags")
+        if not tags:
+            return
+
+        # each feature gets an element once, even if it matches multiple tags
+        matched = {}
+        for key, value in tags.items():
+            matcher = matchers.get(key)
+            if matcher is None:
                 continue
 
-            if "node" in kwargs["topology"]:
-                self._elements_dict[kwargs["name"]].extend(results.nodes())
-            elif any(t in ["way", "area"] for t in kwargs["topology"]):
-                self._elements_dict[kwargs["name"]].extend(results.ways())
+            for buffers, types in matcher[1].get(value, matcher[0]):
+                if element["type"] in types:
+                    matched[id(buffers)] = buffers
+
+        for buffers in matched.values():
+            self._appendElement(buffers, element)
+
+    def _appendElement(self, buffers: dict, element: dict) -> None:
+        """Appends the coordinates of a raw element to the buffers of a feature.
+        Only closed ways make a ring, as open ones can't be drawn as polygons.
 
-    def _rotateCoordinates(self, coords: list[tuple[float, float]], angle: float = -90):
+        Args:
+            buffers (dict): Feature buffers, as created by self._queryOSM
+            element (dict): Raw JSON element
+        """
+        buffers["count"] += 1
+
+        if buffers["sizes"] is None:
+            buffers["lat"].append(float(element["lat"]))
+            buffers["lon"].append(float(element["lon"]))
+            return
+
+        geometry = element.get("geometry") or []
+        if len(geometry) < 2 or geometry[0] != geometry[-1]:
+            return
+
+        # ways used to be converted to GeoJSON, keep its precision of 6 decimals
+        buffers["lat"].extend(round(p["lat"], 6) for p in geometry)
+        buffers["lon"].extend(round(p["lon"], 6) for p in geometry)
+        buffers["sizes"].append(len(geometry))
+
+    def _rotateCoordinates(self, coords: np.ndarray, angle: float = -90) -> np.ndarray:
         """Rotates each coordinates around its center
 
         Args:
-            coords (list[tuple[float, float]]): List of normalized coordinates
+            coords (np.ndarray): Nx2 array of normalized coordinates
             angle (float, optional): Rotation angle. Defaults to -90.
 
         Returns:
-            [type]: [description]
+            np.ndarray: Nx2 array of rotated coordinates
         """
         c = cos(radians(angle))
         s = sin(radians(angle))
+        rotation = np.array([[c, s], [-s, c]])
+
+        return (coords - 0.5) @ rotation + 0.5
+
+    def _elementsToArrays(
+        self, name: str, topology: list[str]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+        """Returns the coordinate buffers of a feature as arrays, without copying them
+
+        Args:
+            name (str): Element type.
+            topology (list[str]): Element topology.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray | None]: latitudes, longitudes and
+                ring offsets (None for nodes)
+        """
+        buffers = self._elements_dict[name]
+        lat = np.frombuffer(buffers["lat"], dtype=float)
+        lon = np.frombuffer(buffers["lon"], dtype=float)
 
-        translated = [tuple(s - 0.5 for s in t) for t in coords]
-        rotated = [(x * c - y * s, x * s + y * c) for x, y in translated]
-        return [tuple(s + 0.5 for s in t) for t in rotated]
+        if buffers["sizes"] is None:
+            return lat, lon, None
+
+        sizes = np.frombuffer(buffers["sizes"], dtype=np.int64)
+        return lat, lon, np.concatenate(([0], np.cumsum(sizes)))
+
+    def _clipRings(
+        self, lat: np.ndarray, lon: np.ndarray, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Removes the invalid vertices of each ring, then drops the rings left
+        with less than 3 vertices
+
+        Args:
+            lat (np.ndarray): Latitude of each vertex
+            lon (np.ndarray): Longitude of each vertex
+            offsets (np.ndarray): Ring offsets
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: latitudes, longitudes and offsets
+                of the remaining rings
+        """
+        valid = self._isPositionValid(lat, lon)
+
+        # number of valid vertices in each ring
+        valid_before = np.concatenate(([0], np.cumsum(valid)))[offsets]
+        counts = np.diff(valid_before)
+        # sometimes the coords list might be empty
+        keep = counts >= 3
+        valid &= np.repeat(keep, np.diff(offsets))
+
+        offsets = np.concatenate(([0], np.cumsum(counts[keep])))
+        return lat[valid], lon[valid], offsets
 
     def _normalizeElements(self, **kwargs) -> None:
         """Creates an entry in self._normalized_dict for a set of positions in self._elements_dict.
-        The resulting coordinates are a list of (x, y) tuples in range [0, 1]x[0, 1], relative to
+        The resulting coordinates are a Geometry of (x, y) points in range [0, 1]x[0, 1], relative to
         the bounding box of the coordinates themselves.
+        Filtering, projection and rotation are performed at once on all the vertices of the feature.
 
         Keyword args:
             name (str): Element type.
             tag (str): Element tag.
             topology (str): Element topology.
         """
-        if "node" in kwargs["topology"]:
-            coords = [
-                self._coordsToXY(e.lat(), e.lon())
-                for e in self._elements_dict[kwargs["name"]]
-                if self._isPositionValid(e.lat(), e.lon())
+        if "node" not in kwargs["topology"] and not any(
+            t in ["way", "area"] for t in kwargs["topology"]
+        ):
+            return
+
+        name = kwargs["name"]
+        with self._instrumentation.timer(f"normalize.{name}"):
+            self._normalizeArrays(name, kwargs["topology"])
+
+    def _normalizeArrays(self, name: str, topology: list[str]) -> None:
+        """Filters, projects and rotates the vertices of a feature, see _normalizeElements
+
+        Args:
+            name (str): Element type.
+            topology (list[str]): Element topology.
+        """
+        lat, lon, offsets = self._elementsToArrays(name, topology)
+
+        self._instrumentation.count(f"{name}.elements", self._elements_dict[name]["count"])
+        self._instrumentation.count(f"{name}.vertices", len(lat))
+
+        if offsets is not None:
+            self._instrumentation.count(f"{name}.rings", len(offsets) - 1)
+            lat, lon, offsets = self._clipRings(lat, lon, offsets)
+            self._instrumentation.count(f"{name}.valid_rings", len(offsets) - 1)
+        else:
+            # features without any valid vertex are kept as well, empty
+            valid = self._isPositionValid(lat, lon)
+            lat, lon = lat[valid], lon[valid]
+
+        self._instrumentation.count(f"{name}.valid_vertices", len(lat))
+
+        # convert to xy and rotate
+        coords = np.column_stack(self._coordsToXY(lat, lon))
+        rotated = self._rotateCoordinates(coords)
+
+        # add to dictionary
+        self._normalized_dict[name] = Geometry(
+            rotated.astype(self._dtype, copy=False),
+            offsets,
+            {"name": name, "topology": topology},
+        )
+
+    def loadFeatures(self) -> None:
+        """Loads and normalize all features. Queries are fetched concurrently."""
+        with self._instrumentation.timer("fetch"), ThreadPoolExecutor(
+            max_workers=self._max_workers
+        ) as executor:
+            futures = [
+                executor.submit(self._queryOSM, features)
+                for features in self._planQueries()
             ]
+            # propagate exceptions raised in the workers
+            for f in futures:
+                f.result()
 
-            if not coords:
-                return
+        with self._instrumentation.profile("normalize"):
+            for feature in self._features_list:
+                self._normalizeElements(**feature)
 
-            # rotate coordinates
-            rotated = self._rotateCoordinates(coords)
-            # add to dictionary
-            self._normalized_dict[kwargs["name"]] = rotated
+        # coordinates now live in the normalized geometry only
+        self._elements_dict.clear()
 
-        elif any(t in ["way", "area"] for t in kwargs["topology"]):
-            self._normalized_dict[kwargs["name"]] = []
+    def snapshotKey(self) -> str:
+        """Returns the key of the snapshots of the map: a hash of everything the
+        queries depend on (kind of map, city, radius and feature definitions)
 
-            for element in self._elements_dict[kwargs["name"]]:
-                for shape in element.geometry()["coordinates"]:
-                    # sometimes shape are just an element
-                    if len(shape) == 1:
-                        shape = shape[0]
+        Returns:
+            str
+        """
+        return self._cache.key(
+            "snapshot",
+            type(self).__name__,
+            self._city,
+            getattr(self, "_radius", None),
+            self._features_list,
+            np.dtype(self._dtype).str,
+        )
 
-                    # filter coords and convert to xy
-                    # sometimes coords are not lists? I don't understand why
-                    coords = [
-                        self._coordsToXY(*s[::-1])
-                        for s in shape
-                        if isinstance(s, list) and self._isPositionValid(*s[::-1])
-                    ]
+    def isSnapshotValid(self, filename: str) -> bool:
+        """Tells if a snapshot can be loaded instead of querying OSM again: it must exist,
+        have been saved by a map with the same key and be younger than the cache entries
 
-                    # sometimes the coords list might be empty
-                    if len(coords) < 3:
-                        continue
+        Args:
+            filename (str)
 
-                    # rotate coordinates
-                    rotated = self._rotateCoordinates(coords)
-                    # add to dictionary
-                    self._normalized_dict[kwargs["name"]].append(rotated)
+        Returns:
+            bool
+        """
+        try:
+            header, _ = readSnapshot(filename)
+        except (OSError, ValueError):
+            return False
+
+        return (
+            header.get("key") == self.snapshotKey()
+            and time() - header.get("created", 0) <= self._cache.ttl
+        )
 
-    def loadFeatures(self) -> None:
-        """Loads and normalize all features."""
-        for feature in self._features_list:
-            self._queryOSM(**feature)
-            self._normalizeElements(**feature)
+    def saveSnapshot(self, filename: str) -> None:
+        """Saves the normalized features in a binary snapshot, which can be opened
+        by loadSnapshot (or readSnapshot) without copying the arrays
+
+        Args:
+            filename (str)
+        """
+        header = {
+            "type": type(self).__name__,
+            "key": self.snapshotKey(),
+            "created": time(),
+            "city": self._city,
+            "bbox": list(self._bbox),
+            "center": getattr(self, "_city_center", None),
+            "radius": getattr(self, "_radius", None),
+            "features": [],
+        }
+
+        arrays = []
+        size = 0
+        for name, geometry in self._normalized_dict.items():
+            entry = {
+                "name": name,
+                "topology": geometry.metadata.get("topology"),
+                "color": self._features[name].get("color") if name in self._features else None,
+            }
+            for key, data in (("coords", geometry.coords), ("offsets", geometry.offsets)):
+                if data is None:
+                    entry[key] = None
+                    continue
+
+                size = -(-size // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+                entry[key] = {"dtype": data.dtype.str, "shape": data.shape, "offset": size}
+                arrays.append((size, data))
+                size += data.nbytes
+
+            header["features"].append(entry)
+
+        raw = json.dumps(header).encode("utf-8")
+        start = _snapshotStart(len(raw))
+
+        # write to a temporary file first, so that readers never see partial snapshots
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(raw)))
+            f.write(raw)
+            for offset, data in arrays:
+                f.seek(start + offset)
+                f.write(np.ascontiguousarray(data).data)
+        os.replace(tmp, filename)
+
+    def loadSnapshot(self, filename: str) -> None:
+        """Loads city and features from a snapshot saved by saveSnapshot, instead of
+        calling loadCity and loadFeatures. Coordinates are memory mapped, so maps opened
+        by multiple processes share the same memory.
+
+        Args:
+            filename (str)
+
+        Raises:
+            ValueError: the snapshot belongs to a different kind of map, or was saved with
+                different query parameters (radius, feature definitions...), or it expired
+        """
+        header, geometry = readSnapshot(filename)
+
+        if header["type"] != type(self).__name__:
+            raise ValueError(f"Snapshot {filename} contains a {header['type']}")
+        if header["radius"] != getattr(self, "_radius", None):
+            raise ValueError(f"Snapshot {filename} has radius {header['radius']}")
+        if header.get("key") != self.snapshotKey():
+            raise ValueError(f"Snapshot {filename} was saved with different query parameters")
+        if time() - header.get("created", 0) > self._cache.ttl:
+            raise ValueError(f"Snapshot {filename} expired")
+
+        self._bbox = tuple(header["bbox"])
+        if header["center"] is not None:
+            self._city_center = tuple(header["center"])
+            self._city_center_rad = tuple(radians(x) for x in self._city_center)
+
+        self._normalized_dict = geometry
+
+
+def loadMaps(maps: list[CityMap], max_workers: int = 4) -> None:
+    """Loads cities and features of multiple maps concurrently.
+    Requests are still limited by the slots shared by all the maps.
+
+    Args:
+        maps (list[CityMap]): Maps to be loaded
+        max_workers (int, optional): Number of maps loaded concurrently. Defaults to 4.
+    """
+
+    def load(m: CityMap) -> None:
+        m.loadCity()
+        m.loadFeatures()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for f in [executor.submit(load, m) for m in maps]:
+            f.result()
+
+
+def _snapshotStart(header_size: int) -> int:
+    """Returns the position of the first array in a snapshot
+
+    Args:
+        header_size (int): Size of the JSON header, in bytes
+
+    Returns:
+        int
+    """
+    size = _SNAPSHOT_PREAMBLE.size + header_size
+    return -(-size // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+
+
+def readSnapshot(filename: str) -> tuple[dict, dict[str, Geometry]]:
+    """Opens a snapshot saved by CityMap.saveSnapshot.
+    Arrays are read only views of the memory mapped file, nothing is copied.
+
+    Args:
+        filename (str)
+
+    Raises:
+        ValueError: the file is not a snapshot, or it has a different version
+
+    Returns:
+        tuple[dict, dict[str, Geometry]]: header (type, key, creation time, city, bbox,
+            center, radius and features), geometry of each feature
+    """
+    with open(filename, "rb") as f:
+        preamble = f.read(_SNAPSHOT_PREAMBLE.size)
+        if len(preamble) < _SNAPSHOT_PREAMBLE.size:
+            raise ValueError(f"{filename} is not a snapshot")
+
+        magic, version, header_size = _SNAPSHOT_PREAMBLE.unpack(preamble)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{filename} is not a snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot {filename} has unsupported version {version}")
+
+        header = json.loads(f.read(header_size))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    start = _snapshotStart(header_size)
+
+    def view(entry: dict | None) -> np.ndarray | None:
+        if entry is None:
+            return None
+
+        count = int(np.prod(entry["shape"]))
+        if not count:
+            return np.empty(entry["shape"], dtype=entry["dtype"])
+
+        data = np.frombuffer(
+            mapped, dtype=entry["dtype"], count=count, offset=start + entry["offset"]
+        )
+        return data.reshape(entry["shape"])
+
+    geometry = {
+        entry["name"]: Geometry(
+            view(entry["coords"]),
+            view(entry["offsets"]),
+            {"name": entry["name"], "topology": entry["topology"]},
+        )
+        for entry in header["features"]
+    }
+    return header, geometry
 
 
 class MinimalMap(CityMap):
-    def __init__(self, city: str):
-        super().__init__(city)
+    def __init__(self, city: str, **kwargs):
+        super().__init__(city, **kwargs)
         self._features_list = [
             {
                 "name": "benches",
@@ -285,38 +1301,46 @@ class MinimalMap(CityMap):
             },
         ]
 
-    def _isPositionValid(self, *_) -> bool:
+    def _isPositionValid(
+        self, lat: float | np.ndarray, lon: float | np.ndarray
+    ) -> bool | np.ndarray:
         """
         All positions are valid in the minimal map. There's no need to check if they are in bbox.
         This is redundant and probably unnecessary, but I wouldn't know how to change this."""
-        return True
+        return np.ones(np.shape(lat), dtype=bool)
 
-    def getColor(self, feature: str) -> str:
+    def getColor(self, feature: str) -> str | None:
         """Returns color relative to feature.
 
         Args:
             feature (str): Feature in class
 
+        Raises:
+            ValueError: the feature is not defined
+
         Returns:
-            str: Feature color¨
+            str | None: Feature color, None if the feature has no color
         """
-        for f in self._features_list:
-            if f["name"] == feature:
-                return f.get("color")
-        return None
+        if feature not in self._features:
+            raise ValueError(f"Unknown feature {feature}")
+
+        return self._features[feature].get("color")
 
 
 class RoundCityMap(CityMap):
-    def __init__(self, city: str, radius: float = 3000):
+    def __init__(self, city: str, radius: float = 3000, **kwargs):
         """Creates a round city
 
         Args:
             city (str): Name of the city
             radius (float, optional): City radius. Defaults to 3000.
+            **kwargs: Cache and backends, as in CityMap
         """
-        super().__init__(city)
+        super().__init__(city, **kwargs)
 
         self._radius = radius
+        # sides of the polygon approximating the circle, when clipping rings
+        self._clip_sides = 256
         self._features_list = [
             {
                 "name": "trees",
@@ -357,10 +1381,7 @@ class RoundCityMap(CityMap):
 
     def loadCity(self) -> None:
         """Loads city area id and bounding box (both in xy and coordinates forms)"""
-        city_query = self._nominatim.query(
-            self._city,
-            timeout=self._timeout,
-        )
+        city_query = self._queryNominatim()
         # city area id
         self._area_id = city_query.areaId()
         # city center cords
@@ -378,6 +1399,8 @@ class RoundCityMap(CityMap):
         km_lat, km_lon = 110.574235, 110.572833 * cos(r_lat)
         d_lat = self._radius / 1000 / km_lat
         d_lon = self._radius / 1000 / km_lon
+        # meters per degree, around the city center
+        self._meters_per_degree = (km_lat * 1000, km_lon * 1000)
 
         self._bbox = (
             self._city_center[0] - d_lat,
@@ -386,39 +1409,225 @@ class RoundCityMap(CityMap):
             self._city_center[1] + d_lon,
         )
 
-    def _distFromCityCenter(self, lat: float, lon: float) -> float:
-        """Returns distance between a point and the city center coordinates
+    def _distFromCityCenter(
+        self, lat: float | np.ndarray, lon: float | np.ndarray
+    ) -> float | np.ndarray:
+        """Returns distance between points and the city center coordinates
 
         Args:
-            lat (float)
-            lon (float)
+            lat (float | np.ndarray)
+            lon (float | np.ndarray)
 
         Returns:
-            float: distance in meters
+            float | np.ndarray: distance in meters
         """
         R = 6371
-        r_lat, r_lon = radians(lat), radians(lon)
+        r_lat, r_lon = np.radians(lat), np.radians(lon)
         d_lat, d_lon = (
             r_lat - self._city_center_rad[0],
             r_lon - self._city_center_rad[1],
         )
 
         a = (
-            sin(d_lat / 2) ** 2
-            + cos(r_lat) * cos(self._city_center_rad[0]) * sin(d_lon / 2) ** 2
+            np.sin(d_lat / 2) ** 2
+            + np.cos(r_lat) * cos(self._city_center_rad[0]) * np.sin(d_lon / 2) ** 2
         )
-        c = 2 * asin(sqrt(a))
+        c = 2 * np.arcsin(np.sqrt(a))
 
         return R * c * 1000  # meters
 
-    def _isPositionValid(self, lat: float, lon: float) -> bool:
-        """Checks whether the given point is indide the circle radius
+    def _isPositionValid(
+        self, lat: float | np.ndarray, lon: float | np.ndarray
+    ) -> bool | np.ndarray:
+        """Checks whether the given points are inside the circle radius
 
         Args:
-            lat (float): longitude of the point
-            lon (float): latitude of the point
+            lat (float | np.ndarray): latitude of the points
+            lon (float | np.ndarray): longitude of the points
 
         Returns:
-            bool
+            bool | np.ndarray
         """
         return self._distFromCityCenter(lat, lon) < self._radius
+
+    def _clipRings(
+        self, lat: np.ndarray, lon: np.ndarray, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Clips the rings to the circle.
+        Rings whose bounding box is entirely inside the circle are kept as they are,
+        the ones entirely outside are dropped, and only the ones crossing the border
+        are clipped vertex by vertex against a polygon approximating the circle.
+
+        Args:
+            lat (np.ndarray): Latitude of each vertex
+            lon (np.ndarray): Longitude of each vertex
+            offsets (np.ndarray): Ring offsets
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: latitudes, longitudes and offsets
+                of the clipped rings
+        """
+        sizes = np.diff(offsets)
+        x, y = self._toMeters(lat, lon)
+
+        # bounding box of each ring (empty ones are dropped anyway)
+        starts = np.minimum(offsets[:-1], max(len(x) - 1, 0))
+        nonempty = sizes > 0
+        if not nonempty.any():
+            return lat[:0], lon[:0], np.zeros(1, dtype=np.int64)
+
+        min_x, max_x = np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts)
+        min_y, max_y = np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+
+        # distance of the nearest and farthest point of the box from the center
+        near = np.hypot(
+            np.maximum(min_x, np.minimum(0, max_x)),
+            np.maximum(min_y, np.minimum(0, max_y)),
+        )
+        far = np.hypot(
+            np.maximum(np.abs(min_x), np.abs(max_x)),
+            np.maximum(np.abs(min_y), np.abs(max_y)),
+        )
+        # the polygon is inscribed in the circle
+        apothem = self._radius * cos(np.pi / self._clip_sides)
+        inside = nonempty & (far <= apothem) & (sizes >= 3)
+        crossing = nonempty & ~inside & (near < self._radius)
+
+        # rings crossing the border are clipped all together
+        crossing_vertices = np.repeat(crossing, sizes)
+        clipped_x, clipped_y, ids = self._clipVertices(
+            x[crossing_vertices],
+            y[crossing_vertices],
+            np.repeat(np.arange(len(sizes)), sizes)[crossing_vertices],
+        )
+
+        clipped_sizes = np.bincount(ids, minlength=len(sizes))
+        new_sizes = np.where(inside, sizes, np.where(clipped_sizes >= 3, clipped_sizes, 0))
+        new_offsets = np.concatenate(([0], np.cumsum(new_sizes)))
+        out_lat = np.empty(new_offsets[-1])
+        out_lon = np.empty(new_offsets[-1])
+
+        # rings inside the circle are copied as they are
+        copied = np.repeat(inside, sizes)
+        shift = np.repeat((new_offsets[:-1] - offsets[:-1])[inside], sizes[inside])
+        destination = np.flatnonzero(copied) + shift
+        out_lat[destination] = lat[copied]
+        out_lon[destination] = lon[copied]
+
+        # clipped rings are converted back to coordinates
+        kept = new_sizes[ids] > 0
+        clipped_offsets = np.concatenate(([0], np.cumsum(clipped_sizes)))
+        destination = np.arange(len(ids)) - clipped_offsets[ids] + new_offsets[ids]
+        ring_lat, ring_lon = self._toDegrees(clipped_x[kept], clipped_y[kept])
+        out_lat[destination[kept]] = ring_lat
+        out_lon[destination[kept]] = ring_lon
+
+        return out_lat, out_lon, np.concatenate(([0], np.cumsum(new_sizes[new_sizes > 0])))
+
+    def _clipVertices(
+        self, x: np.ndarray, y: np.ndarray, ids: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Clips rings to the polygon approximating the circle (Sutherland-Hodgman).
+        Each ring is only clipped against the sides its vertices lie beyond.
+        All the rings are clipped at once, one side of each ring per round.
+
+        Args:
+            x (np.ndarray): Vertices x, in meters from the city center
+            y (np.ndarray): Vertices y, in meters from the city center
+            ids (np.ndarray): Ring of each vertex. Rings must be contiguous.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: x, y and ring of the clipped vertices.
+                Rings outside the polygon have no vertices left.
+        """
+        sides = self._clip_sides
+        step = 2 * np.pi / sides
+        normals = np.exp(1j * (np.arange(sides) + 0.5) * step)
+        apothem = self._radius * cos(np.pi / sides)
+
+        # sides of the polygon each vertex lies beyond: only those need clipping
+        rho = np.hypot(x, y)
+        beyond = rho > apothem
+        center = np.arctan2(y[beyond], x[beyond]) / step - 0.5
+        spread = np.arccos(apothem / rho[beyond]) / step
+        first_side = np.ceil(center - spread).astype(np.int64)
+        count = np.maximum(np.floor(center + spread).astype(np.int64) - first_side + 1, 0)
+
+        # (ring, side) pairs, sorted by ring
+        rank = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        pairs = np.unique(
+            np.repeat(ids[beyond], count) * sides
+            + (np.repeat(first_side, count) + rank) % sides
+        )
+        pair_ring, pair_side = pairs // sides, pairs % sides
+        # each round clips every ring against one of its sides
+        ring_start = np.concatenate(([True], pair_ring[1:] != pair_ring[:-1]))
+        round_number = np.arange(len(pairs)) - np.maximum.accumulate(
+            np.where(ring_start, np.arange(len(pairs)), 0)
+        )
+
+        rings = int(ids.max()) + 1 if len(ids) else 0
+        for r in range(int(round_number.max()) + 1 if len(pairs) else 0):
+            # every ring may have been dropped in the previous rounds
+            if not len(ids):
+                break
+
+            side = np.full(rings, -1)
+            in_round = round_number == r
+            side[pair_ring[in_round]] = pair_side[in_round]
+
+            vertex_side = side[ids]
+            normal = normals[vertex_side]
+            distance = np.where(
+                vertex_side >= 0, x * normal.real + y * normal.imag - apothem, -1
+            )
+            is_inside = distance <= 0
+
+            # following vertex of each vertex, wrapping around its ring
+            first = np.concatenate(([True], ids[1:] != ids[:-1]))
+            last = np.concatenate((first[1:], [True]))
+            following = np.arange(1, len(ids) + 1)
+            following[last] = np.flatnonzero(first)
+
+            # each edge yields its start, if inside, and the crossing point, if any
+            crossing = is_inside != is_inside[following]
+            t = np.zeros_like(distance)
+            d, d_next = distance[crossing], distance[following][crossing]
+            t[crossing] = d / (d - d_next)
+
+            keep = np.column_stack((is_inside, crossing)).ravel()
+            x = np.column_stack((x, x + t * (x[following] - x))).ravel()[keep]
+            y = np.column_stack((y, y + t * (y[following] - y))).ravel()[keep]
+            ids = np.repeat(ids, 2)[keep]
+
+        return x, y, ids
+
+    def _toMeters(
+        self, lat: np.ndarray, lon: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Projects coordinates to meters from the city center
+
+        Args:
+            lat (np.ndarray)
+            lon (np.ndarray)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: x (east) and y (north) distances
+        """
+        x = (lon - self._city_center[1]) * self._meters_per_degree[1]
+        y = (lat - self._city_center[0]) * self._meters_per_degree[0]
+        return x, y
+
+    def _toDegrees(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Inverse of _toMeters
+
+        Args:
+            x (np.ndarray): east distance from the city center
+            y (np.ndarray): north distance from the city center
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: latitudes and longitudes
+        """
+        lat = self._city_center[0] + y / self._meters_per_degree[0]
+        lon = self._city_center[1] + x / self._meters_per_degree[1]
+        return lat, lon
@@ -0,0 +1,248 @@
+import numpy as np
+
+
+class Geometry:
+    def __init__(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray | None = None,
+        metadata: dict | None = None,
+    ) -> None:
+        """Create a compact geometry container.
+        All the vertices are stored in a single contiguous Nx2 array, while rings
+        are described by their offsets inside the array.
+
+        Args:
+            coords (np.ndarray): Nx2 array of relative coordinates
+            offsets (np.ndarray | None, optional): Ring offsets (M+1 values for M rings).
+                None if the geometry is made of points. Defaults to None.
+            metadata (dict | None, optional): Feature metadata (name, topology...). Defaults to None.
+        """
+        self._coords = np.ascontiguousarray(coords).reshape(-1, 2)
+        self._offsets = None if offsets is None else np.asarray(offsets, dtype=np.int64)
+        self._metadata = metadata if metadata is not None else {}
+
+        # containers are shared between maps and images, don't let anyone touch them
+        self._coords.flags.writeable = False
+        if self._offsets is not None:
+            self._offsets.flags.writeable = False
+
+    @classmethod
+    def empty(
+        cls, polygonal: bool = False, dtype: type = np.float64, metadata: dict = None
+    ) -> "Geometry":
+        """Returns an empty geometry
+
+        Args:
+            polygonal (bool, optional): Is the geometry made of rings? Defaults to False.
+            dtype (type, optional): Coordinates type. Defaults to np.float64.
+            metadata (dict, optional): Feature metadata. Defaults to None.
+
+        Returns:
+            Geometry
+        """
+        offsets = np.zeros(1, dtype=np.int64) if polygonal else None
+        return cls(np.empty((0, 2), dtype=dtype), offsets, metadata)
+
+    @property
+    def coords(self) -> np.ndarray:
+        """Returns the (read only) Nx2 array of all the vertices
+
+        Returns:
+            np.ndarray
+        """
+        return self._coords
+
+    @property
+    def offsets(self) -> np.ndarray | None:
+        """Returns the (read only) ring offsets, None for points
+
+        Returns:
+            np.ndarray | None
+        """
+        return self._offsets
+
+    @property
+    def metadata(self) -> dict:
+        """Returns the feature metadata
+
+        Returns:
+            dict
+        """
+        return self._metadata
+
+    @property
+    def polygonal(self) -> bool:
+        """Is the geometry made of rings?
+
+        Returns:
+            bool
+        """
+        return self._offsets is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the memory used by the arrays, in bytes
+
+        Returns:
+            int
+        """
+        if self._offsets is None:
+            return self._coords.nbytes
+
+        return self._coords.nbytes + self._offsets.nbytes
+
+    def astype(self, dtype: type) -> "Geometry":
+        """Returns a copy of the geometry with a different coordinates type
+
+        Args:
+            dtype (type): New type, e.g. np.float32
+
+        Returns:
+            Geometry
+        """
+        if self._coords.dtype == dtype:
+            return self
+
+        return Geometry(self._coords.astype(dtype), self._offsets, self._metadata)
+
+    def simplify(self, tolerance: float) -> "Geometry":
+        """Returns a copy of the geometry with simplified rings (Douglas-Peucker).
+        All the rings are simplified at once: at each step, every segment whose farthest
+        vertex deviates more than the tolerance is split on that vertex.
+
+        Args:
+            tolerance (float): Maximum deviation, in the same unit of the coordinates
+
+        Returns:
+            Geometry
+        """
+        if self._offsets is None or not len(self._coords):
+            return self
+
+        x = self._coords[:, 0].astype(float)
+        y = self._coords[:, 1].astype(float)
+        starts, ends = self._offsets[:-1], self._offsets[1:] - 1
+        # single vertex rings are kept as they are, empty ones have nothing to keep
+        rings = ends >= starts
+        keep = np.zeros(len(x), dtype=bool)
+        keep[starts[rings]] = keep[ends[rings]] = True
+        first, last = starts[rings], ends[rings]
+
+        while len(first):
+            # vertices between the ends of each segment
+            inner = last - first - 1
+            first, last, inner = first[inner > 0], last[inner > 0], inner[inner > 0]
+            if not len(first):
+                break
+
+            segment_start = np.cumsum(inner) - inner
+            index = np.arange(inner.sum()) + np.repeat(first + 1 - segment_start, inner)
+
+            # squared distance of each vertex from its segment
+            dx, dy = x[last] - x[first], y[last] - y[first]
+            length = dx * dx + dy * dy
+            px = x[index] - np.repeat(x[first], inner)
+            py = y[index] - np.repeat(y[first], inner)
+            dx, dy = np.repeat(dx, inner), np.repeat(dy, inner)
+            t = px * dx + py * dy
+            # closed rings start and end on the same vertex
+            t = np.divide(t, np.repeat(length, inner), out=t, where=t != 0)
+            t = np.clip(t, 0, 1, out=t)
+            px -= t * dx
+            py -= t * dy
+            distance = px * px + py * py
+
+            # farthest vertex of each segment (the first one, on ties)
+            largest = np.maximum.reduceat(distance, segment_start)
+            farthest = np.flatnonzero(distance == np.repeat(largest, inner))
+            segment = np.searchsorted(segment_start, farthest, side="right") - 1
+            farthest = farthest[np.concatenate(([True], segment[1:] != segment[:-1]))]
+
+            split = largest > tolerance * tolerance
+            middle = index[farthest[split]]
+            keep[middle] = True
+            first, last = (
+                np.concatenate((first[split], middle)),
+                np.concatenate((middle, last[split])),
+            )
+
+        # number of vertices left in each ring
+        offsets = np.concatenate(([0], np.cumsum(keep)))[self._offsets]
+        return Geometry(self._coords[keep], offsets, self._metadata)
+
+    def cull(self, min_size: float) -> "Geometry":
+        """Returns a copy of the geometry without the rings whose bounding box is smaller
+        than a given size along both axes
+
+        Args:
+            min_size (float): Minimum size, in the same unit of the coordinates
+
+        Returns:
+            Geometry
+        """
+        if self._offsets is None or not len(self._coords):
+            return self
+
+        sizes = np.diff(self._offsets)
+        starts = np.minimum(self._offsets[:-1], len(self._coords) - 1)
+        extent = np.maximum.reduceat(self._coords, starts) - np.minimum.reduceat(
+            self._coords, starts
+        )
+        keep = (sizes > 0) & (extent >= min_size).any(axis=1)
+
+        offsets = np.concatenate(([0], np.cumsum(sizes[keep])))
+        return Geometry(self._coords[np.repeat(keep, sizes)], offsets, self._metadata)
+
+    def ring(self, index: int) -> np.ndarray:
+        """Returns a view of the vertices of a ring
+
+        Args:
+            index (int)
+
+        Returns:
+            np.ndarray
+        """
+        return self._coords[self._offsets[index] : self._offsets[index + 1]]
+
+    def __len__(self) -> int:
+        """Returns the number of rings (or points)
+
+        Returns:
+            int
+        """
+        if self._offsets is None:
+            return len(self._coords)
+
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """Returns a point, or a view of the vertices of a ring
+
+        Args:
+            index (int)
+
+        Returns:
+            np.ndarray
+        """
+        if self._offsets is None:
+            return self._coords[index]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("Geometry index out of range")
+
+        return self.ring(index)
+
+    def __iter__(self):
+        """Iterates over points or rings (as array views)"""
+        if self._offsets is None:
+            return iter(self._coords)
+
+        return (self.ring(i) for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        kind = "rings" if self.polygonal else "points"
+        return f"Geometry({len(self)} {kind}, {len(self._coords)} vertices, {self._coords.dtype})"
@@ -0,0 +1,129 @@
+import cProfile
+import json
+import os
+
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+
+class Instrumentation:
+    def __init__(self, name: str = "", profile_dir: str | None = None) -> None:
+        """Create an instrumentation surface, collecting timers, counters and events.
+        All the methods are thread safe.
+
+        Args:
+            name (str, optional): Name of the instrumented object (e.g. the city). Defaults to "".
+            profile_dir (str | None, optional): Folder where cProfile stats are saved.
+                Defaults to None (no profiling).
+        """
+        self._name = name
+        self._profile_dir = profile_dir
+
+        self._timers = {}
+        self._counters = {}
+        self._events = []
+        self._lock = Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Times a block of code. Timers with the same name are aggregated.
+
+        Args:
+            name (str): Timer name
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, perf_counter() - started)
+
+    def addTime(self, name: str, elapsed: float) -> None:
+        """Adds a measured time to a timer
+
+        Args:
+            name (str): Timer name
+            elapsed (float): Time, in seconds
+        """
+        with self._lock:
+            timer = self._timers.setdefault(name, {"count": 0, "total": 0, "max": 0})
+            timer["count"] += 1
+            timer["total"] += elapsed
+            timer["max"] = max(timer["max"], elapsed)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increments a counter
+
+        Args:
+            name (str): Counter name
+            value (int, optional): Increment. Defaults to 1.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def record(self, kind: str, **fields) -> None:
+        """Records a single event (e.g. a request)
+
+        Args:
+            kind (str): Event kind
+            **fields: Event fields, must be JSON serializable
+        """
+        with self._lock:
+            self._events.append({"kind": kind, **fields})
+
+    def events(self, kind: str | None = None) -> list[dict]:
+        """Returns the recorded events
+
+        Args:
+            kind (str | None, optional): Only return events of this kind. Defaults to None.
+
+        Returns:
+            list[dict]
+        """
+        with self._lock:
+            return [e for e in self._events if kind is None or e["kind"] == kind]
+
+    @contextmanager
+    def profile(self, stage: str):
+        """Profiles a block of code with cProfile, if a profile folder was provided.
+        Stats are saved in {profile_dir}/{name}-{stage}.prof
+
+        Args:
+            stage (str): Stage name
+        """
+        if not self._profile_dir:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self._profile_dir, exist_ok=True)
+            name = "".join(c if c.isalnum() else "-" for c in f"{self._name}-{stage}")
+            profiler.dump_stats(os.path.join(self._profile_dir, f"{name}.prof"))
+
+    def report(self) -> dict:
+        """Returns a machine readable report
+
+        Returns:
+            dict: name, timers, counters and events
+        """
+        with self._lock:
+            return {
+                "name": self._name,
+                "timers": {k: dict(v) for k, v in self._timers.items()},
+                "counters": dict(self._counters),
+                "events": list(self._events),
+            }
+
+    def save(self, filename: str) -> None:
+        """Saves the report as a JSON file
+
+        Args:
+            filename (str)
+        """
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -7,11 +7,10 @@ Reference:
 - Colors https://www.w3schools.com/colors/colors_crayola.asp
 """
 
+import argparse
 import logging
-from string import ascii_lowercase
 
-from citymap import RoundCityMap, MinimalMap
-from cityimage import CityImage, DarkCityImage, MinimalisticCityImage
+from batch import loadJobs, runJobs
 
 
 def main():
@@ -21,79 +20,60 @@ def main():
         format="%(asctime)s - %(levelname)s: %(message)s",
     )
 
-    logging.info("Script started")
-
-    # list of cities and their radii
-    cities = {
-        "Milano, Italia": 3000,
-        "Paris, France": 3000,
-        "Berlin, Germany": 3000,
-        "Barcellona, Spain": 3000,
-        "Amsterdam, the Netherlands": 3000,
-        "Prague, Czechia": 3000,
-        "Budapest, Hungary": 3000,
-    }
-
-    for city, radius in cities.items():
-        # format filename
-        filename = "".join(
-            [
-                c
-                for c in city.lower().replace(" ", "-")
-                if c in ascii_lowercase or c == "-"
-            ]
-        )
-
-        # load the city and its features
-        logging.info(f"Creating round map for {city}")
-        r = RoundCityMap(city, radius)
-        logging.info("Loading city")
-        r.loadCity()
-        logging.info("Loading features")
-        r.loadFeatures()
-
-        # create the first circular image
-        logging.info("Creating image")
-        m = CityImage()
-        m.drawTrees(r.trees)
-        m.drawWater(r.water)
-        m.drawParks(r.parks)
-        m.drawBuildings(r.buildings)
-
-        m.drawTitle(city)
-        logging.info(f"Saving image {filename}")
-        m.save(f"output/{filename}-minimal.png")
-
-        # create the second circular image (black and white)
-        d = DarkCityImage()
-        d.drawTrees(r.trees)
-        d.drawWater(r.water)
-        d.drawParks(r.parks)
-        d.drawBuildings(r.buildings)
+    parser = argparse.ArgumentParser(description="Render minimalistic city maps")
+    parser.add_argument("--jobs", help="JSON file with the list of jobs")
+    parser.add_argument(
+        "--status",
+        default="output/status.json",
+        help="JSON file where the status of each job is saved",
+    )
+    parser.add_argument("--fetch-workers", type=int, default=4)
+    parser.add_argument("--render-workers", type=int, default=None)
+    parser.add_argument(
+        "--profile", default=None, help="folder where cProfile stats of each stage are saved"
+    )
+    parser.add_argument(
+        "--layer-cache",
+        default=None,
+        help="folder where rasterized layers are cached, to only redraw the changed ones",
+    )
+    parser.add_argument(
+        "--snapshots",
+        default=None,
+        help="folder where normalized maps are saved, to be reused without fetching them",
+    )
+    args = parser.parse_args()
 
-        d.drawTitle(city)
-        logging.info(f"Saving image {filename} dark")
-        d.save(f"output/{filename}-minimal-dark.png")
+    logging.info("Script started")
 
-        logging.info(f"Creating minimal map for {city}")
-        # create the minimal map for the city
-        m = MinimalMap(city)
-        logging.info("Loading city")
-        m.loadCity()
-        logging.info("Loading features")
-        m.loadFeatures()
+    if args.jobs:
+        jobs = loadJobs(args.jobs)
+    else:
+        # list of cities and their radii
+        cities = {
+            "Milano, Italia": 3000,
+            "Paris, France": 3000,
+            "Berlin, Germany": 3000,
+            "Barcellona, Spain": 3000,
+            "Amsterdam, the Netherlands": 3000,
+            "Prague, Czechia": 3000,
+            "Budapest, Hungary": 3000,
+        }
+        jobs = [{"city": city, "radius": radius} for city, radius in cities.items()]
+
+    status = runJobs(
+        jobs,
+        status_path=args.status,
+        fetch_workers=args.fetch_workers,
+        render_workers=args.render_workers,
+        profile_dir=args.profile,
+        layer_cache=args.layer_cache,
+        snapshot_dir=args.snapshots,
+    )
 
-        for tag, coords in m.circular_features.items():
-            # create a minimal map for each feature in the city
-            city_name = city.split(",")[0]
-            title = f"{city_name} and its {len(coords)} {tag}"
-            fill = m.getColor(tag)
-            logging.info(f"Creating image with {tag}: found {len(coords)}")
-            i = MinimalisticCityImage()
-            i.drawMultipleCircles(coords, fill=fill, radius=10)
-            i.drawTitle(title)
-            logging.info(f"Saving image {filename}-{tag.replace(' ',  '-')}")
-            i.save(f"output/{filename}-{tag.replace(' ',  '-')}.png")
+    failed = [job for job, s in status.items() if s["status"] == "failed"]
+    if failed:
+        logging.error(f"Failed jobs: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
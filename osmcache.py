@@ -0,0 +1,431 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from time import time
+from typing import IO, Iterator
+
+from OSMPythonTools.cachingStrategy.base import CachingStrategyBase
+from PIL import Image
+
+
+class _JSONStream:
+    def __init__(self, f: IO[str], chunk_size: int = 1024**2) -> None:
+        """Incremental reader of a JSON document, decoding one value at a time
+
+        Args:
+            f (IO[str]): Text file
+            chunk_size (int, optional): Characters read at once. Defaults to 1 MB.
+        """
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Reads the next chunk of the file, discarding the consumed part of the buffer
+
+        Returns:
+            bool: False if the file is over
+        """
+        if self._eof:
+            return False
+
+        chunk = self._f.read(self._chunk_size)
+        self._buffer = self._buffer[self._position :] + chunk
+        self._position = 0
+        self._eof = not chunk
+        return not self._eof
+
+    def next(self) -> str:
+        """Returns the next non whitespace character, consuming it
+
+        Raises:
+            ValueError: the document is truncated
+
+        Returns:
+            str
+        """
+        while True:
+            while self._position < len(self._buffer):
+                c = self._buffer[self._position]
+                self._position += 1
+                if not c.isspace():
+                    return c
+
+            if not self._fill():
+                raise ValueError("Truncated JSON document")
+
+    def expect(self, chars: str) -> str:
+        """Consumes the next non whitespace character, checking it
+
+        Args:
+            chars (str): Allowed characters
+
+        Raises:
+            ValueError: unexpected character
+
+        Returns:
+            str: the consumed character
+        """
+        c = self.next()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON document, found {c!r}")
+
+        return c
+
+    def peek(self) -> str:
+        """Returns the next non whitespace character, without consuming it
+
+        Returns:
+            str
+        """
+        c = self.next()
+        self._position -= 1
+        return c
+
+    def value(self):
+        """Decodes the next value
+
+        Returns:
+            Any
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # numbers might continue in the next chunk, e.g. "0" of "0.6"
+            if (
+                isinstance(value, (int, float))
+                and self._buffer[end : end + 1] in ("", *"0123456789.eE+-")
+                and self._fill()
+            ):
+                continue
+
+            self._position = end
+            return value
+
+
+def iterJSONList(f: IO[str], field: str, chunk_size: int = 1024**2) -> Iterator:
+    """Iterates over the items of a list inside a JSON object, without loading the whole document.
+    Only the items are decoded, one at a time.
+
+    Args:
+        f (IO[str]): Text file containing a JSON object
+        field (str): Key of the list in the object
+        chunk_size (int, optional): Characters read at once. Defaults to 1 MB.
+
+    Yields:
+        Any: items of the list. Nothing if the key is missing.
+    """
+    stream = _JSONStream(f, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+
+    while True:
+        key = stream.value()
+        stream.expect(":")
+
+        if key != field:
+            stream.value()
+        else:
+            stream.expect("[")
+            if stream.peek() == "]":
+                return
+
+            while True:
+                yield stream.value()
+                if stream.expect(",]") == "]":
+                    return
+
+        if stream.expect(",}") == "}":
+            return
+
+
+class NoCaching(CachingStrategyBase):
+    """OSMPythonTools caching strategy that never stores anything.
+    Responses are cached by OSMCache, which can expire and evict them:
+    the never expiring cache of the library would answer the refetches
+    and keep a second copy of every response."""
+
+    def get(self, key: str) -> None:
+        return None
+
+    def set(self, key: str, data: dict) -> None:
+        pass
+
+
+class OSMCache:
+    # extension of the cached files
+    _extension = ".json"
+
+    def __init__(
+        self,
+        path: str = ".osmcache",
+        ttl: float = 7 * 24 * 3600,
+        max_size: int = 2 * 1024**3,
+    ) -> None:
+        """Create a content addressed on-disk cache for OSM responses.
+        Each entry is stored as a plain JSON file named after the hash of its key.
+
+        Args:
+            path (str, optional): Cache folder. Defaults to ".osmcache".
+            ttl (float, optional): Time to live of each entry, in seconds. Defaults to one week.
+            max_size (int, optional): Maximum size of the cache folder, in bytes. Defaults to 2 GB.
+        """
+        self._path = path
+        self._ttl = ttl
+        self._max_size = max_size
+
+        os.makedirs(self._path, exist_ok=True)
+
+    @property
+    def ttl(self) -> float:
+        """Returns the time to live of each entry, in seconds
+
+        Returns:
+            float
+        """
+        return self._ttl
+
+    def key(self, *parts) -> str:
+        """Returns the key relative to a set of parts (query string, bbox, topology...)
+
+        Returns:
+            str: hex digest of the parts
+        """
+        raw = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """Returns the path of the file relative to a key
+
+        Args:
+            key (str)
+
+        Returns:
+            str
+        """
+        return os.path.join(self._path, f"{key}{self._extension}")
+
+    def get(self, key: str) -> dict | list | None:
+        """Returns the cached data relative to a key.
+        Expired entries are removed and treated as missing.
+
+        Args:
+            key (str)
+
+        Returns:
+            dict | list | None: cached data, None if missing
+        """
+        f = self._open(key)
+        if f is None:
+            return None
+
+        with f:
+            return json.load(f)
+
+    def iterate(self, key: str, field: str) -> Iterator | None:
+        """Returns an iterator over a list inside the cached object relative to a key.
+        Items are decoded one at a time while iterating, see iterJSONList.
+
+        Args:
+            key (str)
+            field (str): Key of the list in the cached object
+
+        Returns:
+            Iterator | None: items of the list, None if the entry is missing
+        """
+        f = self._open(key)
+        if f is None:
+            return None
+
+        def items():
+            with f:
+                yield from iterJSONList(f, field)
+
+        return items()
+
+    def _open(self, key: str, mode: str = "r") -> IO | None:
+        """Opens the file relative to a key, marking it as recently used.
+        Expired entries are removed and treated as missing.
+
+        Args:
+            key (str)
+            mode (str, optional): File mode. Defaults to "r".
+
+        Returns:
+            IO | None: open file, None if missing
+        """
+        filename = self.path(key)
+
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+
+        now = time()
+        if now - stat.st_mtime > self._ttl:
+            logging.info(f"Cache entry {key} expired")
+            self._remove(filename)
+            return None
+
+        try:
+            f = open(filename, mode)
+        except FileNotFoundError:
+            return None
+
+        # access time is used to evict least recently used entries
+        os.utime(filename, (now, stat.st_mtime))
+        return f
+
+    def set(self, key: str, data: dict | list) -> None:
+        """Stores data relative to a key, then evicts old entries if needed
+
+        Args:
+            key (str)
+            data (dict | list): JSON serializable data
+        """
+        filename = self.path(key)
+        # write to a temporary file first, so that readers never see partial entries
+        tmp = self._tmpPath(filename)
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+
+        self._evict()
+
+    def _tmpPath(self, filename: str) -> str:
+        """Returns the temporary file an entry is written to before being moved in place.
+        Each process and thread gets its own, so that concurrent writers never share it.
+
+        Args:
+            filename (str): Entry filename
+
+        Returns:
+            str
+        """
+        return f"{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+    def clear(self) -> None:
+        """Removes all the entries in the cache"""
+        for filename, _ in self._entries():
+            self._remove(filename)
+
+    def _entries(self) -> list[tuple[str, os.stat_result]]:
+        """Returns all the entries in the cache folder
+
+        Returns:
+            list[tuple[str, os.stat_result]]: list of (path, stat)
+        """
+        entries = []
+        for f in os.listdir(self._path):
+            if not f.endswith(self._extension):
+                continue
+
+            filename = os.path.join(self._path, f)
+            try:
+                entries.append((filename, os.stat(filename)))
+            except FileNotFoundError:
+                continue
+
+        return entries
+
+    def _evict(self) -> None:
+        """Removes expired entries and least recently used ones until the cache fits its size"""
+        now = time()
+        entries = []
+        for filename, stat in self._entries():
+            if now - stat.st_mtime > self._ttl:
+                self._remove(filename)
+            else:
+                entries.append((filename, stat))
+
+        total = sum(s.st_size for _, s in entries)
+        if total <= self._max_size:
+            return
+
+        entries.sort(key=lambda e: e[1].st_atime)
+        for filename, stat in entries:
+            if total <= self._max_size:
+                break
+
+            logging.info(f"Evicting cache entry {filename}")
+            self._remove(filename)
+            total -= stat.st_size
+
+    def _remove(self, filename: str) -> None:
+        """Removes a file, ignoring it if it was already removed
+
+        Args:
+            filename (str)
+        """
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+class ImageCache(OSMCache):
+    _extension = ".png"
+
+    def __init__(
+        self,
+        path: str = ".imagecache",
+        ttl: float = 7 * 24 * 3600,
+        max_size: int = 2 * 1024**3,
+    ) -> None:
+        """Create a content addressed on-disk cache for rasterized images.
+        Each entry is stored as a losslessly compressed PNG file named after the hash of its key.
+
+        Args:
+            path (str, optional): Cache folder. Defaults to ".imagecache".
+            ttl (float, optional): Time to live of each entry, in seconds. Defaults to one week.
+            max_size (int, optional): Maximum size of the cache folder, in bytes. Defaults to 2 GB.
+        """
+        super().__init__(path, ttl, max_size)
+
+    def get(self, key: str) -> Image.Image | None:
+        """Returns the cached image relative to a key.
+        Expired entries are removed and treated as missing.
+
+        Args:
+            key (str)
+
+        Returns:
+            Image.Image | None: cached image, None if missing
+        """
+        f = self._open(key, "rb")
+        if f is None:
+            return None
+
+        with f:
+            image = Image.open(f)
+            image.load()
+            return image
+
+    def set(self, key: str, image: Image.Image) -> None:
+        """Stores an image relative to a key, then evicts old entries if needed
+
+        Args:
+            key (str)
+            image (Image.Image)
+        """
+        filename = self.path(key)
+        # write to a temporary file first, so that readers never see partial entries
+        tmp = self._tmpPath(filename)
+        # entries are written once and read many times, fast compression is enough
+        image.save(tmp, "PNG", compress_level=1)
+        os.replace(tmp, filename)
+
+        self._evict()
@@ -0,0 +1,184 @@
+from urllib.error import HTTPError, URLError
+
+import numpy as np
+import pytest
+
+from benchmark import FakeNominatim, FakeOverpass, syntheticCity
+from citymap import OverpassTimeout, RoundCityMap
+from osmcache import OSMCache
+
+# elements of the synthetic city used by the tiling tests
+CITY = syntheticCity(400, 100, 8, radius=1000)
+
+
+class FailingOverpass(FakeOverpass):
+    def __init__(self, error: Exception) -> None:
+        """Overpass backend whose queries always fail
+
+        Args:
+            error (Exception): Error raised by each query
+        """
+        super().__init__({"elements": []})
+        self._error = error
+        self.queries = 0
+
+    def query(self, query: str, **_):
+        self.queries += 1
+        raise self._error
+
+
+def roundMap(
+    tmp_path, radius: float = 1000, overpass: FakeOverpass | None = None
+) -> RoundCityMap:
+    r = RoundCityMap(
+        "Synthetic city",
+        radius=radius,
+        cache=OSMCache(str(tmp_path)),
+        nominatim=FakeNominatim(),
+        overpass=overpass if overpass is not None else FakeOverpass({"elements": []}),
+    )
+    r._backoff_base = 0
+    r.loadCity()
+    return r
+
+
+def loadedFeatures(r: RoundCityMap) -> dict[str, list]:
+    # points and rings of each feature, whatever the order of the tiles
+    r.loadFeatures()
+    return {f: sorted(g.tolist() for g in getattr(r, f)) for f in r.features}
+
+
+def counters(r: RoundCityMap) -> dict:
+    return r.instrumentation.report()["counters"]
+
+
+def test_clip_ring_outside_the_disc(tmp_path):
+    # ring beyond several sides of the north east border: it is dropped by the
+    # first clipping round, while the next rounds still have sides to clip
+    r = roundMap(tmp_path)
+    x = np.array([1000, 959, 754, 605, 947, 1020], dtype=float)
+    y = np.array([897, 1060, 1003, 1296, 761, 1176], dtype=float)
+    lat, lon = r._toDegrees(x, y)
+
+    lat, lon, offsets = r._clipRings(lat, lon, np.array([0, 6]))
+
+    assert len(lat) == len(lon) == 0
+    assert offsets.tolist() == [0]
+
+
+def test_clip_ring_leaving_the_disc(tmp_path):
+    # ring starting inside the disc, leaving it across several sides
+    r = roundMap(tmp_path)
+    x = np.array([0, 2000, 2000, 0], dtype=float)
+    y = np.array([0, 0, 2000, 2000], dtype=float)
+    outside = np.array([3000, 3000, 3100, 3100], dtype=float)
+    lat, lon = r._toDegrees(np.concatenate((x, outside)), np.concatenate((y, outside)))
+
+    lat, lon, offsets = r._clipRings(lat, lon, np.array([0, 4, 8]))
+    x, y = r._toMeters(lat, lon)
+
+    assert len(offsets) == 2
+    assert np.all(np.hypot(x, y) <= 1000 + 1e-6)
+
+
+def test_plan_tiles_within_budget(tmp_path):
+    r = roundMap(tmp_path, overpass=FakeOverpass(CITY))
+    r._max_elements = 60
+    features = r._planQueries()[0]
+    topology = sorted({t for f in features for t in f["topology"]})
+
+    tiles = r._planTiles(features, topology)
+
+    assert len(tiles) > 1
+    for bbox, depth in tiles:
+        assert 0 < depth <= r._max_depth
+        assert r._countElements(features, bbox, topology) <= 60
+
+
+def test_tiles_skip_duplicates(tmp_path):
+    # ways crossing the border of a tile are returned by both tiles, but loaded once
+    whole = loadedFeatures(roundMap(tmp_path / "whole", overpass=FakeOverpass(CITY)))
+    r = roundMap(tmp_path / "tiled", overpass=FakeOverpass(CITY))
+    r._max_elements = 60
+
+    tiled = loadedFeatures(r)
+
+    assert counters(r)["overpass.tiles"] > 1
+    assert counters(r)["overpass.duplicates"] > 0
+    assert tiled == whole
+
+
+def test_split_tiles_timing_out(tmp_path):
+    # the server gives up on queries returning more than 150 elements
+    whole = loadedFeatures(roundMap(tmp_path / "whole", overpass=FakeOverpass(CITY)))
+    r = roundMap(tmp_path / "split", overpass=FakeOverpass(CITY, limit=150))
+
+    split = loadedFeatures(r)
+
+    assert counters(r)["overpass.tiles"] > 1
+    assert counters(r)["overpass.retries"] == 0
+    assert split == whole
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        Exception("could not download", URLError(ConnectionRefusedError(111, "refused"))),
+        Exception("could not download", HTTPError("", 429, "Too Many Requests", {}, None)),
+        Exception('[overpass] error in result: [timeout:300][out:json];(node["natural"]);'),
+    ],
+)
+def test_no_split_on_other_errors(tmp_path, error):
+    overpass = FailingOverpass(error)
+    r = roundMap(tmp_path, overpass=overpass)
+    r._max_attempts = 2
+
+    with pytest.raises(RuntimeError):
+        r.loadFeatures()
+
+    # the count of the first query is tried again, then the load fails
+    assert overpass.queries == 2
+    assert "overpass.count_timeouts" not in counters(r)
+
+
+def test_split_count_timing_out(tmp_path):
+    overpass = FailingOverpass(
+        Exception("could not download", HTTPError("", 504, "Gateway Timeout", {}, None))
+    )
+    r = roundMap(tmp_path, overpass=overpass)
+    r._max_depth = 1
+    features = r._planQueries()[0]
+    topology = sorted({t for f in features for t in f["topology"]})
+
+    tiles = r._planTiles(features, topology)
+
+    # the root and its four quadrants are counted once each
+    assert len(tiles) == 4
+    assert overpass.queries == 5
+    assert counters(r)["overpass.count_timeouts"] == 5
+
+
+@pytest.mark.parametrize(
+    "error, timeout",
+    [
+        (OverpassTimeout("runtime error: Query timed out"), True),
+        (Exception("download failed", HTTPError("", 504, "Gateway Timeout", {}, None)), True),
+        (Exception("download failed", URLError(TimeoutError("timed out"))), True),
+        (TimeoutError("timed out"), True),
+        (Exception("download failed", HTTPError("", 429, "Too Many Requests", {}, None)), False),
+        (Exception("[overpass] error in result: [timeout:300];"), False),
+        (RuntimeError("overpass request failed"), False),
+    ],
+)
+def test_is_timeout(tmp_path, error, timeout):
+    assert roundMap(tmp_path)._isTimeout(error) is timeout
+
+
+def test_timeout_is_found_in_the_cause(tmp_path):
+    try:
+        try:
+            raise OverpassTimeout("runtime error: Query run out of memory")
+        except OverpassTimeout as e:
+            raise RuntimeError("overpass request failed") from e
+    except RuntimeError as e:
+        assert roundMap(tmp_path)._isTimeout(e)
@@ -0,0 +1,762 @@
+import gzip
+import os
+import zlib
+
+from html import escape
+from PIL import ImageColor
+
+import numpy as np
+
+from cityimage import CityImage, FONTS_PATH, loadFont
+from instrumentation import Instrumentation
+
+# weight and style of each font variant, in SVG files
+_SVG_FONTS = {
+    "Light": (300, "normal"),
+    "LightItalic": (300, "italic"),
+    "Regular": (400, "normal"),
+    "Italic": (400, "italic"),
+    "Bold": (700, "normal"),
+    "BoldItalic": (700, "italic"),
+    "Black": (900, "normal"),
+    "BlackItalic": (900, "italic"),
+}
+
+# vector images are written as they are drawn, nothing can be rendered afterwards
+_RASTER_ERROR = (
+    "Vector images are streamed to their file and can't be rasterized: "
+    "use save or close to complete the file, or CityImage for raster output"
+)
+
+
+def _formatNumbers(values: np.ndarray, precision: int) -> np.ndarray:
+    """Formats quantized coordinates as short decimal strings
+
+    Args:
+        values (np.ndarray): Coordinates multiplied by 10 ** precision, as integers
+        precision (int): Number of decimals
+
+    Returns:
+        np.ndarray: Array of strings, same shape of the values
+    """
+    if precision == 0:
+        return values.astype(str)
+
+    scale = 10**precision
+    # whole numbers lose their decimals, the others get the shortest representation
+    return np.where(
+        values % scale == 0, (values // scale).astype(str), (values / scale).astype(str)
+    )
+
+
+def _rgb(fill: tuple[int, int, int] | str) -> tuple[int, int, int]:
+    """Returns a color as an RGB tuple
+
+    Args:
+        fill (tuple[int, int, int] | str)
+
+    Returns:
+        tuple[int, int, int]
+    """
+    return tuple(ImageColor.getrgb(fill)[:3] if isinstance(fill, str) else fill[:3])
+
+
+class _SVGWriter:
+    def __init__(
+        self,
+        filename: str,
+        size: tuple[int, int],
+        background_color: tuple[int, int, int],
+        precision: int,
+    ) -> None:
+        """Streams paths to an SVG file (gzipped if the extension is .svgz).
+        Polygons are written with relative coordinates, which are shorter.
+
+        Args:
+            filename (str): Filename
+            size (tuple[int, int]): Image size
+            background_color (tuple[int, int, int]): Background color
+            precision (int): Number of decimals of the coordinates
+        """
+        opener = gzip.open if filename.endswith(".svgz") else open
+        self._file = opener(filename, "wt", encoding="utf-8")
+        self._precision = precision
+        # group of the current layer, and fill of the open merged path
+        self._layer = None
+        self._path = None
+
+        self._file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{size[0]}" height="{size[1]}" '
+            f'viewBox="0 0 {size[0]} {size[1]}">\n'
+            f'<rect width="100%" height="100%" fill="{self._color(background_color)}"/>\n'
+        )
+
+    def _color(self, fill: tuple[int, int, int]) -> str:
+        return "#{:02x}{:02x}{:02x}".format(*fill)
+
+    def _begin(self, layer: str | None, fill: tuple[int, int, int], merge: bool) -> None:
+        """Moves to the group of a layer, opening a merged path if needed
+
+        Args:
+            layer (str | None): Layer name
+            fill (tuple[int, int, int]): Fill color
+            merge (bool): Merge the subpaths into the open path
+        """
+        if merge and self._path == (layer, fill):
+            return
+
+        self._end()
+        if layer != self._layer:
+            if self._layer is not None:
+                self._file.write("</g>\n")
+            if layer is not None:
+                self._file.write(f'<g id="{escape(layer)}">\n')
+            self._layer = layer
+
+        if merge:
+            self._file.write(f'<path fill="{self._color(fill)}" d="')
+            self._path = (layer, fill)
+
+    def _end(self) -> None:
+        """Closes the open merged path, if any"""
+        if self._path is not None:
+            self._file.write('"/>\n')
+            self._path = None
+
+    def polygons(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        fill: tuple[int, int, int],
+        layer: str | None,
+        merge: bool,
+    ) -> None:
+        """Writes a set of rings
+
+        Args:
+            coords (np.ndarray): Nx2 array of quantized coordinates
+            offsets (np.ndarray): Ring offsets
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+            merge (bool): Write all the rings in a single path
+        """
+        starts = offsets[:-1]
+        # each vertex is written relative to the previous one, except the first of each ring
+        deltas = np.diff(coords, axis=0, prepend=coords[:1])
+        deltas[starts] = coords[starts]
+        numbers = _formatNumbers(deltas, self._precision)
+        pairs = np.char.add(np.char.add(numbers[:, 0], " "), numbers[:, 1]).tolist()
+
+        rings = [
+            f"M{pairs[s]}l{' '.join(pairs[s + 1 : e])}z"
+            for s, e in zip(starts.tolist(), offsets[1:].tolist())
+        ]
+
+        self._begin(layer, fill, merge)
+        if merge:
+            self._file.write("".join(rings))
+        else:
+            color = self._color(fill)
+            self._file.writelines(f'<path fill="{color}" d="{d}"/>\n' for d in rings)
+
+    def circles(
+        self,
+        centers: np.ndarray,
+        radius: int,
+        fill: tuple[int, int, int],
+        layer: str | None,
+        merge: bool,
+    ) -> None:
+        """Writes a set of circles
+
+        Args:
+            centers (np.ndarray): Nx2 array of quantized centers
+            radius (int): Quantized radius
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+            merge (bool): Write all the circles in a single path
+        """
+        self._begin(layer, fill, merge)
+
+        if merge:
+            # two half circles, starting from the leftmost point
+            numbers = _formatNumbers(centers - [radius, 0], self._precision)
+            r, d = _formatNumbers(np.array([radius, 2 * radius]), self._precision)
+            arcs = f"a{r} {r} 0 1 0 {d} 0a{r} {r} 0 1 0 -{d} 0z"
+            self._file.writelines(f"M{x} {y}{arcs}" for x, y in numbers.tolist())
+        else:
+            numbers = _formatNumbers(centers, self._precision)
+            r = _formatNumbers(np.array([radius]), self._precision)[0]
+            color = self._color(fill)
+            self._file.writelines(
+                f'<circle cx="{x}" cy="{y}" r="{r}" fill="{color}"/>\n'
+                for x, y in numbers.tolist()
+            )
+
+    def text(
+        self,
+        xy: tuple[float, float],
+        text: str,
+        variant: str,
+        size: int,
+        fill: tuple[int, int, int],
+        layer: str | None,
+    ) -> None:
+        """Writes a line of text
+
+        Args:
+            xy (tuple[float, float]): Middle of the baseline
+            text (str): Text
+            variant (str): Chivo variant
+            size (int): Font size
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+        """
+        self._begin(layer, fill, False)
+        weight, style = _SVG_FONTS[variant]
+        self._file.write(
+            f'<text x="{xy[0]:g}" y="{xy[1]:g}" font-family="Chivo, sans-serif" '
+            f'font-weight="{weight}" font-style="{style}" font-size="{size}" '
+            f'text-anchor="middle" fill="{self._color(fill)}">{escape(text)}</text>\n'
+        )
+
+    def close(self) -> None:
+        """Closes the document and the file"""
+        self._end()
+        if self._layer is not None:
+            self._file.write("</g>\n")
+        self._file.write("</svg>\n")
+        self._file.close()
+
+
+class _PDFWriter:
+    def __init__(
+        self,
+        filename: str,
+        size: tuple[int, int],
+        background_color: tuple[int, int, int],
+        precision: int,
+    ) -> None:
+        """Streams paths to a single page PDF file.
+        The page content is compressed as it is written; fonts, page and cross reference
+        table are written when the file is closed. One output pixel is one point.
+
+        Args:
+            filename (str): Filename
+            size (tuple[int, int]): Page size
+            background_color (tuple[int, int, int]): Background color
+            precision (int): Number of decimals of the coordinates
+        """
+        self._file = open(filename, "wb")
+        self._size = size
+        self._precision = precision
+        # byte offset of each object
+        self._objects = []
+        # resource name of each embedded font variant
+        self._fonts = {}
+        self._fill = None
+        self._stroke = None
+
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        # the page content is the first object, its length the second
+        self._beginObject()
+        self._file.write(b"<< /Length 2 0 R /Filter /FlateDecode >>\nstream\n")
+        self._compressor = zlib.compressobj()
+        self._length = 0
+
+        self._setFill(background_color)
+        self._write(f"0 0 {size[0]} {size[1]} re f\n")
+
+    def _beginObject(self) -> int:
+        """Starts a new object
+
+        Returns:
+            int: Object number
+        """
+        self._objects.append(self._file.tell())
+        number = len(self._objects)
+        self._file.write(f"{number} 0 obj\n".encode())
+        return number
+
+    def _writeObject(self, content: str | bytes, stream: bytes | None = None) -> int:
+        """Writes a whole object
+
+        Args:
+            content (str | bytes): Object content (the dictionary, for streams)
+            stream (bytes | None, optional): Stream data. Defaults to None.
+
+        Returns:
+            int: Object number
+        """
+        number = self._beginObject()
+        self._file.write(content.encode() if isinstance(content, str) else content)
+        if stream is not None:
+            self._file.write(b"\nstream\n" + stream + b"\nendstream")
+        self._file.write(b"\nendobj\n")
+        return number
+
+    def _write(self, content: str) -> None:
+        """Appends to the page content
+
+        Args:
+            content (str)
+        """
+        data = self._compressor.compress(content.encode("latin-1"))
+        self._file.write(data)
+        self._length += len(data)
+
+    def _setFill(self, fill: tuple[int, int, int]) -> None:
+        if fill != self._fill:
+            self._write("{:.4g} {:.4g} {:.4g} rg\n".format(*(c / 255 for c in fill)))
+            self._fill = fill
+
+    def _flip(self, coords: np.ndarray) -> np.ndarray:
+        """Moves the origin from the top left corner to the bottom left one
+
+        Args:
+            coords (np.ndarray): Nx2 array of quantized coordinates
+
+        Returns:
+            np.ndarray
+        """
+        flipped = coords.copy()
+        flipped[:, 1] = self._size[1] * 10**self._precision - coords[:, 1]
+        return flipped
+
+    def polygons(
+        self,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        fill: tuple[int, int, int],
+        layer: str | None,
+        merge: bool,
+    ) -> None:
+        """Writes a set of rings
+
+        Args:
+            coords (np.ndarray): Nx2 array of quantized coordinates
+            offsets (np.ndarray): Ring offsets
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+            merge (bool): Fill all the rings at once
+        """
+        numbers = _formatNumbers(self._flip(coords), self._precision)
+        points = np.char.add(np.char.add(numbers[:, 0], " "), numbers[:, 1]).tolist()
+        fill_op = "h\n" if merge else "h f\n"
+
+        rings = [
+            f"{points[s]} m {' l '.join(points[s + 1 : e])} l {fill_op}"
+            for s, e in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+        ]
+
+        self._setFill(fill)
+        self._write("".join(rings))
+        if merge:
+            self._write("f\n")
+
+    def circles(
+        self,
+        centers: np.ndarray,
+        radius: int,
+        fill: tuple[int, int, int],
+        layer: str | None,
+        merge: bool,
+    ) -> None:
+        """Writes a set of circles, as zero length lines stroked with round caps:
+        PDF viewers paint them as discs whose diameter is the line width
+
+        Args:
+            centers (np.ndarray): Nx2 array of quantized centers
+            radius (int): Quantized radius
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+            merge (bool): Stroke all the circles at once
+        """
+        numbers = _formatNumbers(self._flip(centers), self._precision)
+        width = _formatNumbers(np.array([2 * radius]), self._precision)[0]
+        points = np.char.add(np.char.add(numbers[:, 0], " "), numbers[:, 1]).tolist()
+        stroke_op = "\n" if merge else " S\n"
+
+        if fill != self._stroke:
+            self._write("{:.4g} {:.4g} {:.4g} RG\n".format(*(c / 255 for c in fill)))
+            self._stroke = fill
+        self._write(f"1 J {width} w\n")
+        self._write("".join(f"{p} m {p} l{stroke_op}" for p in points))
+        if merge:
+            self._write("S\n")
+
+    def _font(self, variant: str) -> str:
+        """Returns the resource name of a font variant
+
+        Args:
+            variant (str): Chivo variant
+
+        Returns:
+            str
+        """
+        return self._fonts.setdefault(variant, f"F{len(self._fonts) + 1}")
+
+    def _embedFont(self, variant: str) -> int:
+        """Embeds a TrueType font, with the widths of its WinAnsi characters
+
+        Args:
+            variant (str): Chivo variant
+
+        Returns:
+            int: Number of the font object
+        """
+        with open(os.path.join(FONTS_PATH, f"Chivo-{variant}.ttf"), "rb") as f:
+            data = f.read()
+
+        compressed = zlib.compress(data)
+        font_file = self._writeObject(
+            f"<< /Length {len(compressed)} /Length1 {len(data)} /Filter /FlateDecode >>",
+            compressed,
+        )
+
+        # glyph space is 1000 units per em
+        font = loadFont(variant, 1000)
+        ascent, descent = font.getmetrics()
+        widths = [
+            round(font.getlength(bytes([c]).decode("cp1252", errors="replace")))
+            for c in range(32, 256)
+        ]
+        name = f"Chivo-{variant}"
+        descriptor = self._writeObject(
+            f"<< /Type /FontDescriptor /FontName /{name} /Flags 32 "
+            f"/FontBBox [-200 {-descent} 1200 {ascent}] /ItalicAngle 0 "
+            f"/Ascent {ascent} /Descent {-descent} /CapHeight {ascent} /StemV 80 "
+            f"/FontFile2 {font_file} 0 R >>"
+        )
+        return self._writeObject(
+            f"<< /Type /Font /Subtype /TrueType /BaseFont /{name} "
+            f"/FirstChar 32 /LastChar 255 /Widths [{' '.join(map(str, widths))}] "
+            f"/Encoding /WinAnsiEncoding /FontDescriptor {descriptor} 0 R >>"
+        )
+
+    def text(
+        self,
+        xy: tuple[float, float],
+        text: str,
+        variant: str,
+        size: int,
+        fill: tuple[int, int, int],
+        layer: str | None,
+    ) -> None:
+        """Writes a line of text. Characters outside of WinAnsi are replaced.
+
+        Args:
+            xy (tuple[float, float]): Middle of the baseline
+            text (str): Text
+            variant (str): Chivo variant
+            size (int): Font size
+            fill (tuple[int, int, int]): Fill color
+            layer (str | None): Layer name
+        """
+        encoded = text.encode("cp1252", errors="replace")
+        width = loadFont(variant, size).getlength(encoded.decode("cp1252"))
+        escaped = (
+            encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+        )
+
+        self._setFill(fill)
+        self._write(
+            f"BT /{self._font(variant)} {size} Tf "
+            f"{xy[0] - width / 2:.2f} {self._size[1] - xy[1]:.2f} Td ("
+        )
+        self._write(escaped.decode("latin-1"))
+        self._write(") Tj ET\n")
+
+    def close(self) -> None:
+        """Writes fonts, page and cross reference table, then closes the file"""
+        data = self._compressor.flush()
+        self._file.write(data)
+        self._length += len(data)
+        self._file.write(b"\nendstream\nendobj\n")
+        self._writeObject(str(self._length))
+
+        fonts = " ".join(
+            f"/{name} {self._embedFont(variant)} 0 R"
+            for variant, name in self._fonts.items()
+        )
+        # the pages tree follows the page
+        pages = len(self._objects) + 2
+        page = self._writeObject(
+            f"<< /Type /Page /Parent {pages} 0 R "
+            f"/MediaBox [0 0 {self._size[0]} {self._size[1]}] "
+            f"/Resources << /Font << {fonts} >> >> /Contents 1 0 R >>"
+        )
+        self._writeObject(f"<< /Type /Pages /Kids [{page} 0 R] /Count 1 >>")
+        catalog = self._writeObject(f"<< /Type /Catalog /Pages {pages} 0 R >>")
+
+        xref = self._file.tell()
+        self._file.write(f"xref\n0 {len(self._objects) + 1}\n".encode())
+        self._file.write(b"0000000000 65535 f \n")
+        self._file.write(b"".join(f"{o:010d} 00000 n \n".encode() for o in self._objects))
+        self._file.write(
+            f"trailer\n<< /Size {len(self._objects) + 1} /Root {catalog} 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n".encode()
+        )
+        self._file.close()
+
+
+class VectorCityImage(CityImage):
+    _writers = {"svg": _SVGWriter, "svgz": _SVGWriter, "pdf": _PDFWriter}
+
+    def __init__(
+        self,
+        filename: str,
+        width: int = 2000,
+        height: int = 2000,
+        background_color: tuple[float, float, float] | str | None = None,
+        scl: float = 0.8,
+        palette: dict[str, tuple[int, int, int] | str] | None = None,
+        precision: int = 1,
+        merge: bool = True,
+        simplify: float | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """Create a city image streamed to a vector file.
+        Nothing is rasterized: each drawing call writes its paths to the file straight away,
+        the file is complete once the image is closed.
+
+        Args:
+            filename (str): Output file. The extension (.svg, .svgz or .pdf) picks the format.
+            width (int, optional): Output width, in pixels (points for PDF). Defaults to 2000.
+            height (int, optional): Output height. Defaults to 2000.
+            background_color (tuple[float, float, float] | str | None, optional): Background
+                color. Defaults to the palette background, or (240, 240, 240).
+            scl (float, optional): Scale of the map relative to the image. Defaults to 0.8.
+            palette (dict[str, tuple[int, int, int] | str] | None, optional): Colors of the
+                title and of each layer, as returned by CityImage.palette. Defaults to None
+                (the colors of the drawing calls).
+            precision (int, optional): Number of decimals of the coordinates. Consecutive
+                vertices falling on the same quantized point are written once. Defaults to 1.
+            merge (bool, optional): Write consecutive shapes of the same layer and color as a
+                single path. Rings are reoriented so that overlapping shapes don't cancel out.
+                Defaults to True.
+            simplify (float | None, optional): Tolerance of the polygon simplification,
+                see CityImage. Defaults to None (no simplification).
+            instrumentation (Instrumentation | None, optional): Collects the draw timer.
+                Defaults to a new instance.
+
+        Raises:
+            ValueError: unknown file format
+        """
+        extension = os.path.splitext(filename)[1][1:].lower()
+        if extension not in self._writers:
+            raise ValueError(f"Unknown vector format {extension}")
+
+        self._palette = palette or {}
+        if background_color is None:
+            background_color = self._palette.get("background", (240, 240, 240))
+
+        super().__init__(
+            width=width,
+            height=height,
+            background_color=background_color,
+            scl=scl,
+            supersample=1,
+            tile_size=None,
+            simplify=simplify,
+            instrumentation=instrumentation,
+        )
+        self._precision = precision
+        self._merge = merge
+        self._filename = filename
+        self._writer = self._writers[extension](
+            filename, self._sizes, _rgb(background_color), precision
+        )
+
+    def __enter__(self) -> "VectorCityImage":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Completes the file"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _color(
+        self, fill: tuple[int, int, int] | str, layer: str | None
+    ) -> tuple[int, int, int]:
+        """Returns the color of a shape, taken from the palette if its layer is in there
+
+        Args:
+            fill (tuple[int, int, int] | str): Color of the drawing call
+            layer (str | None): Layer name
+
+        Returns:
+            tuple[int, int, int]
+        """
+        return _rgb(self._palette.get(layer, fill) if layer is not None else fill)
+
+    def _addCircles(
+        self,
+        abs_coords: np.ndarray,
+        radius: float,
+        fill: tuple[int, int, int] | str,
+        layer: str | None = None,
+    ) -> None:
+        """Writes a set of circles
+
+        Args:
+            abs_coords (np.ndarray): Nx2 array of absolute centers
+            radius (float): Circles radius
+            fill (tuple[int, int, int] | str): Fill color
+            layer (str | None, optional): Layer name. Defaults to None.
+        """
+        if not len(abs_coords):
+            return
+
+        scale = 10**self._precision
+        centers = np.rint(abs_coords * scale).astype(np.int64)
+        quantized_radius = max(int(round(radius * scale)), 1)
+
+        with self._instrumentation.timer("draw"):
+            self._writer.circles(
+                centers, quantized_radius, self._color(fill, layer), layer, self._merge
+            )
+        self._instrumentation.count("vector.circles", len(centers))
+
+    def _addPolygons(
+        self,
+        abs_coords: np.ndarray,
+        offsets: np.ndarray,
+        fill: tuple[int, int, int] | str,
+        layer: str | None = None,
+    ) -> None:
+        """Quantizes and writes a set of polygons. Repeated vertices and the closing vertex
+        of each ring are dropped, rings left with less than 3 vertices are skipped.
+
+        Args:
+            abs_coords (np.ndarray): Nx2 array of absolute coordinates
+            offsets (np.ndarray): Ring offsets
+            fill (tuple[int, int, int] | str): Fill color
+            layer (str | None, optional): Layer name. Defaults to None.
+        """
+        offsets = np.asarray(offsets)
+        sizes = np.diff(offsets)
+        if not len(abs_coords) or not sizes.any():
+            return
+
+        coords = np.rint(abs_coords * 10**self._precision).astype(np.int64)
+        starts, ends = offsets[:-1][sizes > 0], offsets[1:][sizes > 0] - 1
+
+        keep = np.ones(len(coords), dtype=bool)
+        keep[1:] = (coords[1:] != coords[:-1]).any(axis=1)
+        keep[starts] = True
+        keep[ends] &= (coords[ends] != coords[starts]).any(axis=1)
+
+        ring = np.repeat(np.arange(len(sizes)), sizes)
+        sizes = np.bincount(ring[keep], minlength=len(sizes))
+        coords, ring = coords[keep], ring[keep]
+        valid = sizes >= 3
+        coords, ring, sizes = coords[valid[ring]], ring[valid[ring]], sizes[valid]
+        if not len(sizes):
+            return
+
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        if self._merge:
+            coords = self._orient(coords, offsets)
+
+        with self._instrumentation.timer("draw"):
+            self._writer.polygons(
+                coords, offsets, self._color(fill, layer), layer, self._merge
+            )
+        self._instrumentation.count("vector.rings", len(sizes))
+        self._instrumentation.count("vector.vertices", len(coords))
+
+    def _orient(self, coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """Reverses the clockwise rings, so that all of them wind the same way and
+        the union of a merged path is filled with the nonzero rule
+
+        Args:
+            coords (np.ndarray): Nx2 array of coordinates
+            offsets (np.ndarray): Ring offsets
+
+        Returns:
+            np.ndarray
+        """
+        starts, sizes = offsets[:-1], np.diff(offsets)
+        # following vertex of each vertex, wrapping around each ring
+        following = np.arange(1, len(coords) + 1)
+        following[offsets[1:] - 1] = starts
+        x, y = coords[:, 0].astype(float), coords[:, 1].astype(float)
+        area = np.add.reduceat(x * y[following] - x[following] * y, starts)
+
+        flip = np.repeat(area < 0, sizes)
+        if not flip.any():
+            return coords
+
+        position = np.arange(len(coords)) - np.repeat(starts, sizes)
+        reverse = np.repeat(offsets[1:] - 1, sizes) - position
+        return coords[np.where(flip, reverse, np.arange(len(coords)))]
+
+    def drawTitle(self, title: str, layer: str = "title", font: str = "Light") -> None:
+        """Writes a title on the image, as text
+
+        Args:
+            text (str): Title text
+            layer (str, optional): Layer name. Defaults to "title".
+            font (str, optional): Chivo variant, one of FONT_VARIANTS. Defaults to "Light".
+        """
+        dy = int((1 - self._scl) * self._sizes[1] * 0.25)
+        dx = self._sizes[0] // 2
+        # raster titles are anchored to the top of the ascenders, text to its baseline
+        ascent = loadFont(font, self._title_size).getmetrics()[0]
+        fill = _rgb(self._palette.get("title", self._title_color))
+
+        with self._instrumentation.timer("draw"):
+            self._writer.text(
+                (dx, dy + ascent), title, font, self._title_size, fill, layer
+            )
+
+    def save(self, filename: str | None = None) -> None:
+        """Completes the file. Vector images are streamed to the file picked when
+        the image was created, which is the only one they can be saved to.
+
+        Args:
+            filename (str | None, optional): Filename, must match the one of the image.
+                Defaults to None.
+
+        Raises:
+            ValueError: the filename is not the one of the image
+        """
+        if filename is not None and os.path.abspath(filename) != os.path.abspath(
+            self._filename
+        ):
+            raise ValueError(
+                f"Vector image is streamed to {self._filename}, can't save it to {filename}"
+            )
+
+        self.close()
+
+    def render(self) -> None:
+        """Vector images are never rasterized, see save
+
+        Raises:
+            TypeError: always
+        """
+        raise TypeError(_RASTER_ERROR)
+
+    def renderThemes(self, palettes: list[dict]) -> None:
+        """Vector images are never rasterized: create one image per theme instead,
+        passing its palette
+
+        Raises:
+            TypeError: always
+        """
+        raise TypeError(_RASTER_ERROR)
+
+    def renderLayers(self, layers: list[str], composite: bool = False) -> None:
+        """Vector images are never rasterized: each layer is a group of the SVG file
+
+        Raises:
+            TypeError: always
+        """
+        raise TypeError(_RASTER_ERROR)